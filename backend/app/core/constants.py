@@ -30,6 +30,22 @@ MEMORY_TYPE_DAYS = {
     MEMORY_TYPE_LEVEL_ARCHIVE: float("inf"),
 }
 
+# 長期archiveの生成方法
+# （incremental: 直前のarchiveに最新のlevel_1000のみを統合する、full: すべてのlevel_1000を要約し直す）
+LEVEL_ARCHIVE_MODE_INCREMENTAL = "incremental"
+LEVEL_ARCHIVE_MODE_FULL = "full"
+
+# incrementalモードで保持するarchiveの数（古いものから削除する）
+LEVEL_ARCHIVE_CHAIN_LENGTH = 3
+
+# add_memories_bulk で1回のINSERT文にまとめる記憶の数
+MEMORY_BULK_INSERT_CHUNK_SIZE = 1000
+
+# 古いdaily_raw記憶を圧縮して保存する設定
+COLD_STORAGE_MIN_AGE_DAYS = 30  # 作成からこの日数を過ぎた記憶を対象とする
+COLD_STORAGE_BATCH_SIZE = 500  # 1回のトランザクションで圧縮する記憶の数
+COLD_STORAGE_COMPRESSION_LEVEL = 6  # zlibの圧縮レベル
+
 # セッションタイプ
 SESSION_TYPE_CONVERSATION = "conversation"  # 会話セッション
 SESSION_TYPE_SLEEP = "sleep"  # 睡眠セッション
@@ -39,6 +55,101 @@ SESSION_STATUS_ACTIVE = "active"  # アクティブなセッション
 SESSION_STATUS_COMPLETED = "completed"  # 完了したセッション
 SESSION_STATUS_ERROR = "error"  # エラーが発生したセッション
 
+# 睡眠処理ジョブの状態
+SLEEP_JOB_STATUS_PENDING = "pending"  # 実行待ち
+SLEEP_JOB_STATUS_RUNNING = "running"  # ワーカーが実行中
+SLEEP_JOB_STATUS_COMPLETED = "completed"  # 完了
+SLEEP_JOB_STATUS_DEAD = "dead"  # 再試行の上限に達して破棄
+
 # セッションのプロパティ名
 SESSION_PROP_CURRENT_DAY = "current_day"  # 現在の日
 SESSION_PROP_DEVICE_ID = "device_id"  # デバイスID
+SESSION_PROP_COMPLETED_STEPS = "completed_steps"  # 睡眠処理の完了済みステップ
+SESSION_PROP_RESUMED_FROM = "resumed_from"  # 再開元の睡眠セッションID
+
+# モデルごとの記憶プロンプトに割り当てるトークン数の上限
+MEMORY_TOKEN_BUDGETS = {
+    "gemini/gemini-2.0-flash": 32000,
+    "openai/gpt-4o": 16000,
+    "openai/gpt-4o-mini": 16000,
+    "anthropic/claude-3-7-sonnet-20250219": 16000,
+    "anthropic/claude-3-5-haiku-20241022": 8000,
+}
+DEFAULT_MEMORY_TOKEN_BUDGET = 8000
+
+# LLM呼び出しの同時実行数の上限（全体とプロバイダーごと）
+LLM_MAX_CONCURRENCY = 32
+LLM_PROVIDER_CONCURRENCY = {
+    "gemini": 16,
+    "openai": 16,
+    "anthropic": 8,
+}
+DEFAULT_LLM_PROVIDER_CONCURRENCY = 8
+
+# LLM呼び出しのレート制限（モデル名またはプロバイダー名ごとの1分あたりの上限）
+LLM_RATE_LIMITS = {
+    "gemini/gemini-2.0-flash": {
+        "requests_per_minute": 2000,
+        "tokens_per_minute": 4000000,
+    },
+    "openai/gpt-4o": {"requests_per_minute": 5000, "tokens_per_minute": 800000},
+    "openai/gpt-4o-mini": {"requests_per_minute": 5000, "tokens_per_minute": 4000000},
+    "anthropic": {"requests_per_minute": 50, "tokens_per_minute": 40000},
+}
+DEFAULT_LLM_RATE_LIMIT = {"requests_per_minute": 60, "tokens_per_minute": 100000}
+
+# レート制限の見積もりに使用する応答の想定トークン数
+LLM_EXPECTED_OUTPUT_TOKENS = 1024
+
+# LLM呼び出しの再試行とサーキットブレーカーの設定
+LLM_MAX_RETRIES = 5
+LLM_RETRY_BASE_DELAY = 1.0  # 秒
+LLM_RETRY_MAX_DELAY = 60.0  # 秒
+LLM_CIRCUIT_FAILURE_THRESHOLD = 5
+LLM_CIRCUIT_RESET_TIMEOUT = 30.0  # 秒
+
+# モデルごとのコンテキストウィンドウ（入力トークン数）
+LLM_CONTEXT_WINDOWS = {
+    "gemini/gemini-2.0-flash": 1048576,
+    "openai/gpt-4o": 128000,
+    "openai/gpt-4o-mini": 128000,
+    "anthropic/claude-3-7-sonnet-20250219": 200000,
+    "anthropic/claude-3-5-haiku-20241022": 200000,
+}
+DEFAULT_LLM_CONTEXT_WINDOW = 32000
+
+# 要約の入力を分割する際の1グループの最大トークン数
+# （コンテキストウィンドウに対する割合と、1回の呼び出しの遅延を抑えるための上限）
+SUMMARY_CHUNK_CONTEXT_RATIO = 0.5
+SUMMARY_CHUNK_MAX_TOKENS = 32000
+
+# 記憶タイプと入力トークン数ごとのLLMモデルのルーティング
+# （入力トークン数の上限の昇順、Noneは上限なし。モデルは失敗時に順に試す）
+LLM_MODEL_ROUTES = {
+    MEMORY_TYPE_DAILY_RAW: [
+        (None, ["gemini/gemini-2.0-flash", "openai/gpt-4o-mini"]),
+    ],
+    MEMORY_TYPE_DAILY_SUMMARY: [
+        (None, ["gemini/gemini-2.0-flash", "openai/gpt-4o-mini"]),
+    ],
+    MEMORY_TYPE_LEVEL_10: [
+        (None, ["gemini/gemini-2.0-flash", "openai/gpt-4o-mini"]),
+    ],
+    MEMORY_TYPE_LEVEL_100: [
+        (16000, ["gemini/gemini-2.0-flash", "openai/gpt-4o-mini"]),
+        (None, ["gemini/gemini-2.0-flash", "openai/gpt-4o"]),
+    ],
+    MEMORY_TYPE_LEVEL_1000: [
+        (None, ["anthropic/claude-3-7-sonnet-20250219", "openai/gpt-4o"]),
+    ],
+    MEMORY_TYPE_LEVEL_ARCHIVE: [
+        (None, ["anthropic/claude-3-7-sonnet-20250219", "openai/gpt-4o"]),
+    ],
+}
+
+# 睡眠処理ジョブのリース期間・ハートビート間隔・再試行（秒）
+SLEEP_JOB_LEASE_SECONDS = 300
+SLEEP_JOB_HEARTBEAT_INTERVAL = 60
+SLEEP_JOB_MAX_ATTEMPTS = 5
+SLEEP_JOB_RETRY_DELAY = 60
+SLEEP_JOB_POLL_INTERVAL = 5
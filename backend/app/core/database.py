@@ -2,6 +2,7 @@ import os
 import re
 
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
@@ -37,11 +38,23 @@ else:
     DATABASE_URL = "sqlite:///:memory:"
     print("SQLiteのインメモリデータベースを使用します（テスト用）")
 
+# 非同期エンジン用の接続URL（PostgreSQLはasyncpg、SQLiteはaiosqliteを使用）
+ASYNC_DATABASE_URL = DATABASE_URL.replace(
+    "postgresql://", "postgresql+asyncpg://", 1
+).replace("sqlite://", "sqlite+aiosqlite://", 1)
+
 # SQLAlchemyエンジンとセッションの作成
 engine = create_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+# 非同期エンジンとセッションの作成
+# コミット後の属性アクセスで暗黙のI/Oが発生しないよう expire_on_commit=False とする
+async_engine = create_async_engine(ASYNC_DATABASE_URL)
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine, autoflush=False, expire_on_commit=False
+)
+
 
 def get_db():
     """
@@ -54,3 +67,13 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+async def get_async_db():
+    """
+    非同期データベースセッションの依存性注入用関数
+
+    FastAPIの非同期エンドポイントのDependencyとして使用される
+    """
+    async with AsyncSessionLocal() as db:
+        yield db
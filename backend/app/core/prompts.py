@@ -2,6 +2,10 @@
 記憶生成と処理に使用するプロンプト定義
 """
 
+# プロンプトのバージョン（LLM応答キャッシュのキーに含まれるため、
+# プロンプトを変更した場合は更新すること）
+PROMPT_TEMPLATE_VERSION = "1"
+
 # 生の会話をdaily_raw記憶に変換するためのプロンプト
 DAILY_RAW_CONVERSION_PROMPT = """
 あなたはAIキャラクターの記憶を処理するシステムです。以下の会話履歴を分析し、AIキャラクターの視点から記憶として保存すべき情報を抽出してください。
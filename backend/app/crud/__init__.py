@@ -1,9 +1,10 @@
 __all__ = [
     "create_character", "get_character", "get_characters_by_user", "update_character", "delete_character",
-    "add_memory", "get_memories_by_character", "update_memory", "delete_memory",
+    "add_memory", "get_memories_by_character", "get_memories_page", "iter_memories_by_character",
+    "get_memories_in_ranges", "update_memory", "delete_memory",
     "create_session", "get_active_session", "update_session", "end_session"
 ]
 
 from .character import create_character, get_character, get_characters_by_user, update_character, delete_character
-from .memory import add_memory, get_memories_by_character, update_memory, delete_memory
+from .memory import add_memory, get_memories_by_character, get_memories_page, iter_memories_by_character, get_memories_in_ranges, update_memory, delete_memory
 from .session import create_session, get_active_session, update_session, end_session
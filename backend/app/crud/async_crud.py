@@ -0,0 +1,369 @@
+"""
+AsyncSession用のデータアクセス関数
+
+同期版のCRUD関数を AsyncSession.run_sync 経由で実行するため、処理内容・例外は
+同期版と同じで、データベースI/Oは非同期ドライバ（asyncpg/aiosqlite）で行われる。
+"""
+
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.constants import SESSION_STATUS_COMPLETED
+from app.crud import character as character_crud
+from app.crud import memory as memory_crud
+from app.crud import session as session_crud
+from app.models import Character, Memory
+from app.models import Session as DbSession
+
+
+async def create_character(
+    db: AsyncSession, user_id: uuid.UUID, name: str, config: Dict[str, Any] = {}
+) -> Character:
+    """
+    新しいキャラクターを作成する
+
+    Args:
+        db: 非同期データベースセッション
+        user_id: ユーザーID
+        name: キャラクター名
+        config: キャラクター設定（オプション）
+
+    Returns:
+        作成されたキャラクターのインスタンス
+    """
+    return await db.run_sync(character_crud.create_character, user_id, name, config)
+
+
+async def get_character(
+    db: AsyncSession, character_id: uuid.UUID
+) -> Optional[Character]:
+    """
+    キャラクターIDでキャラクターを取得する
+
+    Args:
+        db: 非同期データベースセッション
+        character_id: キャラクターID
+
+    Returns:
+        キャラクターのインスタンス、見つからない場合はNone
+    """
+    return await db.run_sync(character_crud.get_character, character_id)
+
+
+async def get_characters_by_user(
+    db: AsyncSession, user_id: uuid.UUID, skip: int = 0, limit: int = 100
+) -> List[Character]:
+    """
+    ユーザーIDに基づいてキャラクターのリストを取得する
+
+    Args:
+        db: 非同期データベースセッション
+        user_id: ユーザーID
+        skip: スキップするレコード数
+        limit: 取得するレコードの最大数
+
+    Returns:
+        キャラクターのリスト
+    """
+    return await db.run_sync(
+        character_crud.get_characters_by_user, user_id, skip, limit
+    )
+
+
+async def update_character(
+    db: AsyncSession,
+    character_id: uuid.UUID,
+    name: Optional[str] = None,
+    config: Optional[Dict[str, Any]] = None,
+) -> Character:
+    """
+    キャラクターを更新する
+
+    Args:
+        db: 非同期データベースセッション
+        character_id: キャラクターID
+        name: 新しいキャラクター名（オプション）
+        config: 新しいキャラクター設定（オプション）
+
+    Returns:
+        更新されたキャラクターのインスタンス
+    """
+    return await db.run_sync(
+        character_crud.update_character, character_id, name, config
+    )
+
+
+async def delete_character(db: AsyncSession, character_id: uuid.UUID) -> bool:
+    """
+    キャラクターを削除する
+
+    Args:
+        db: 非同期データベースセッション
+        character_id: キャラクターID
+
+    Returns:
+        削除が成功したかどうか
+    """
+    return await db.run_sync(character_crud.delete_character, character_id)
+
+
+async def add_memory(
+    db: AsyncSession,
+    user_id: uuid.UUID,
+    character_id: uuid.UUID,
+    memory_type: str,
+    start_day: int,
+    end_day: int,
+    content: str,
+    source_fingerprint: Optional[str] = None,
+) -> Memory:
+    """
+    新しい記憶を追加する
+
+    Args:
+        db: 非同期データベースセッション
+        user_id: ユーザーID
+        character_id: キャラクターID
+        memory_type: 記憶タイプ
+        start_day: 開始日
+        end_day: 終了日
+        content: 記憶内容
+        source_fingerprint: 要約の入力となった記憶のフィンガープリント（オプション）
+
+    Returns:
+        作成された記憶のインスタンス
+    """
+    return await db.run_sync(
+        memory_crud.add_memory,
+        user_id,
+        character_id,
+        memory_type,
+        start_day,
+        end_day,
+        content,
+        source_fingerprint,
+    )
+
+
+async def get_memories_by_character(
+    db: AsyncSession,
+    character_id: uuid.UUID,
+    memory_type: Optional[str] = None,
+    start_day: Optional[int] = None,
+    end_day: Optional[int] = None,
+    skip: int = 0,
+    limit: int = 100,
+) -> List[Memory]:
+    """
+    キャラクターIDと条件に基づいて記憶を取得する
+
+    Args:
+        db: 非同期データベースセッション
+        character_id: キャラクターID
+        memory_type: 記憶タイプでフィルタリング（オプション）
+        start_day: 開始日でフィルタリング（オプション）
+        end_day: 終了日でフィルタリング（オプション）
+        skip: スキップするレコード数
+        limit: 取得するレコードの最大数
+
+    Returns:
+        記憶のリスト
+    """
+    return await db.run_sync(
+        memory_crud.get_memories_by_character,
+        character_id,
+        memory_type,
+        start_day,
+        end_day,
+        skip,
+        limit,
+    )
+
+
+async def get_memories_page(
+    db: AsyncSession,
+    character_id: uuid.UUID,
+    memory_type: Optional[str] = None,
+    start_day: Optional[int] = None,
+    end_day: Optional[int] = None,
+    after: Optional[Tuple[int, uuid.UUID]] = None,
+    limit: int = 100,
+) -> Tuple[List[Memory], Optional[Tuple[int, uuid.UUID]]]:
+    """
+    キャラクターの記憶を(開始日, ID)のカーソルでページ単位に取得する
+
+    Args:
+        db: 非同期データベースセッション
+        character_id: キャラクターID
+        memory_type: 記憶タイプでフィルタリング（オプション）
+        start_day: 開始日でフィルタリング（オプション）
+        end_day: 終了日でフィルタリング（オプション）
+        after: 前のページが返したカーソル（Noneの場合は先頭から）
+        limit: 1ページのレコードの最大数
+
+    Returns:
+        (開始日の降順に並んだ記憶のリスト, 次のページのカーソル（最後のページの場合はNone）)
+    """
+    return await db.run_sync(
+        memory_crud.get_memories_page,
+        character_id,
+        memory_type,
+        start_day,
+        end_day,
+        after,
+        limit,
+    )
+
+
+async def get_memories_in_ranges(
+    db: AsyncSession,
+    character_id: uuid.UUID,
+    ranges: List[Tuple[str, Optional[int], Optional[int]]],
+) -> List[Memory]:
+    """
+    複数の(記憶タイプ, 開始日, 終了日)条件に一致する記憶を1回のクエリで取得する
+
+    Args:
+        db: 非同期データベースセッション
+        character_id: キャラクターID
+        ranges: (記憶タイプ, 開始日の下限, 終了日の上限) のリスト
+
+    Returns:
+        開始日の降順に並んだ記憶のリスト
+    """
+    return await db.run_sync(memory_crud.get_memories_in_ranges, character_id, ranges)
+
+
+async def update_memory(
+    db: AsyncSession,
+    memory_id: uuid.UUID,
+    content: Optional[str] = None,
+    memory_type: Optional[str] = None,
+    source_fingerprint: Optional[str] = None,
+) -> Memory:
+    """
+    記憶を更新する
+
+    Args:
+        db: 非同期データベースセッション
+        memory_id: 記憶ID
+        content: 新しい記憶内容（オプション）
+        memory_type: 新しい記憶タイプ（オプション）
+        source_fingerprint: 新しい入力記憶のフィンガープリント（オプション）
+
+    Returns:
+        更新された記憶のインスタンス
+    """
+    return await db.run_sync(
+        memory_crud.update_memory, memory_id, content, memory_type, source_fingerprint
+    )
+
+
+async def delete_memory(db: AsyncSession, memory_id: uuid.UUID) -> bool:
+    """
+    記憶を削除する
+
+    Args:
+        db: 非同期データベースセッション
+        memory_id: 記憶ID
+
+    Returns:
+        削除が成功したかどうか
+    """
+    return await db.run_sync(memory_crud.delete_memory, memory_id)
+
+
+async def create_session(
+    db: AsyncSession,
+    user_id: uuid.UUID,
+    character_id: uuid.UUID,
+    device_id: str,
+    session_type: str,
+    properties: Dict[str, Any] = None,
+) -> DbSession:
+    """
+    新しいセッションを作成する
+
+    Args:
+        db: 非同期データベースセッション
+        user_id: ユーザーID
+        character_id: キャラクターID
+        device_id: デバイスID
+        session_type: セッションタイプ ('conversation' または 'sleep')
+        properties: セッションに関連する追加プロパティ (オプション)
+
+    Returns:
+        作成されたセッションのインスタンス
+    """
+    return await db.run_sync(
+        session_crud.create_session,
+        user_id,
+        character_id,
+        device_id,
+        session_type,
+        properties,
+    )
+
+
+async def get_active_session(
+    db: AsyncSession, character_id: uuid.UUID
+) -> Optional[DbSession]:
+    """
+    キャラクターIDに基づいてアクティブなセッションを取得する
+
+    Args:
+        db: 非同期データベースセッション
+        character_id: キャラクターID
+
+    Returns:
+        アクティブなセッションのインスタンス、見つからない場合はNone
+    """
+    return await db.run_sync(session_crud.get_active_session, character_id)
+
+
+async def update_session(
+    db: AsyncSession,
+    session_id: uuid.UUID,
+    is_active: Optional[bool] = None,
+    status: Optional[str] = None,
+    properties: Optional[Dict[str, Any]] = None,
+) -> DbSession:
+    """
+    セッションを更新する
+
+    Args:
+        db: 非同期データベースセッション
+        session_id: セッションID
+        is_active: 新しいアクティブ状態 (オプション)
+        status: 新しいステータス (オプション)
+        properties: 更新するプロパティ (オプション、部分更新)
+
+    Returns:
+        更新されたセッションのインスタンス
+    """
+    return await db.run_sync(
+        session_crud.update_session, session_id, is_active, status, properties
+    )
+
+
+async def end_session(
+    db: AsyncSession,
+    session_id: uuid.UUID,
+    status: str = SESSION_STATUS_COMPLETED,
+    properties: Optional[Dict[str, Any]] = None,
+) -> DbSession:
+    """
+    セッションを終了する（非アクティブにする）
+
+    Args:
+        db: 非同期データベースセッション
+        session_id: セッションID
+        status: 終了時のステータス (デフォルト: 'completed')
+        properties: 更新するプロパティ (オプション)
+
+    Returns:
+        更新されたセッションのインスタンス
+    """
+    return await db.run_sync(session_crud.end_session, session_id, status, properties)
@@ -1,13 +1,277 @@
-from sqlalchemy.orm import Session
+from sqlalchemy import Integer, and_, case, column, func, insert, or_, values
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.exc import SQLAlchemyError
 from fastapi import HTTPException
+import logging
 import uuid
-from typing import Optional
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import partial
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
-from app.models import Memory
+from app.core.constants import (
+    COLD_STORAGE_BATCH_SIZE,
+    COLD_STORAGE_COMPRESSION_LEVEL,
+    COLD_STORAGE_MIN_AGE_DAYS,
+    MEMORY_BULK_INSERT_CHUNK_SIZE,
+    MEMORY_TYPE_DAILY_RAW,
+    MEMORY_TYPE_DAILY_SUMMARY,
+)
+
+from app.memory.cache import memory_context_cache
+from app.memory.embeddings import memory_embedding_store
+from app.memory.search import memory_search_index
+from app.models import Memory, MemoryColdContent
+
+logger = logging.getLogger(__name__)
+
+# Session.info に保持する、バッチ書き込み中のコミット後の処理のリストのキー
+_BATCH_CALLBACKS_KEY = "memory_batch_callbacks"
+
+# add_memories_bulk の各記憶に必須のキー
+_BULK_REQUIRED_FIELDS = ("user_id", "character_id", "memory_type", "start_day", "end_day", "content")
+
+@contextmanager
+def batched_writes(db: Session) -> Iterator[Session]:
+    """
+    記憶とキャラクターの書き込みをまとめて1つのトランザクションでコミットする
+
+    コンテキスト内の add_memory / update_memory / delete_memory はコミットと refresh を
+    行わずに flush のみを行う（作成日時などのサーバー側の既定値は INSERT ... RETURNING で
+    取得される）。キャッシュと検索インデックスへの反映はコミット後にまとめて行い、
+    例外が発生した場合はすべての書き込みを破棄する。入れ子になった場合は
+    最も外側のコンテキストでコミットする。コミット後の処理は個別に実行し、
+    失敗した処理はログに記録して残りの処理を続ける。
+
+    Args:
+        db: データベースセッション
+
+    Returns:
+        同じデータベースセッション
+    """
+    if _BATCH_CALLBACKS_KEY in db.info:
+        yield db
+        return
+
+    callbacks = db.info[_BATCH_CALLBACKS_KEY] = []
+    try:
+        yield db
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.info.pop(_BATCH_CALLBACKS_KEY, None)
+
+    for callback in callbacks:
+        _run_after_commit(callback)
+
+def in_batched_writes(db: Session) -> bool:
+    """
+    バッチ書き込み中かどうかを返す
+    """
+    return _BATCH_CALLBACKS_KEY in db.info
+
+def commit_writes(db: Session):
+    """
+    書き込みを確定する（バッチ書き込み中は flush のみを行い、コミットはバッチの終了時に行う）
+
+    Args:
+        db: データベースセッション
+    """
+    if in_batched_writes(db):
+        db.flush()
+    else:
+        db.commit()
+
+def after_commit(db: Session, callback: Callable[[], None]):
+    """
+    書き込みのコミット後に実行する処理を登録する（バッチ書き込み中でなければ即時に実行する）
+
+    Args:
+        db: データベースセッション
+        callback: コミット後に実行する関数
+    """
+    if in_batched_writes(db):
+        db.info[_BATCH_CALLBACKS_KEY].append(callback)
+    else:
+        _run_after_commit(callback)
+
+def _run_after_commit(callback: Callable[[], None]):
+    """
+    コミット後の処理を実行する
+
+    書き込みは確定済みのため、処理の失敗は呼び出し元に伝えずログに記録する。
+    """
+    try:
+        callback()
+    except Exception:
+        logger.exception("コミット後の処理に失敗しました: %r", callback)
+
+def _on_memory_saved(db: Session, db_memory: Memory):
+    """
+    記憶の追加・更新をキャッシュと検索インデックスに反映する
+
+    Args:
+        db: データベースセッション
+        db_memory: 追加または更新された記憶
+    """
+    # コミット後に属性を再読み込みしないよう値を先に取り出す
+    character_id, memory_id = db_memory.character_id, db_memory.id
+    content, end_day = db_memory.content, db_memory.end_day
+
+    # キャッシュの破棄を最初に行い、各処理は他の処理の失敗の影響を受けないよう個別に登録する
+    # （埋め込みベクトルはキューに追加するのみで、計算は次の検索時に行う）
+    after_commit(db, partial(memory_context_cache.invalidate, character_id, end_day))
+    after_commit(db, partial(memory_search_index.add_memory, character_id, memory_id, content))
+    after_commit(db, partial(memory_embedding_store.add_memory, character_id, memory_id, content))
+
+def _on_memory_deleted(db: Session, character_id: uuid.UUID, memory_id: uuid.UUID, end_day: int):
+    """
+    記憶の削除をキャッシュと検索インデックスに反映する
+
+    Args:
+        db: データベースセッション
+        character_id: キャラクターID
+        memory_id: 削除された記憶ID
+        end_day: 削除された記憶の終了日
+    """
+    after_commit(db, partial(memory_context_cache.invalidate, character_id, end_day))
+    after_commit(db, partial(memory_search_index.remove_memory, character_id, memory_id))
+    after_commit(db, partial(memory_embedding_store.remove_memory, character_id, memory_id))
+
+def _get_cold_contents(db: Session, memory_ids: List[uuid.UUID]) -> Dict[uuid.UUID, str]:
+    """
+    圧縮して保存された記憶内容を展開して取得する
+    """
+    if not memory_ids:
+        return {}
+
+    rows = (
+        db.query(MemoryColdContent.memory_id, MemoryColdContent.compressed_content)
+        .filter(MemoryColdContent.memory_id.in_(memory_ids))
+        .all()
+    )
+    return {
+        memory_id: zlib.decompress(compressed_content).decode("utf-8")
+        for memory_id, compressed_content in rows
+    }
+
+def _load_cold_contents(db: Session, memories: List[Memory]) -> List[Memory]:
+    """
+    圧縮された記憶の内容を展開してインスタンスに設定する
+
+    変更として扱われないよう読み込み済みの値として設定するため、
+    展開した内容がcontent列に書き戻されることはない。
+
+    Args:
+        db: データベースセッション
+        memories: 記憶のリスト
+
+    Returns:
+        同じ記憶のリスト
+    """
+    cold_contents = _get_cold_contents(
+        db, [memory.id for memory in memories if memory.is_compressed and not memory.content]
+    )
+    for memory in memories:
+        if memory.id in cold_contents:
+            set_committed_value(memory, "content", cold_contents[memory.id])
+    return memories
+
+def compress_old_daily_raw(
+    db: Session, min_age_days: float = COLD_STORAGE_MIN_AGE_DAYS,
+    limit: int = COLD_STORAGE_BATCH_SIZE, character_id: Optional[uuid.UUID] = None,
+    now: Optional[datetime] = None
+) -> Dict[str, int]:
+    """
+    古いdaily_raw記憶の内容を圧縮して memory_cold_contents に移す
+
+    作成から min_age_days 日を過ぎ、同じ日のdaily_summaryが作成済みの記憶を対象とする。
+    移した記憶のcontent列は空になり、取得時に展開される。
+
+    Args:
+        db: データベースセッション
+        min_age_days: 対象とする記憶の作成からの日数
+        limit: 1回で圧縮する記憶の最大数
+        character_id: 対象のキャラクターID（Noneの場合はすべてのキャラクター）
+        now: 現在日時（Noneの場合は datetime.now()）
+
+    Returns:
+        圧縮した記憶の数と、圧縮前後および削減したバイト数
+    """
+    now = now or datetime.now()
+    summary = aliased(Memory)
+    query = db.query(Memory).filter(
+        Memory.memory_type == MEMORY_TYPE_DAILY_RAW,
+        Memory.is_compressed.is_(False),
+        Memory.created_at < now - timedelta(days=min_age_days),
+        db.query(summary.id).filter(
+            summary.character_id == Memory.character_id,
+            summary.memory_type == MEMORY_TYPE_DAILY_SUMMARY,
+            summary.start_day == Memory.start_day,
+        ).exists(),
+    )
+    if character_id is not None:
+        query = query.filter(Memory.character_id == character_id)
+
+    report = {"compressed_count": 0, "original_bytes": 0, "compressed_bytes": 0, "bytes_reclaimed": 0}
+    try:
+        for memory in query.order_by(Memory.created_at, Memory.id).limit(limit).all():
+            original = memory.content.encode("utf-8")
+            compressed = zlib.compress(original, COLD_STORAGE_COMPRESSION_LEVEL)
+            db.add(MemoryColdContent(
+                memory_id=memory.id,
+                compressed_content=compressed,
+                original_bytes=len(original),
+                compressed_bytes=len(compressed),
+            ))
+            memory.content = ""
+            memory.is_compressed = True
+            report["compressed_count"] += 1
+            report["original_bytes"] += len(original)
+            report["compressed_bytes"] += len(compressed)
+        db.commit()
+    except SQLAlchemyError as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"記憶の圧縮中にエラーが発生しました: {str(e)}")
+
+    report["bytes_reclaimed"] = report["original_bytes"] - report["compressed_bytes"]
+    return report
+
+def get_cold_storage_stats(db: Session, character_id: Optional[uuid.UUID] = None) -> Dict[str, int]:
+    """
+    圧縮して保存された記憶の集計を取得する
+
+    Args:
+        db: データベースセッション
+        character_id: 対象のキャラクターID（Noneの場合はすべてのキャラクター）
+
+    Returns:
+        圧縮された記憶の数と、圧縮前後および削減したバイト数
+    """
+    query = db.query(
+        func.count(MemoryColdContent.memory_id),
+        func.coalesce(func.sum(MemoryColdContent.original_bytes), 0),
+        func.coalesce(func.sum(MemoryColdContent.compressed_bytes), 0),
+    )
+    if character_id is not None:
+        query = query.join(Memory, Memory.id == MemoryColdContent.memory_id).filter(
+            Memory.character_id == character_id
+        )
+    count, original_bytes, compressed_bytes = query.one()
+    return {
+        "compressed_count": count,
+        "original_bytes": original_bytes,
+        "compressed_bytes": compressed_bytes,
+        "bytes_reclaimed": original_bytes - compressed_bytes,
+    }
 
 def add_memory(db: Session, user_id: uuid.UUID, character_id: uuid.UUID, memory_type: str, 
-               start_day: int, end_day: int, content: str):
+               start_day: int, end_day: int, content: str,
+               source_fingerprint: Optional[str] = None):
     """
     新しい記憶を追加する
     
@@ -19,6 +283,7 @@ def add_memory(db: Session, user_id: uuid.UUID, character_id: uuid.UUID, memory_
         start_day: 開始日
         end_day: 終了日
         content: 記憶内容
+        source_fingerprint: 要約の入力となった記憶のフィンガープリント（オプション）
     
     Returns:
         作成された記憶のインスタンス
@@ -30,16 +295,124 @@ def add_memory(db: Session, user_id: uuid.UUID, character_id: uuid.UUID, memory_
             memory_type=memory_type,
             start_day=start_day,
             end_day=end_day,
-            content=content
+            content=content,
+            source_fingerprint=source_fingerprint
         )
         db.add(db_memory)
-        db.commit()
-        db.refresh(db_memory)
+        if in_batched_writes(db):
+            db.flush()
+        else:
+            db.commit()
+            db.refresh(db_memory)
+        _on_memory_saved(db, db_memory)
         return db_memory
     except SQLAlchemyError as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=f"記憶追加中にエラーが発生しました: {str(e)}")
 
+def add_memories_bulk(
+    db: Session, memories: Iterable[Dict[str, Any]],
+    chunk_size: int = MEMORY_BULK_INSERT_CHUNK_SIZE, return_ids: bool = False
+) -> Union[int, List[uuid.UUID]]:
+    """
+    複数の記憶を executemany でまとめて追加する
+
+    ORMのインスタンスを作らずに chunk_size 件ずつ1回のINSERTで追加し、
+    すべての記憶を1つのトランザクションでコミットする（バッチ書き込み中は
+    バッチの終了時）。PostgreSQLなど対応するドライバでは insertmanyvalues により
+    複数行の INSERT ... VALUES 文として送信される。コミット後はキャラクターごとに
+    キャッシュを1回破棄し、検索インデックスと埋め込みベクトルを破棄する。
+
+    Args:
+        db: データベースセッション
+        memories: user_id, character_id, memory_type, start_day, end_day, content と
+            任意の id, source_fingerprint, is_processed を持つ辞書のイテラブル
+        chunk_size: 1回のINSERTで追加する記憶の数
+        return_ids: INSERT ... RETURNING で追加した記憶IDを取得するかどうか
+
+    Returns:
+        return_ids が True の場合は追加した順の記憶IDのリスト、それ以外の場合は追加した件数
+    """
+    if chunk_size <= 0:
+        raise HTTPException(status_code=400, detail=f"無効なチャンクサイズです: {chunk_size}")
+
+    # ORMの一括処理を経由しないよう Core のテーブルに対して実行する
+    table = Memory.__table__
+    statement = insert(table)
+    if return_ids:
+        statement = statement.returning(table.c.id, sort_by_parameter_order=True)
+
+    inserted_ids: List[uuid.UUID] = []
+    # キャラクターごとの追加した記憶の最小の終了日（キャッシュの破棄に使用する）
+    from_days: Dict[uuid.UUID, int] = {}
+    count = 0
+
+    def flush_chunk(chunk: List[Dict[str, Any]]):
+        result = db.execute(statement, chunk)
+        if return_ids:
+            inserted_ids.extend(result.scalars().all())
+
+    try:
+        chunk: List[Dict[str, Any]] = []
+        for index, memory in enumerate(memories):
+            missing = [field for field in _BULK_REQUIRED_FIELDS if memory.get(field) is None]
+            if missing:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"{index}件目の記憶に必須の項目がありません: {', '.join(missing)}",
+                )
+            row = {
+                "id": memory.get("id") or uuid.uuid4(),
+                **{field: memory[field] for field in _BULK_REQUIRED_FIELDS},
+                "source_fingerprint": memory.get("source_fingerprint"),
+                "is_processed": memory.get("is_processed", False),
+                "is_compressed": False,
+            }
+            chunk.append(row)
+            character_id, end_day = row["character_id"], row["end_day"]
+            from_days[character_id] = min(end_day, from_days.get(character_id, end_day))
+            count += 1
+            if len(chunk) >= chunk_size:
+                flush_chunk(chunk)
+                chunk = []
+        if chunk:
+            flush_chunk(chunk)
+        commit_writes(db)
+    except HTTPException:
+        db.rollback()
+        raise
+    except SQLAlchemyError as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"記憶の一括追加中にエラーが発生しました: {str(e)}")
+
+    # 検索インデックスと埋め込みベクトルは1件ずつ反映せず、キャラクター単位で破棄して
+    # 次の検索時にDBから構築し直す
+    for character_id, from_day in from_days.items():
+        after_commit(db, partial(memory_context_cache.invalidate, character_id, from_day))
+        after_commit(db, partial(memory_search_index.drop_character, character_id))
+        after_commit(db, partial(memory_embedding_store.drop_character, character_id))
+    return inserted_ids if return_ids else count
+
+def _filter_memories_by_character(
+    db: Session, character_id: uuid.UUID, memory_type: Optional[str] = None,
+    start_day: Optional[int] = None, end_day: Optional[int] = None
+):
+    """
+    キャラクターIDと条件で記憶を絞り込むクエリを作成する
+    """
+    query = db.query(Memory).filter(Memory.character_id == character_id)
+    
+    if memory_type:
+        query = query.filter(Memory.memory_type == memory_type)
+    
+    if start_day is not None:
+        query = query.filter(Memory.start_day >= start_day)
+    
+    if end_day is not None:
+        query = query.filter(Memory.end_day <= end_day)
+    
+    return query
+
 def get_memories_by_character(
     db: Session, character_id: uuid.UUID, memory_type: Optional[str] = None, 
     start_day: Optional[int] = None, end_day: Optional[int] = None,
@@ -47,6 +420,9 @@ def get_memories_by_character(
 ):
     """
     キャラクターIDと条件に基づいて記憶を取得する
+
+    件数の多い履歴を走査する場合は get_memories_page または
+    iter_memories_by_character を使用する。
     
     Args:
         db: データベースセッション
@@ -60,20 +436,384 @@ def get_memories_by_character(
     Returns:
         記憶のリスト
     """
-    query = db.query(Memory).filter(Memory.character_id == character_id)
-    
-    if memory_type:
-        query = query.filter(Memory.memory_type == memory_type)
-    
-    if start_day is not None:
-        query = query.filter(Memory.start_day >= start_day)
-    
-    if end_day is not None:
-        query = query.filter(Memory.end_day <= end_day)
-    
-    return query.order_by(Memory.start_day.desc()).offset(skip).limit(limit).all()
+    query = _filter_memories_by_character(db, character_id, memory_type, start_day, end_day)
+    return _load_cold_contents(db, (
+        query.order_by(Memory.start_day.desc(), Memory.id.desc())
+        .offset(skip)
+        .limit(limit)
+        .all()
+    ))
 
-def update_memory(db: Session, memory_id: uuid.UUID, content: Optional[str] = None, memory_type: Optional[str] = None):
+def get_memories_page(
+    db: Session, character_id: uuid.UUID, memory_type: Optional[str] = None,
+    start_day: Optional[int] = None, end_day: Optional[int] = None,
+    after: Optional[Tuple[int, uuid.UUID]] = None, limit: int = 100
+):
+    """
+    キャラクターの記憶を(開始日, ID)のカーソルでページ単位に取得する
+
+    OFFSETを使わないため、ページの深さに関係なく一定の速度で取得できる。
+
+    Args:
+        db: データベースセッション
+        character_id: キャラクターID
+        memory_type: 記憶タイプでフィルタリング（オプション）
+        start_day: 開始日でフィルタリング（オプション）
+        end_day: 終了日でフィルタリング（オプション）
+        after: 前のページが返したカーソル（Noneの場合は先頭から）
+        limit: 1ページのレコードの最大数
+
+    Returns:
+        (開始日の降順に並んだ記憶のリスト, 次のページのカーソル（最後のページの場合はNone）)
+    """
+    if limit <= 0:
+        raise HTTPException(status_code=400, detail=f"無効な取得件数です: {limit}")
+
+    query = _filter_memories_by_character(db, character_id, memory_type, start_day, end_day)
+    if after is not None:
+        after_start_day, after_id = after
+        query = query.filter(or_(
+            Memory.start_day < after_start_day,
+            and_(Memory.start_day == after_start_day, Memory.id < after_id),
+        ))
+
+    # 次のページの有無を判定するため1件多く取得する
+    memories = (
+        query.order_by(Memory.start_day.desc(), Memory.id.desc())
+        .limit(limit + 1)
+        .all()
+    )
+    if len(memories) <= limit:
+        return _load_cold_contents(db, memories), None
+
+    memories = _load_cold_contents(db, memories[:limit])
+    return memories, (memories[-1].start_day, memories[-1].id)
+
+def iter_memories_by_character(
+    db: Session, character_id: uuid.UUID, memory_type: Optional[str] = None,
+    start_day: Optional[int] = None, end_day: Optional[int] = None,
+    batch_size: int = 1000
+) -> Iterator[Memory]:
+    """
+    キャラクターの条件に一致するすべての記憶を開始日の降順に順次取得する
+
+    サーバーサイドカーソルから batch_size 件ずつ読み込むため、件数に関係なく
+    一定のメモリで全履歴を走査できる。
+
+    Args:
+        db: データベースセッション
+        character_id: キャラクターID
+        memory_type: 記憶タイプでフィルタリング（オプション）
+        start_day: 開始日でフィルタリング（オプション）
+        end_day: 終了日でフィルタリング（オプション）
+        batch_size: 1回に読み込むレコード数
+
+    Returns:
+        記憶のイテレータ
+    """
+    query = _filter_memories_by_character(db, character_id, memory_type, start_day, end_day)
+    batch = []
+    for memory in query.order_by(Memory.start_day.desc(), Memory.id.desc()).yield_per(batch_size):
+        batch.append(memory)
+        if len(batch) >= batch_size:
+            yield from _load_cold_contents(db, batch)
+            batch = []
+    yield from _load_cold_contents(db, batch)
+
+def _ranges_condition(ranges: List[Tuple[str, Optional[int], Optional[int]]]):
+    """
+    (記憶タイプ, 開始日, 終了日)条件のリストをORで結合したフィルタ条件を作成する
+
+    Args:
+        ranges: (記憶タイプ, 開始日の下限, 終了日の上限) のリスト（日はNoneで無制限）
+
+    Returns:
+        SQLAlchemyのフィルタ条件
+    """
+    conditions = []
+    for memory_type, start_day, end_day in ranges:
+        clauses = [Memory.memory_type == memory_type]
+        if start_day is not None:
+            clauses.append(Memory.start_day >= start_day)
+        if end_day is not None:
+            clauses.append(Memory.end_day <= end_day)
+        conditions.append(and_(*clauses))
+    return or_(*conditions)
+
+def get_memories_in_ranges(
+    db: Session, character_id: uuid.UUID,
+    ranges: List[Tuple[str, Optional[int], Optional[int]]]
+):
+    """
+    複数の(記憶タイプ, 開始日, 終了日)条件に一致する記憶を1回のクエリで取得する
+
+    各条件は get_memories_by_character の memory_type/start_day/end_day と
+    同じ意味を持ち、OR で結合される。
+
+    Args:
+        db: データベースセッション
+        character_id: キャラクターID
+        ranges: (記憶タイプ, 開始日の下限, 終了日の上限) のリスト（日はNoneで無制限）
+
+    Returns:
+        開始日の降順に並んだ記憶のリスト
+    """
+    return get_memories_in_ranges_for_characters(db, [character_id], ranges)
+
+def get_memories_in_ranges_for_characters(
+    db: Session, character_ids: List[uuid.UUID],
+    ranges: List[Tuple[str, Optional[int], Optional[int]]]
+):
+    """
+    複数キャラクターの記憶を(記憶タイプ, 開始日, 終了日)条件で1回のクエリで取得する
+
+    Args:
+        db: データベースセッション
+        character_ids: キャラクターIDのリスト
+        ranges: (記憶タイプ, 開始日の下限, 終了日の上限) のリスト（日はNoneで無制限）
+
+    Returns:
+        開始日の降順に並んだ記憶のリスト
+    """
+    if not character_ids or not ranges:
+        return []
+
+    return _load_cold_contents(db, (
+        db.query(Memory)
+        .filter(Memory.character_id.in_(character_ids), _ranges_condition(ranges))
+        .order_by(Memory.start_day.desc(), Memory.id.desc())
+        .all()
+    ))
+
+def get_memories_in_relative_ranges_for_targets(
+    db: Session, targets: List[Tuple[uuid.UUID, int]],
+    ranges: List[Tuple[str, Optional[int], Optional[int]]]
+):
+    """
+    複数の(キャラクターID, 現在の日)について、現在の日からの相対範囲で記憶を1回のクエリで取得する
+
+    対象はVALUESの共通テーブル式として結合し、日付範囲は結合した現在の日からの
+    差として計算するため、現在の日の種類数にかかわらずクエリは1回になる。
+
+    Args:
+        db: データベースセッション
+        targets: (キャラクターID, 現在の日)のリスト
+        ranges: (記憶タイプ, 開始日の下限, 終了日の上限) のリスト
+            （下限と上限は現在の日から引く日数、Noneで無制限）
+
+    Returns:
+        開始日の降順に並んだ(記憶, 現在の日)の行のリスト
+    """
+    if not targets or not ranges:
+        return []
+
+    session_targets = values(
+        column("character_id", Memory.character_id.type),
+        column("current_day", Integer),
+        name="session_targets",
+    ).data(list(targets)).cte()
+    current_day = session_targets.c.current_day
+
+    conditions = []
+    for memory_type, start_offset, end_offset in ranges:
+        clauses = [Memory.memory_type == memory_type]
+        if start_offset is not None:
+            clauses.append(Memory.start_day >= current_day - start_offset)
+        if end_offset is not None:
+            clauses.append(Memory.end_day <= current_day - end_offset)
+        conditions.append(and_(*clauses))
+
+    rows = (
+        db.query(Memory, current_day)
+        .join(session_targets, session_targets.c.character_id == Memory.character_id)
+        .filter(or_(*conditions))
+        .order_by(Memory.start_day.desc(), Memory.id.desc())
+        .all()
+    )
+    _load_cold_contents(db, [memory for memory, _ in rows])
+    return rows
+
+def get_memory_metadata_in_ranges(
+    db: Session, character_id: uuid.UUID,
+    ranges: List[Tuple[str, Optional[int], Optional[int]]]
+):
+    """
+    (記憶タイプ, 開始日, 終了日)条件に一致する記憶のメタデータのみを取得する
+
+    記憶内容（content列）は読み込まず、長さのみをデータベース側で計算する。
+    圧縮済みの記憶は圧縮前のバイト数を長さとする（文字数の上限として扱う）。
+    内容が必要な記憶は get_memories_by_ids でまとめて取得する。
+
+    Args:
+        db: データベースセッション
+        character_id: キャラクターID
+        ranges: (記憶タイプ, 開始日の下限, 終了日の上限) のリスト（日はNoneで無制限）
+
+    Returns:
+        開始日の降順に並んだ(id, memory_type, start_day, end_day, content_length)の行のリスト
+    """
+    if not ranges:
+        return []
+
+    return (
+        db.query(
+            Memory.id,
+            Memory.memory_type,
+            Memory.start_day,
+            Memory.end_day,
+            case(
+                (Memory.is_compressed, func.coalesce(MemoryColdContent.original_bytes, 0)),
+                else_=func.coalesce(func.length(Memory.content), 0),
+            ).label("content_length"),
+        )
+        .outerjoin(MemoryColdContent, MemoryColdContent.memory_id == Memory.id)
+        .filter(Memory.character_id == character_id, _ranges_condition(ranges))
+        .order_by(Memory.start_day.desc(), Memory.id.desc())
+        .all()
+    )
+
+def get_latest_memory_before(db: Session, character_id: uuid.UUID, memory_type: str, end_day: int):
+    """
+    指定した日より前に終わる、終了日が最も新しい記憶を取得する
+
+    Args:
+        db: データベースセッション
+        character_id: キャラクターID
+        memory_type: 記憶タイプ
+        end_day: この日より前に終わる記憶を対象とする
+
+    Returns:
+        記憶のインスタンス、見つからない場合はNone
+    """
+    memory = (
+        db.query(Memory)
+        .filter(
+            Memory.character_id == character_id,
+            Memory.memory_type == memory_type,
+            Memory.end_day < end_day,
+        )
+        .order_by(Memory.end_day.desc(), Memory.created_at.desc(), Memory.id.desc())
+        .first()
+    )
+    if memory is not None:
+        _load_cold_contents(db, [memory])
+    return memory
+
+def get_memory_periods(db: Session, character_id: uuid.UUID, max_day: Optional[int] = None):
+    """
+    キャラクターの記憶が存在する(記憶タイプ, 開始日, 終了日)の組み合わせを取得する
+
+    記憶内容は読み込まないため、睡眠処理の追いつき計画で不足している要約を
+    判定するのに使用する。
+
+    Args:
+        db: データベースセッション
+        character_id: キャラクターID
+        max_day: 終了日の上限（Noneの場合は無制限）
+
+    Returns:
+        重複のない(memory_type, start_day, end_day)の行のリスト
+    """
+    query = db.query(Memory.memory_type, Memory.start_day, Memory.end_day).filter(
+        Memory.character_id == character_id
+    )
+
+    if max_day is not None:
+        query = query.filter(Memory.end_day <= max_day)
+
+    return query.distinct().all()
+
+def get_memories_for_range(
+    db: Session, character_id: uuid.UUID, memory_type: str, start_day: int, end_day: int
+):
+    """
+    記憶タイプと期間が完全に一致する記憶を取得する
+
+    Args:
+        db: データベースセッション
+        character_id: キャラクターID
+        memory_type: 記憶タイプ
+        start_day: 開始日
+        end_day: 終了日
+
+    Returns:
+        作成日時の昇順に並んだ記憶のリスト
+    """
+    return _load_cold_contents(db, (
+        db.query(Memory)
+        .filter(
+            Memory.character_id == character_id,
+            Memory.memory_type == memory_type,
+            Memory.start_day == start_day,
+            Memory.end_day == end_day,
+        )
+        .order_by(Memory.created_at, Memory.id)
+        .all()
+    ))
+
+def get_memories_by_ids(db: Session, memory_ids: List[uuid.UUID]):
+    """
+    記憶IDのリストに一致する記憶を1回のクエリで取得する
+
+    Args:
+        db: データベースセッション
+        memory_ids: 記憶IDのリスト
+
+    Returns:
+        記憶のリスト（順序は不定）
+    """
+    if not memory_ids:
+        return []
+
+    return _load_cold_contents(db, db.query(Memory).filter(Memory.id.in_(memory_ids)).all())
+
+def get_memory_contents(db: Session, character_id: uuid.UUID):
+    """
+    キャラクターのすべての記憶のIDと内容を取得する
+
+    Args:
+        db: データベースセッション
+        character_id: キャラクターID
+
+    Returns:
+        (記憶ID, 記憶内容)のリスト
+    """
+    rows = (
+        db.query(Memory.id, Memory.content, Memory.is_compressed)
+        .filter(Memory.character_id == character_id)
+        .all()
+    )
+    cold_contents = _get_cold_contents(db, [memory_id for memory_id, _, is_compressed in rows if is_compressed])
+    return [(memory_id, cold_contents.get(memory_id, content)) for memory_id, content, _ in rows]
+
+def get_memory_watermarks(db: Session, character_ids: Optional[List[uuid.UUID]] = None) -> Dict[uuid.UUID, str]:
+    """
+    キャラクターごとの記憶の状態（件数・内容の版数の合計・最新の作成日時）を取得する
+
+    保存した検索インデックスが現在の記憶と一致するかの検証に使用する。
+    記憶の追加・削除に加えて、内容の更新も版数の合計の変化として検出する。
+
+    Args:
+        db: データベースセッション
+        character_ids: キャラクターIDのリスト（Noneの場合はすべてのキャラクター）
+
+    Returns:
+        キャラクターIDごとの "件数:版数の合計:最新の作成日時" の文字列
+    """
+    query = db.query(
+        Memory.character_id, func.count(Memory.id), func.sum(Memory.content_version), func.max(Memory.created_at)
+    ).group_by(Memory.character_id)
+    if character_ids is not None:
+        if not character_ids:
+            return {}
+        query = query.filter(Memory.character_id.in_(character_ids))
+    return {
+        character_id: f"{count}:{versions or 0}:{latest.isoformat() if latest else ''}"
+        for character_id, count, versions, latest in query.all()
+    }
+
+def update_memory(db: Session, memory_id: uuid.UUID, content: Optional[str] = None, memory_type: Optional[str] = None,
+                  source_fingerprint: Optional[str] = None):
     """
     記憶を更新する
     
@@ -82,6 +822,7 @@ def update_memory(db: Session, memory_id: uuid.UUID, content: Optional[str] = No
         memory_id: 記憶ID
         content: 新しい記憶内容（オプション）
         memory_type: 新しい記憶タイプ（オプション）
+        source_fingerprint: 新しい入力記憶のフィンガープリント（オプション）
     
     Returns:
         更新された記憶のインスタンス
@@ -92,13 +833,29 @@ def update_memory(db: Session, memory_id: uuid.UUID, content: Optional[str] = No
             raise HTTPException(status_code=404, detail="記憶が見つかりません")
         
         if content is not None:
+            if db_memory.is_compressed:
+                # 内容を更新した記憶は圧縮を解除する
+                db.query(MemoryColdContent).filter(MemoryColdContent.memory_id == memory_id).delete(
+                    synchronize_session=False
+                )
+                db_memory.is_compressed = False
             db_memory.content = content
+            db_memory.content_version = Memory.content_version + 1
         
         if memory_type is not None:
             db_memory.memory_type = memory_type
         
-        db.commit()
-        db.refresh(db_memory)
+        if source_fingerprint is not None:
+            db_memory.source_fingerprint = source_fingerprint
+        
+        if in_batched_writes(db):
+            db.flush()
+        else:
+            db.commit()
+            db.refresh(db_memory)
+        # 内容を更新しなかった圧縮済みの記憶は展開してから返す
+        _load_cold_contents(db, [db_memory])
+        _on_memory_saved(db, db_memory)
         return db_memory
     except SQLAlchemyError as e:
         db.rollback()
@@ -120,8 +877,14 @@ def delete_memory(db: Session, memory_id: uuid.UUID):
         if db_memory is None:
             raise HTTPException(status_code=404, detail="記憶が見つかりません")
         
+        character_id, end_day = db_memory.character_id, db_memory.end_day
+        if db_memory.is_compressed:
+            db.query(MemoryColdContent).filter(MemoryColdContent.memory_id == memory_id).delete(
+                synchronize_session=False
+            )
         db.delete(db_memory)
-        db.commit()
+        commit_writes(db)
+        _on_memory_deleted(db, character_id, memory_id, end_day)
         return True
     except SQLAlchemyError as e:
         db.rollback()
@@ -3,6 +3,7 @@ from datetime import datetime
 from typing import Any, Dict, List, Optional
 
 from fastapi import HTTPException
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session
 
@@ -14,6 +15,12 @@ from app.core.constants import (
 )
 from app.models import Session as DbSession
 
+# ON CONFLICT DO NOTHING に対応した方言ごとの INSERT 文
+_UPSERT_INSERTS = {
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert,
+}
+
 
 def create_session(
     db: Session,
@@ -27,6 +34,10 @@ def create_session(
     新しいセッションを作成する。
     既にアクティブなセッションが存在する場合はエラーを返す。
 
+    キャラクターごとのアクティブなセッションの部分一意インデックスに対する
+    INSERT ... ON CONFLICT DO NOTHING RETURNING を1回実行するため、
+    複数のデバイスから同時に開始された場合も1つだけが作成される。
+
     Args:
         db: データベースセッション
         user_id: ユーザーID
@@ -44,34 +55,39 @@ def create_session(
     if session_type not in [SESSION_TYPE_CONVERSATION, SESSION_TYPE_SLEEP]:
         raise ValueError(f"無効なセッションタイプです: {session_type}")
 
+    dialect = db.get_bind().dialect.name
+    if dialect not in _UPSERT_INSERTS:
+        raise ValueError(f"セッションの作成に対応していないデータベースです: {dialect}")
+
     try:
-        # 既にアクティブなセッションが存在するか確認
-        existing_sessions = (
-            db.query(DbSession)
-            .filter(DbSession.character_id == character_id, DbSession.is_active)
-            .all()
+        # アクティブなセッションが既に存在する場合は何も挿入せず、行を返さない
+        statement = (
+            _UPSERT_INSERTS[dialect](DbSession)
+            .values(
+                user_id=user_id,
+                character_id=character_id,
+                device_id=device_id,
+                session_type=session_type,
+                is_active=True,
+                status=SESSION_STATUS_ACTIVE,
+                properties=properties or {},
+            )
+            .on_conflict_do_nothing(
+                index_elements=[DbSession.character_id],
+                index_where=DbSession.is_active,
+            )
+            .returning(DbSession)
         )
-
-        if existing_sessions:
+        db_session = db.scalars(statement).first()
+        if db_session is None:
+            db.rollback()
             raise HTTPException(
                 status_code=409,
                 detail=f"キャラクターID {character_id} には既にアクティブなセッションが存在します。"
                 f"新しいセッションを開始する前に、既存のセッションを終了してください。",
             )
 
-        # 新しいセッションを作成
-        db_session = DbSession(
-            user_id=user_id,
-            character_id=character_id,
-            device_id=device_id,
-            session_type=session_type,
-            is_active=True,
-            status=SESSION_STATUS_ACTIVE,
-            properties=properties or {},
-        )
-        db.add(db_session)
         db.commit()
-        db.refresh(db_session)
         return db_session
 
     except HTTPException:
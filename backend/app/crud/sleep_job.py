@@ -0,0 +1,374 @@
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from fastapi import HTTPException
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from app.core.constants import (
+    SLEEP_JOB_LEASE_SECONDS,
+    SLEEP_JOB_MAX_ATTEMPTS,
+    SLEEP_JOB_RETRY_DELAY,
+    SLEEP_JOB_STATUS_COMPLETED,
+    SLEEP_JOB_STATUS_DEAD,
+    SLEEP_JOB_STATUS_PENDING,
+    SLEEP_JOB_STATUS_RUNNING,
+)
+from app.models import SleepJob
+
+
+def enqueue_sleep_job(
+    db: Session,
+    character_id: uuid.UUID,
+    current_day: int,
+    max_attempts: int = SLEEP_JOB_MAX_ATTEMPTS,
+    run_after: Optional[datetime] = None,
+) -> SleepJob:
+    """
+    睡眠処理ジョブをキューに追加する
+
+    Args:
+        db: データベースセッション
+        character_id: キャラクターID
+        current_day: 処理する現在の日
+        max_attempts: 実行の最大試行回数
+        run_after: 実行を開始できる日時（Noneの場合は即時）
+
+    Returns:
+        作成されたジョブのインスタンス
+    """
+    if max_attempts <= 0:
+        raise HTTPException(
+            status_code=400, detail=f"無効な最大試行回数です: {max_attempts}"
+        )
+
+    try:
+        job = SleepJob(
+            character_id=character_id,
+            current_day=current_day,
+            status=SLEEP_JOB_STATUS_PENDING,
+            attempts=0,
+            max_attempts=max_attempts,
+            run_after=run_after or datetime.now(),
+        )
+        db.add(job)
+        db.commit()
+        db.refresh(job)
+        return job
+    except SQLAlchemyError as e:
+        db.rollback()
+        raise HTTPException(
+            status_code=500, detail=f"ジョブ作成中にエラーが発生しました: {str(e)}"
+        )
+
+
+def get_sleep_job(db: Session, job_id: uuid.UUID) -> Optional[SleepJob]:
+    """
+    ジョブIDに基づいてジョブを取得する
+
+    Args:
+        db: データベースセッション
+        job_id: ジョブID
+
+    Returns:
+        ジョブのインスタンス、見つからない場合はNone
+    """
+    return db.query(SleepJob).filter(SleepJob.id == job_id).first()
+
+
+def claim_sleep_jobs(
+    db: Session,
+    worker_id: str,
+    limit: int = 1,
+    lease_seconds: float = SLEEP_JOB_LEASE_SECONDS,
+    now: Optional[datetime] = None,
+) -> List[SleepJob]:
+    """
+    実行可能なジョブを取得し、ワーカーのリースを設定する
+
+    実行待ちのジョブと、リース期限を過ぎた実行中のジョブを対象とする。
+    PostgreSQLでは FOR UPDATE SKIP LOCKED で他のワーカーが取得中の行を飛ばし、
+    SQLiteなど行ロックのないデータベースでは状態を条件とした UPDATE の
+    更新件数で取得できたかを判定する。リース期限を過ぎたジョブが試行回数の
+    上限に達している場合は取得せずに破棄（dead）にする。
+
+    Args:
+        db: データベースセッション
+        worker_id: ワーカーID
+        limit: 取得するジョブの最大数
+        lease_seconds: リース期間（秒）
+        now: 現在日時（Noneの場合は datetime.now()）
+
+    Returns:
+        取得したジョブのリスト
+    """
+    now = now or datetime.now()
+    claimable = or_(
+        and_(
+            SleepJob.status == SLEEP_JOB_STATUS_PENDING,
+            SleepJob.run_after <= now,
+        ),
+        and_(
+            SleepJob.status == SLEEP_JOB_STATUS_RUNNING,
+            SleepJob.lease_expires_at < now,
+        ),
+    )
+
+    try:
+        query = (
+            db.query(SleepJob.id, SleepJob.attempts, SleepJob.max_attempts)
+            .filter(claimable)
+            .order_by(SleepJob.run_after, SleepJob.id)
+            .limit(limit)
+        )
+        if db.get_bind().dialect.name == "postgresql":
+            query = query.with_for_update(skip_locked=True)
+        candidates = query.all()
+
+        claimed_ids = []
+        for job_id, attempts, max_attempts in candidates:
+            if attempts >= max_attempts:
+                # リース期限切れで再試行の上限に達したジョブは破棄する
+                db.query(SleepJob).filter(SleepJob.id == job_id, claimable).update(
+                    {
+                        SleepJob.status: SLEEP_JOB_STATUS_DEAD,
+                        SleepJob.locked_by: None,
+                        SleepJob.lease_expires_at: None,
+                        SleepJob.last_error: "リース期限切れで試行回数の上限に達しました",
+                        SleepJob.updated_at: now,
+                    },
+                    synchronize_session=False,
+                )
+                continue
+
+            updated = (
+                db.query(SleepJob)
+                .filter(SleepJob.id == job_id, claimable)
+                .update(
+                    {
+                        SleepJob.status: SLEEP_JOB_STATUS_RUNNING,
+                        SleepJob.attempts: SleepJob.attempts + 1,
+                        SleepJob.locked_by: worker_id,
+                        SleepJob.lease_expires_at: now
+                        + timedelta(seconds=lease_seconds),
+                        SleepJob.heartbeat_at: now,
+                        SleepJob.updated_at: now,
+                    },
+                    synchronize_session=False,
+                )
+            )
+            if updated == 1:
+                claimed_ids.append(job_id)
+        db.commit()
+    except SQLAlchemyError as e:
+        db.rollback()
+        raise HTTPException(
+            status_code=500, detail=f"ジョブ取得中にエラーが発生しました: {str(e)}"
+        )
+
+    if not claimed_ids:
+        return []
+
+    jobs = {
+        job.id: job
+        for job in db.query(SleepJob)
+        .filter(SleepJob.id.in_(claimed_ids))
+        .populate_existing()
+    }
+    return [jobs[job_id] for job_id in claimed_ids]
+
+
+def _update_owned_job(
+    db: Session, job_id: uuid.UUID, worker_id: str, values: Dict[Any, Any]
+) -> bool:
+    """
+    ワーカーがリースを保持している実行中のジョブを更新する
+    """
+    try:
+        updated = (
+            db.query(SleepJob)
+            .filter(
+                SleepJob.id == job_id,
+                SleepJob.status == SLEEP_JOB_STATUS_RUNNING,
+                SleepJob.locked_by == worker_id,
+            )
+            .update(values, synchronize_session=False)
+        )
+        db.commit()
+        return updated == 1
+    except SQLAlchemyError as e:
+        db.rollback()
+        raise HTTPException(
+            status_code=500, detail=f"ジョブ更新中にエラーが発生しました: {str(e)}"
+        )
+
+
+def heartbeat_sleep_job(
+    db: Session,
+    job_id: uuid.UUID,
+    worker_id: str,
+    lease_seconds: float = SLEEP_JOB_LEASE_SECONDS,
+    now: Optional[datetime] = None,
+) -> bool:
+    """
+    実行中のジョブのリースを延長する
+
+    Args:
+        db: データベースセッション
+        job_id: ジョブID
+        worker_id: ワーカーID
+        lease_seconds: 延長後のリース期間（秒）
+        now: 現在日時（Noneの場合は datetime.now()）
+
+    Returns:
+        リースを延長できた場合はTrue、他のワーカーに取得されたなどで
+        リースを失っていた場合はFalse
+    """
+    now = now or datetime.now()
+    return _update_owned_job(
+        db,
+        job_id,
+        worker_id,
+        {
+            SleepJob.lease_expires_at: now + timedelta(seconds=lease_seconds),
+            SleepJob.heartbeat_at: now,
+        },
+    )
+
+
+def complete_sleep_job(
+    db: Session,
+    job_id: uuid.UUID,
+    worker_id: str,
+    result: Optional[Dict[str, Any]] = None,
+) -> bool:
+    """
+    ジョブを完了状態にする
+
+    Args:
+        db: データベースセッション
+        job_id: ジョブID
+        worker_id: ワーカーID
+        result: 処理結果の要約
+
+    Returns:
+        完了にできた場合はTrue、リースを失っていた場合はFalse
+    """
+    return _update_owned_job(
+        db,
+        job_id,
+        worker_id,
+        {
+            SleepJob.status: SLEEP_JOB_STATUS_COMPLETED,
+            SleepJob.locked_by: None,
+            SleepJob.lease_expires_at: None,
+            SleepJob.result: result or {},
+            SleepJob.updated_at: datetime.now(),
+        },
+    )
+
+
+def fail_sleep_job(
+    db: Session,
+    job_id: uuid.UUID,
+    worker_id: str,
+    error: str,
+    retry_delay: float = SLEEP_JOB_RETRY_DELAY,
+    now: Optional[datetime] = None,
+) -> Optional[str]:
+    """
+    ジョブの失敗を記録する
+
+    試行回数が上限未満の場合は retry_delay * 2 ** (試行回数 - 1) 秒後に
+    再実行できるよう実行待ちに戻し、上限に達した場合は破棄（dead）にする。
+
+    Args:
+        db: データベースセッション
+        job_id: ジョブID
+        worker_id: ワーカーID
+        error: エラーメッセージ
+        retry_delay: 再実行までの基本の待ち時間（秒）
+        now: 現在日時（Noneの場合は datetime.now()）
+
+    Returns:
+        更新後の状態（'pending' または 'dead'）、リースを失っていた場合はNone
+    """
+    now = now or datetime.now()
+    job = db.query(SleepJob).filter(SleepJob.id == job_id).populate_existing().first()
+    if job is None:
+        return None
+
+    if job.attempts >= job.max_attempts:
+        status = SLEEP_JOB_STATUS_DEAD
+        run_after = job.run_after
+    else:
+        status = SLEEP_JOB_STATUS_PENDING
+        run_after = now + timedelta(seconds=retry_delay * 2 ** (job.attempts - 1))
+
+    updated = _update_owned_job(
+        db,
+        job_id,
+        worker_id,
+        {
+            SleepJob.status: status,
+            SleepJob.run_after: run_after,
+            SleepJob.locked_by: None,
+            SleepJob.lease_expires_at: None,
+            SleepJob.last_error: error,
+            SleepJob.updated_at: now,
+        },
+    )
+    return status if updated else None
+
+
+def get_dead_sleep_jobs(db: Session, limit: int = 100) -> List[SleepJob]:
+    """
+    破棄（dead）されたジョブを取得する
+
+    Args:
+        db: データベースセッション
+        limit: 取得するレコードの最大数
+
+    Returns:
+        更新日時の降順に並んだジョブのリスト
+    """
+    return (
+        db.query(SleepJob)
+        .filter(SleepJob.status == SLEEP_JOB_STATUS_DEAD)
+        .order_by(SleepJob.updated_at.desc())
+        .limit(limit)
+        .all()
+    )
+
+
+def retry_dead_sleep_job(db: Session, job_id: uuid.UUID) -> SleepJob:
+    """
+    破棄（dead）されたジョブを試行回数をリセットして実行待ちに戻す
+
+    Args:
+        db: データベースセッション
+        job_id: ジョブID
+
+    Returns:
+        更新されたジョブのインスタンス
+
+    Raises:
+        HTTPException: ジョブが見つからないか、破棄されたジョブではない場合
+    """
+    job = get_sleep_job(db, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="ジョブが見つかりません")
+    if job.status != SLEEP_JOB_STATUS_DEAD:
+        raise HTTPException(
+            status_code=409, detail=f"ジョブ {job_id} は破棄されたジョブではありません"
+        )
+
+    job.status = SLEEP_JOB_STATUS_PENDING
+    job.attempts = 0
+    job.run_after = datetime.now()
+    job.updated_at = datetime.now()
+    db.commit()
+    db.refresh(job)
+    return job
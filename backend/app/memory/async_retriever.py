@@ -0,0 +1,167 @@
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.memory.cache import MemoryContextCache
+from app.memory.retriever import (
+    MemoryRetriever,
+    get_memories_for_sessions,
+    get_memory_context,
+)
+from app.models import Memory
+
+
+class AsyncMemoryRetriever:
+    """非同期記憶取得エンジン
+
+    MemoryRetriever の処理を AsyncSession.run_sync 経由で実行し、
+    イベントループをブロックせずに記憶を取得する。
+    """
+
+    def __init__(self, db: AsyncSession, retriever: MemoryRetriever):
+        """
+        非同期記憶取得エンジンの初期化
+
+        通常は create() を使用してインスタンスを作成する。
+
+        Args:
+            db: 非同期データベースセッション
+            retriever: db.sync_session に紐付いた同期版の記憶取得エンジン
+        """
+        self.db = db
+        self.retriever = retriever
+        self.character_id = retriever.character_id
+        self.user_id = retriever.user_id
+
+    @classmethod
+    async def create(
+        cls, db: AsyncSession, character_id: uuid.UUID
+    ) -> "AsyncMemoryRetriever":
+        """
+        非同期記憶取得エンジンを作成する
+
+        Args:
+            db: 非同期データベースセッション
+            character_id: キャラクターID
+
+        Returns:
+            非同期記憶取得エンジン
+
+        Raises:
+            ValueError: キャラクターが見つからない場合
+        """
+        retriever = await db.run_sync(MemoryRetriever, character_id)
+        return cls(db, retriever)
+
+    async def get_memories_for_session(
+        self, current_day: int, single_query: bool = True
+    ) -> Dict[str, List[Memory]]:
+        """
+        会話セッションに必要な記憶を階層パターンに従って取得する
+
+        Args:
+            current_day: 現在の日
+            single_query: 全階層の候補を1回のクエリで取得するかどうか
+
+        Returns:
+            階層別の記憶のディクショナリ
+        """
+        return await self.db.run_sync(
+            lambda _: self.retriever.get_memories_for_session(current_day, single_query)
+        )
+
+    async def get_memories_for_system_prompt(
+        self, current_day: int
+    ) -> List[Tuple[str, Memory]]:
+        """
+        システムプロンプト用に整理された記憶のリストを取得する
+
+        Args:
+            current_day: 現在の日
+
+        Returns:
+            (記憶タイプのラベル, 記憶オブジェクト)のタプルのリスト
+        """
+        return await self.db.run_sync(
+            lambda _: self.retriever.get_memories_for_system_prompt(current_day)
+        )
+
+    async def format_memories_for_prompt(self, current_day: int) -> str:
+        """
+        システムプロンプト用に記憶を整形する
+
+        Args:
+            current_day: 現在の日
+
+        Returns:
+            プロンプト用に整形された記憶テキスト
+        """
+        return await self.db.run_sync(
+            lambda _: self.retriever.format_memories_for_prompt(current_day)
+        )
+
+    async def format_memories_with_budget(
+        self,
+        current_day: int,
+        model: Optional[str] = None,
+        token_budget: Optional[int] = None,
+        deferred_content: bool = False,
+    ) -> Dict[str, Any]:
+        """
+        トークン予算内に収まるように記憶を選択して整形する
+
+        Args:
+            current_day: 現在の日
+            model: 使用するLLMモデル（予算の決定に使用）
+            token_budget: トークン予算（指定した場合はモデルの予算より優先）
+            deferred_content: 記憶内容の取得を選択後まで遅延するかどうか
+
+        Returns:
+            整形されたテキスト、予算、使用トークン数、除外された記憶の情報
+        """
+        return await self.db.run_sync(
+            lambda _: self.retriever.format_memories_with_budget(
+                current_day,
+                model=model,
+                token_budget=token_budget,
+                deferred_content=deferred_content,
+            )
+        )
+
+
+async def get_memory_context_async(
+    db: AsyncSession,
+    character_id: uuid.UUID,
+    current_day: int,
+    cache: Optional[MemoryContextCache] = None,
+) -> Tuple[Dict[str, List[Memory]], str]:
+    """
+    キャッシュを利用して会話用の記憶コンテキストを非同期で取得する
+
+    Args:
+        db: 非同期データベースセッション
+        character_id: キャラクターID
+        current_day: 現在の日
+        cache: 使用するキャッシュ（Noneの場合は共有キャッシュ）
+
+    Returns:
+        (階層別の記憶のディクショナリ, プロンプト用に整形された記憶テキスト)
+    """
+    return await db.run_sync(get_memory_context, character_id, current_day, cache)
+
+
+async def get_memories_for_sessions_async(
+    db: AsyncSession, targets: List[Tuple[uuid.UUID, int]]
+) -> Dict[Tuple[uuid.UUID, int], Dict[str, List[Memory]]]:
+    """
+    複数キャラクターの会話セッション用の記憶を非同期で一括取得する
+
+    Args:
+        db: 非同期データベースセッション
+        targets: (キャラクターID, 現在の日)のリスト
+
+    Returns:
+        (キャラクターID, 現在の日)ごとの階層別の記憶のディクショナリ
+    """
+    return await db.run_sync(get_memories_for_sessions, targets)
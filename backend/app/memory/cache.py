@@ -0,0 +1,220 @@
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+from app.models import Memory
+
+# キャッシュに保持する(キャラクター, 日)の最大エントリ数
+DEFAULT_CACHE_SIZE = 1024
+
+
+def _snapshot(memory: Memory) -> Memory:
+    """
+    セッションに紐付かない記憶のコピーを作成する
+
+    キャッシュ上の記憶はコミットによる失効や遅延ロードでDBにアクセスしないよう、
+    カラム値をコピーした独立したインスタンスとして保持する。
+
+    Args:
+        memory: コピー元の記憶
+
+    Returns:
+        カラム値をコピーした記憶インスタンス
+    """
+    return Memory(
+        **{
+            column.key: getattr(memory, column.key)
+            for column in Memory.__table__.columns
+        }
+    )
+
+
+class MemoryContextCache:
+    """記憶コンテキストキャッシュ
+
+    (キャラクターID, 現在の日)ごとに階層別の記憶と整形済みプロンプトテキストを
+    LRU方式で保持する。記憶の追加・更新・削除時に該当キャラクターのエントリを無効化する。
+
+    キャッシュはプロセスごとに保持し、無効化は同じプロセス内のCRUD関数による
+    書き込みでのみ行われる。他のプロセス（睡眠処理ワーカーなど）や直接のSQLによる
+    書き込みは検知しないため、それらが記憶を書き込む構成では該当キャラクターの
+    invalidate を呼び出すか、キャッシュを使用しない get_memories_for_session を使う。
+
+    無効化のたびにキャラクターの世代番号を進める。DBから読み込む前に generation で
+    世代番号を取得して put に渡すと、読み込み中に無効化された古い内容は保存されない。
+    """
+
+    def __init__(self, max_size: int = DEFAULT_CACHE_SIZE):
+        """
+        記憶コンテキストキャッシュの初期化
+
+        Args:
+            max_size: 保持する最大エントリ数
+        """
+        if max_size < 1:
+            raise ValueError(f"無効なキャッシュサイズです: {max_size}")
+        self.max_size = max_size
+        self._entries: OrderedDict = OrderedDict()
+        self._days_by_character: Dict[uuid.UUID, Set[int]] = {}
+        self._generations: Dict[uuid.UUID, int] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(
+        self, character_id: uuid.UUID, current_day: int
+    ) -> Optional[Tuple[Dict[str, List[Memory]], str]]:
+        """
+        キャッシュされた記憶コンテキストを取得する
+
+        Args:
+            character_id: キャラクターID
+            current_day: 現在の日
+
+        Returns:
+            (階層別の記憶のディクショナリ, 整形済みテキスト)、存在しない場合はNone
+        """
+        key = (character_id, current_day)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            memories, text = entry
+            return {
+                memory_type: list(items) for memory_type, items in memories.items()
+            }, text
+
+    def generation(self, character_id: uuid.UUID) -> int:
+        """
+        キャラクターの現在の世代番号を取得する
+
+        Args:
+            character_id: キャラクターID
+
+        Returns:
+            invalidate のたびに増加する世代番号
+        """
+        with self._lock:
+            return self._generations.get(character_id, 0)
+
+    def put(
+        self,
+        character_id: uuid.UUID,
+        current_day: int,
+        memories: Dict[str, List[Memory]],
+        text: str,
+        generation: Optional[int] = None,
+    ) -> bool:
+        """
+        記憶コンテキストをキャッシュに保存する
+
+        Args:
+            character_id: キャラクターID
+            current_day: 現在の日
+            memories: 階層別の記憶のディクショナリ
+            text: 整形済みプロンプトテキスト
+            generation: DBから読み込む前に取得した世代番号（Noneの場合は確認しない）
+
+        Returns:
+            保存した場合はTrue、読み込み後に無効化されていたため保存しなかった場合はFalse
+        """
+        key = (character_id, current_day)
+        snapshot = {
+            memory_type: [_snapshot(memory) for memory in items]
+            for memory_type, items in memories.items()
+        }
+        with self._lock:
+            if (
+                generation is not None
+                and self._generations.get(character_id, 0) != generation
+            ):
+                return False
+
+            self._entries[key] = (snapshot, text)
+            self._entries.move_to_end(key)
+            self._days_by_character.setdefault(character_id, set()).add(current_day)
+
+            while len(self._entries) > self.max_size:
+                (old_character_id, old_day), _ = self._entries.popitem(last=False)
+                self._discard_day(old_character_id, old_day)
+                self.evictions += 1
+            return True
+
+    def invalidate(
+        self, character_id: uuid.UUID, from_day: Optional[int] = None
+    ) -> int:
+        """
+        キャラクターのキャッシュエントリを無効化する
+
+        記憶は終了日が現在の日以前の場合にのみコンテキストに含まれるため、
+        from_dayを指定した場合はその日以降のエントリだけを無効化する。
+
+        Args:
+            character_id: キャラクターID
+            from_day: 無効化する最初の日（Noneの場合はすべて）
+
+        Returns:
+            無効化したエントリの数
+        """
+        with self._lock:
+            self._generations[character_id] = self._generations.get(character_id, 0) + 1
+            days = self._days_by_character.get(character_id)
+            if not days:
+                return 0
+
+            targets = [day for day in days if from_day is None or day >= from_day]
+            for day in targets:
+                del self._entries[(character_id, day)]
+                self._discard_day(character_id, day)
+
+            self.invalidations += len(targets)
+            return len(targets)
+
+    def clear(self) -> None:
+        """
+        すべてのエントリと統計情報を削除する
+
+        世代番号は読み込み中の呼び出し元が古い内容を保存しないよう保持する。
+        """
+        with self._lock:
+            self._entries.clear()
+            self._days_by_character.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.invalidations = 0
+
+    def stats(self) -> Dict[str, int]:
+        """
+        キャッシュの統計情報を取得する
+
+        Returns:
+            ヒット数・ミス数・追い出し数・無効化数・現在のサイズ
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "size": len(self._entries),
+                "max_size": self.max_size,
+            }
+
+    def _discard_day(self, character_id: uuid.UUID, day: int) -> None:
+        days = self._days_by_character.get(character_id)
+        if days is None:
+            return
+        days.discard(day)
+        if not days:
+            del self._days_by_character[character_id]
+
+
+# アプリケーション全体で共有する記憶コンテキストキャッシュ
+memory_context_cache = MemoryContextCache()
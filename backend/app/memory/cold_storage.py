@@ -0,0 +1,104 @@
+"""
+古いdaily_raw記憶の圧縮ジョブ
+
+daily_summaryの作成後にほとんど読まれない古いdaily_raw記憶の内容を
+memory_cold_contents にzlibで圧縮して移し、memories テーブルを小さく保つ。
+圧縮した記憶は取得時に展開されるため、呼び出し側の変更は不要。
+
+    python -m app.memory.cold_storage --min-age-days 30
+"""
+
+import argparse
+from typing import Dict, List, Optional
+
+from sqlalchemy.orm import sessionmaker
+
+from app.core.constants import COLD_STORAGE_BATCH_SIZE, COLD_STORAGE_MIN_AGE_DAYS
+from app.core.database import SessionLocal
+from app.crud import memory as memory_crud
+
+
+def run_cold_storage_job(
+    session_factory: sessionmaker = SessionLocal,
+    min_age_days: float = COLD_STORAGE_MIN_AGE_DAYS,
+    batch_size: int = COLD_STORAGE_BATCH_SIZE,
+    max_batches: Optional[int] = None,
+) -> Dict[str, int]:
+    """
+    対象の記憶がなくなるまでバッチ単位で圧縮する
+
+    Args:
+        session_factory: データベースセッションを作成するファクトリ
+        min_age_days: 対象とする記憶の作成からの日数
+        batch_size: 1回のトランザクションで圧縮する記憶の数
+        max_batches: 実行するバッチの最大数（Noneの場合は無制限）
+
+    Returns:
+        今回圧縮した記憶の数と、圧縮前後および削減したバイト数
+    """
+    if batch_size <= 0:
+        raise ValueError(f"無効なバッチサイズです: {batch_size}")
+
+    total = {
+        "compressed_count": 0,
+        "original_bytes": 0,
+        "compressed_bytes": 0,
+        "bytes_reclaimed": 0,
+    }
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        db = session_factory()
+        try:
+            report = memory_crud.compress_old_daily_raw(
+                db, min_age_days=min_age_days, limit=batch_size
+            )
+        finally:
+            db.close()
+
+        for key, value in report.items():
+            total[key] += value
+        batches += 1
+        if report["compressed_count"] < batch_size:
+            break
+
+    return total
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="古いdaily_raw記憶の圧縮ジョブ")
+    parser.add_argument(
+        "--min-age-days",
+        type=float,
+        default=COLD_STORAGE_MIN_AGE_DAYS,
+        help="作成からこの日数を過ぎた記憶を圧縮する",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=COLD_STORAGE_BATCH_SIZE,
+        help="1回のトランザクションで圧縮する記憶の数",
+    )
+    args = parser.parse_args(argv)
+
+    report = run_cold_storage_job(
+        min_age_days=args.min_age_days, batch_size=args.batch_size
+    )
+    print(
+        f"{report['compressed_count']}件の記憶を圧縮しました: "
+        f"{report['original_bytes']} → {report['compressed_bytes']} バイト "
+        f"（{report['bytes_reclaimed']} バイト削減）"
+    )
+
+    db = SessionLocal()
+    try:
+        stats = memory_crud.get_cold_storage_stats(db)
+    finally:
+        db.close()
+    print(
+        f"圧縮済みの記憶: {stats['compressed_count']}件、"
+        f"合計 {stats['bytes_reclaimed']} バイト削減"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,650 @@
+"""
+記憶の埋め込みベクトルストア
+
+記憶内容を埋め込みベクトルに変換し、キャラクターごとのfloat32行列として保持する。
+類似度検索はNumPyの行列演算1回で行い、件数が多いキャラクターでは
+IVF（転置ファイル）方式で探索範囲を絞る。
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from app.memory.search import tokenize
+
+logger = logging.getLogger(__name__)
+
+# ハッシュ埋め込みのデフォルト次元数
+DEFAULT_EMBEDDING_DIMENSION = 256
+
+# LiteLLM経由の埋め込みで1回のリクエストに含める最大テキスト数
+EMBEDDING_BATCH_SIZE = 100
+
+# メモリ上に保持するキャラクターのベクトルストアの最大数
+DEFAULT_MAX_CHARACTERS = 256
+
+# IVFインデックスを構築するベクトル数の閾値と探索するクラスタ数
+IVF_THRESHOLD = 20000
+IVF_NPROBE = 8
+
+# IVFのクラスタ中心の学習に使う最大サンプル数（クラスタ数あたり）
+IVF_TRAINING_SAMPLES_PER_LIST = 50
+IVF_TRAINING_ITERATIONS = 10
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    """
+    ベクトルをL2正規化する（ゼロベクトルはそのまま）
+    """
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32, copy=False)
+
+
+@lru_cache(maxsize=65536)
+def _token_hash(token: str) -> int:
+    """
+    トークンのプロセス間で安定した64bitハッシュ値を計算する
+    """
+    digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+class EmbeddingProvider:
+    """埋め込みプロバイダーの基底クラス"""
+
+    dimension: int
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """
+        テキストを埋め込みベクトルに変換する
+
+        Args:
+            texts: テキストのリスト
+
+        Returns:
+            L2正規化された (len(texts), dimension) のfloat32行列
+        """
+        raise NotImplementedError
+
+
+class HashingEmbeddingProvider(EmbeddingProvider):
+    """ハッシュ埋め込みプロバイダー
+
+    全文検索と同じトークンを符号付きの特徴ハッシュで固定次元に射影する。
+    外部サービスを使わず決定的なため、オフライン環境やテストで使用する。
+    """
+
+    def __init__(self, dimension: int = DEFAULT_EMBEDDING_DIMENSION):
+        self.dimension = dimension
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for token in tokenize(text):
+                value = _token_hash(token)
+                vectors[row, value % self.dimension] += 1.0 if value >> 63 else -1.0
+        return _normalize(vectors)
+
+
+class LiteLLMEmbeddingProvider(EmbeddingProvider):
+    """LiteLLM経由の埋め込みプロバイダー
+
+    プロバイダーの1リクエストあたりの上限を超えないよう、テキストを
+    batch_size 件ずつに分けてリクエストする。
+    """
+
+    def __init__(
+        self,
+        model: str = "gemini/text-embedding-004",
+        dimension: int = 768,
+        batch_size: int = EMBEDDING_BATCH_SIZE,
+    ):
+        if batch_size < 1:
+            raise ValueError(f"無効なバッチサイズです: {batch_size}")
+        self.model = model
+        self.dimension = dimension
+        self.batch_size = batch_size
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, self.dimension), dtype=np.float32)
+
+        from litellm import embedding
+
+        vectors = []
+        for offset in range(0, len(texts), self.batch_size):
+            response = embedding(
+                model=self.model, input=texts[offset : offset + self.batch_size]
+            )
+            vectors.extend(item["embedding"] for item in response.data)
+        return _normalize(np.asarray(vectors, dtype=np.float32))
+
+
+class CharacterVectorStore:
+    """キャラクター単位のベクトルストア
+
+    記憶IDと正規化済みベクトルの行列を保持する。行列は容量を倍々に拡張し、
+    削除は末尾の行との入れ替えで行う。
+    """
+
+    def __init__(
+        self,
+        dimension: int,
+        ivf_threshold: int = IVF_THRESHOLD,
+        nprobe: int = IVF_NPROBE,
+    ):
+        self.dimension = dimension
+        self.ivf_threshold = ivf_threshold
+        self.nprobe = nprobe
+        self.ids: List[str] = []
+        self.rows: Dict[str, int] = {}
+        self.matrix = np.zeros((0, dimension), dtype=np.float32)
+        self._centroids: Optional[np.ndarray] = None
+        self._assignments = np.zeros(0, dtype=np.int32)
+        self._trained_size = 0
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, doc_ids: List[str], vectors: np.ndarray) -> None:
+        """
+        ベクトルを追加する（既存の記憶IDは置き換える）
+
+        Args:
+            doc_ids: 記憶IDのリスト
+            vectors: 正規化済みの (len(doc_ids), dimension) 行列
+        """
+        self._ensure_writable()
+        for doc_id, vector in zip(doc_ids, vectors):
+            row = self.rows.get(doc_id)
+            if row is None:
+                row = len(self.ids)
+                self._ensure_capacity(row + 1)
+                self.ids.append(doc_id)
+                self.rows[doc_id] = row
+            self.matrix[row] = vector
+            if self._centroids is not None:
+                self._assignments[row] = int(np.argmax(self._centroids @ vector))
+
+    def remove(self, doc_id: str) -> bool:
+        """
+        ベクトルを削除する
+
+        Args:
+            doc_id: 記憶ID
+
+        Returns:
+            削除したかどうか
+        """
+        row = self.rows.pop(doc_id, None)
+        if row is None:
+            return False
+
+        self._ensure_writable()
+        last = len(self.ids) - 1
+        last_id = self.ids.pop()
+        if row != last:
+            self.ids[row] = last_id
+            self.rows[last_id] = row
+            self.matrix[row] = self.matrix[last]
+            if self._centroids is not None:
+                self._assignments[row] = self._assignments[last]
+        return True
+
+    def search(self, query: np.ndarray, top_k: int = 10) -> List[Tuple[str, float]]:
+        """
+        コサイン類似度の高いベクトルを検索する
+
+        Args:
+            query: 正規化済みのクエリベクトル
+            top_k: 取得する件数
+
+        Returns:
+            類似度の高い順の(記憶ID, 類似度)のリスト
+        """
+        size = len(self.ids)
+        if size == 0 or top_k <= 0:
+            return []
+
+        candidates = None
+        if size >= self.ivf_threshold:
+            self._maybe_train()
+            nearest = np.argsort(self._centroids @ query)[::-1][: self.nprobe]
+            candidates = np.flatnonzero(np.isin(self._assignments[:size], nearest))
+
+        if candidates is None:
+            scores = self.matrix[:size] @ query
+        else:
+            scores = self.matrix[candidates] @ query
+
+        k = min(top_k, len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        rows = top if candidates is None else candidates[top]
+        return [(self.ids[row], float(score)) for row, score in zip(rows, scores[top])]
+
+    def _ensure_capacity(self, size: int) -> None:
+        capacity = self.matrix.shape[0]
+        if size <= capacity and self.matrix.flags.writeable:
+            return
+
+        new_capacity = max(size, capacity * 2, 64)
+        matrix = np.zeros((new_capacity, self.dimension), dtype=np.float32)
+        matrix[: len(self.ids)] = self.matrix[: len(self.ids)]
+        self.matrix = matrix
+
+        assignments = np.zeros(new_capacity, dtype=np.int32)
+        assignments[: len(self.ids)] = self._assignments[: len(self.ids)]
+        self._assignments = assignments
+
+    def _ensure_writable(self) -> None:
+        if not self.matrix.flags.writeable:
+            self.matrix = np.array(self.matrix)
+
+    def _maybe_train(self) -> None:
+        """
+        IVFのクラスタ中心を学習する
+
+        件数が前回の学習時から1.5倍を超えて増えた場合に学習し直す。
+        """
+        size = len(self.ids)
+        if self._centroids is not None and size <= self._trained_size * 1.5:
+            return
+
+        vectors = self.matrix[:size]
+        nlist = max(1, int(np.sqrt(size)))
+        rng = np.random.default_rng(0)
+        sample_size = min(size, nlist * IVF_TRAINING_SAMPLES_PER_LIST)
+        sample = vectors[rng.choice(size, sample_size, replace=False)]
+        centroids = sample[rng.choice(sample_size, nlist, replace=False)]
+
+        # 球面k-means（内積最大のクラスタに割り当て、平均を正規化）
+        for _ in range(IVF_TRAINING_ITERATIONS):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            empty = ~sums.any(axis=1)
+            sums[empty] = centroids[empty]
+            centroids = _normalize(sums)
+
+        self._centroids = centroids
+        self._ensure_capacity(size)
+        self._assignments[:size] = np.argmax(vectors @ centroids.T, axis=1)
+        self._trained_size = size
+
+    def similarity(self, query: np.ndarray, doc_ids: List[str]) -> np.ndarray:
+        """
+        指定した記憶とクエリのコサイン類似度を計算する
+
+        Args:
+            query: 正規化済みのクエリベクトル
+            doc_ids: 記憶IDのリスト
+
+        Returns:
+            doc_idsと同じ順序の類似度の配列（未登録の記憶は0）
+        """
+        rows = np.fromiter(
+            (self.rows.get(doc_id, -1) for doc_id in doc_ids),
+            dtype=np.intp,
+            count=len(doc_ids),
+        )
+        scores = np.zeros(len(doc_ids), dtype=np.float32)
+        known = rows >= 0
+        scores[known] = self.matrix[rows[known]] @ query
+        return scores
+
+    def save(self, path_prefix: str, watermark: Optional[str] = None) -> None:
+        """
+        ベクトル行列（.npy）と記憶ID・保存時点の記憶の状態（.ids.json）を保存する
+        """
+        np.save(
+            f"{path_prefix}.npy", np.ascontiguousarray(self.matrix[: len(self.ids)])
+        )
+        with open(f"{path_prefix}.ids.json", "w", encoding="utf-8") as f:
+            json.dump({"watermark": watermark, "ids": self.ids}, f)
+
+    @classmethod
+    def load(
+        cls, path_prefix: str, **kwargs
+    ) -> Tuple["CharacterVectorStore", Optional[str]]:
+        """
+        保存されたベクトルストアをメモリマップで読み込む
+
+        行列は更新されるまでディスク上のファイルを直接参照する。
+
+        Returns:
+            (ベクトルストア, 保存時点の記憶の状態)
+        """
+        with open(f"{path_prefix}.ids.json", encoding="utf-8") as f:
+            data = json.load(f)
+        ids = data["ids"]
+        # 空の行列はメモリマップできないため通常の読み込みを行う
+        matrix = np.load(f"{path_prefix}.npy", mmap_mode="r" if ids else None)
+
+        store = cls(matrix.shape[1], **kwargs)
+        store.matrix = matrix
+        store.ids = ids
+        store.rows = {doc_id: row for row, doc_id in enumerate(ids)}
+        store._assignments = np.zeros(len(ids), dtype=np.int32)
+        return store, data["watermark"]
+
+
+class MemoryEmbeddingStore:
+    """記憶の埋め込みベクトルストア
+
+    キャラクターごとのベクトルストアを保持する。
+    読み込まれていないキャラクターの更新は無視し、最初の検索時にDBから構築する。
+    記憶の追加・更新は埋め込みを計算せずにキューに追加し、次の検索時
+    （または flush_pending の呼び出し時）にまとめて埋め込む。
+    保持するキャラクター数が max_characters を超えた場合は最も長く検索されていない
+    キャラクターのベクトルストアから破棄する（次の検索時にDBから構築し直す）。
+    """
+
+    def __init__(
+        self,
+        provider: Optional[EmbeddingProvider] = None,
+        ivf_threshold: int = IVF_THRESHOLD,
+        max_characters: int = DEFAULT_MAX_CHARACTERS,
+    ):
+        """
+        埋め込みベクトルストアの初期化
+
+        Args:
+            provider: 埋め込みプロバイダー（Noneの場合はハッシュ埋め込み）
+            ivf_threshold: IVFインデックスを構築するベクトル数の閾値
+            max_characters: メモリ上に保持するキャラクターのベクトルストアの最大数
+        """
+        if max_characters < 1:
+            raise ValueError(f"無効なキャラクター数です: {max_characters}")
+        self.provider = provider or HashingEmbeddingProvider()
+        self.ivf_threshold = ivf_threshold
+        self.max_characters = max_characters
+        self._characters: OrderedDict = OrderedDict()
+        # 埋め込みを計算していない記憶（キャラクターID -> 記憶ID -> 記憶内容）
+        self._pending: Dict[uuid.UUID, Dict[str, str]] = {}
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def has_character(self, character_id: uuid.UUID) -> bool:
+        """
+        キャラクターのベクトルストアが読み込まれているかどうかを判定する
+        """
+        return character_id in self._characters
+
+    def build_character(
+        self, character_id: uuid.UUID, documents: Iterable[Tuple[uuid.UUID, str]]
+    ) -> None:
+        """
+        キャラクターのベクトルストアを構築する（既存の場合は置き換える）
+
+        Args:
+            character_id: キャラクターID
+            documents: (記憶ID, 記憶内容)のリスト
+        """
+        documents = list(documents)
+        store = self._new_store()
+        if documents:
+            store.add(
+                [str(memory_id) for memory_id, _ in documents],
+                self.provider.embed([content for _, content in documents]),
+            )
+        with self._lock:
+            self._put(character_id, store)
+
+    def add_memory(
+        self, character_id: uuid.UUID, memory_id: uuid.UUID, content: str
+    ) -> None:
+        """
+        記憶の追加または更新をキューに追加する（埋め込みは次の検索時に計算する）
+
+        Args:
+            character_id: キャラクターID
+            memory_id: 記憶ID
+            content: 記憶内容
+        """
+        with self._lock:
+            if character_id in self._characters:
+                self._pending.setdefault(character_id, {})[str(memory_id)] = content
+
+    def pending_count(self, character_id: uuid.UUID) -> int:
+        """
+        埋め込みを計算していない記憶の数を返す
+        """
+        with self._lock:
+            return len(self._pending.get(character_id, {}))
+
+    def flush_pending(self, character_id: uuid.UUID) -> int:
+        """
+        キューに追加された記憶の埋め込みをまとめて計算してストアに反映する
+
+        埋め込みの計算はロックの外で行う。計算中に削除または再度更新された記憶は
+        反映しない。計算に失敗した場合はログに記録し、記憶をキューに残す。
+
+        Args:
+            character_id: キャラクターID
+
+        Returns:
+            反映した記憶の数
+        """
+        with self._lock:
+            items = list(self._pending.get(character_id, {}).items())
+        if not items:
+            return 0
+
+        try:
+            vectors = self.provider.embed([content for _, content in items])
+        except Exception:
+            logger.exception(
+                "キャラクター %s の記憶 %d 件の埋め込みに失敗しました",
+                character_id,
+                len(items),
+            )
+            return 0
+
+        with self._lock:
+            pending = self._pending.get(character_id, {})
+            rows = [
+                row
+                for row, (doc_id, content) in enumerate(items)
+                if pending.get(doc_id) is content
+            ]
+            for row in rows:
+                del pending[items[row][0]]
+            if not pending:
+                self._pending.pop(character_id, None)
+
+            store = self._characters.get(character_id)
+            if store is None or not rows:
+                return 0
+            store.add([items[row][0] for row in rows], vectors[rows])
+        return len(rows)
+
+    def remove_memory(self, character_id: uuid.UUID, memory_id: uuid.UUID) -> None:
+        """
+        記憶を削除する
+
+        Args:
+            character_id: キャラクターID
+            memory_id: 記憶ID
+        """
+        with self._lock:
+            self._pending.get(character_id, {}).pop(str(memory_id), None)
+            store = self._characters.get(character_id)
+            if store is not None:
+                store.remove(str(memory_id))
+
+    def drop_character(self, character_id: uuid.UUID) -> None:
+        """
+        キャラクターのベクトルストアを破棄する
+        """
+        with self._lock:
+            self._characters.pop(character_id, None)
+            self._pending.pop(character_id, None)
+
+    def search(
+        self, character_id: uuid.UUID, query: str, top_k: int = 10
+    ) -> List[Tuple[uuid.UUID, float]]:
+        """
+        クエリに意味的に近い記憶を検索する
+
+        Args:
+            character_id: キャラクターID
+            query: 検索クエリ
+            top_k: 取得する件数
+
+        Returns:
+            類似度の高い順の(記憶ID, コサイン類似度)のリスト
+        """
+        if not self.has_character(character_id):
+            return []
+
+        self.flush_pending(character_id)
+        query_vector = self.provider.embed([query])[0]
+        with self._lock:
+            store = self._characters.get(character_id)
+            if store is None:
+                return []
+            self._characters.move_to_end(character_id)
+            results = store.search(query_vector, top_k)
+        return [(uuid.UUID(doc_id), score) for doc_id, score in results]
+
+    def similarity(
+        self, character_id: uuid.UUID, query: str, memory_ids: List[uuid.UUID]
+    ) -> np.ndarray:
+        """
+        指定した記憶とクエリのコサイン類似度を計算する
+
+        Args:
+            character_id: キャラクターID
+            query: クエリ（ユーザーのメッセージなど）
+            memory_ids: 記憶IDのリスト
+
+        Returns:
+            memory_idsと同じ順序の類似度の配列
+        """
+        if not self.has_character(character_id):
+            return np.zeros(len(memory_ids), dtype=np.float32)
+
+        self.flush_pending(character_id)
+        query_vector = self.provider.embed([query])[0]
+        with self._lock:
+            store = self._characters.get(character_id)
+            if store is None:
+                return np.zeros(len(memory_ids), dtype=np.float32)
+            self._characters.move_to_end(character_id)
+            return store.similarity(
+                query_vector, [str(memory_id) for memory_id in memory_ids]
+            )
+
+    def save(
+        self, directory: str, watermarks: Optional[Dict[uuid.UUID, str]] = None
+    ) -> int:
+        """
+        ベクトルストアをキャラクターごとのファイルとして保存する
+
+        Args:
+            directory: 保存先ディレクトリ
+            watermarks: キャラクターごとの保存時点の記憶の状態
+                （memory_crud.get_memory_watermarks の値、読み込み時の検証に使用する）
+
+        Returns:
+            保存したキャラクター数
+        """
+        os.makedirs(directory, exist_ok=True)
+        watermarks = watermarks or {}
+        with self._lock:
+            character_ids = list(self._characters)
+        for character_id in character_ids:
+            self.flush_pending(character_id)
+        with self._lock:
+            for character_id, store in self._characters.items():
+                store.save(
+                    os.path.join(directory, str(character_id)),
+                    watermarks.get(character_id),
+                )
+            return len(self._characters)
+
+    def load(
+        self,
+        directory: str,
+        character_id: Optional[uuid.UUID] = None,
+        watermarks: Optional[Dict[uuid.UUID, str]] = None,
+    ) -> int:
+        """
+        保存されたベクトルストアをメモリマップで読み込む
+
+        watermarks を指定した場合は、保存時の記憶の状態が一致するキャラクターのみを
+        読み込む。一致しないキャラクター（保存後に記憶が追加・更新・削除された場合など）は
+        読み込まず、次の検索時にDBから構築し直す。
+
+        Args:
+            directory: 保存先ディレクトリ
+            character_id: 読み込むキャラクターID（Noneの場合はすべて）
+            watermarks: キャラクターごとの現在の記憶の状態
+                （memory_crud.get_memory_watermarks の値、Noneの場合は検証しない）
+
+        Returns:
+            読み込んだキャラクター数
+        """
+        if not os.path.isdir(directory):
+            return 0
+
+        if character_id is not None:
+            names = [str(character_id)]
+        else:
+            names = [
+                name[: -len(".npy")]
+                for name in os.listdir(directory)
+                if name.endswith(".npy")
+            ]
+
+        loaded = 0
+        for name in names:
+            path_prefix = os.path.join(directory, name)
+            if not os.path.exists(f"{path_prefix}.npy"):
+                continue
+            loaded_id = uuid.UUID(name)
+            store, watermark = CharacterVectorStore.load(
+                path_prefix, ivf_threshold=self.ivf_threshold
+            )
+            if watermarks is not None and (
+                watermark is None or watermark != watermarks.get(loaded_id)
+            ):
+                continue
+            with self._lock:
+                self._put(loaded_id, store)
+            loaded += 1
+
+        return loaded
+
+    def _put(self, character_id: uuid.UUID, store: CharacterVectorStore) -> None:
+        """
+        キャラクターのベクトルストアを登録する（ロックを保持した状態で呼び出す）
+        """
+        self._characters[character_id] = store
+        self._characters.move_to_end(character_id)
+        self._pending.pop(character_id, None)
+        while len(self._characters) > self.max_characters:
+            evicted_id, _ = self._characters.popitem(last=False)
+            self._pending.pop(evicted_id, None)
+            self.evictions += 1
+
+    def _new_store(self) -> CharacterVectorStore:
+        return CharacterVectorStore(
+            self.provider.dimension, ivf_threshold=self.ivf_threshold
+        )
+
+
+# アプリケーション全体で共有する埋め込みベクトルストア
+memory_embedding_store = MemoryEmbeddingStore()
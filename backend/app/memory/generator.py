@@ -1,13 +1,30 @@
+import asyncio
+import hashlib
+import logging
+import time
 import uuid
-from typing import Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
 
-from litellm import completion
+from litellm import acompletion, completion
 from sqlalchemy.orm import Session
 
 from app.core.constants import (
+    DEFAULT_LLM_CONTEXT_WINDOW,
+    DEFAULT_LLM_PROVIDER_CONCURRENCY,
+    LLM_CONTEXT_WINDOWS,
+    LLM_EXPECTED_OUTPUT_TOKENS,
+    LEVEL_ARCHIVE_CHAIN_LENGTH,
+    LEVEL_ARCHIVE_MODE_FULL,
+    LEVEL_ARCHIVE_MODE_INCREMENTAL,
+    LLM_PROVIDER_CONCURRENCY,
     MEMORY_HIERARCHY,
     MEMORY_TYPE_DAILY_RAW,
     MEMORY_TYPE_DAILY_SUMMARY,
+    MEMORY_TYPE_LEVEL_1000,
+    MEMORY_TYPE_LEVEL_ARCHIVE,
+    SUMMARY_CHUNK_CONTEXT_RATIO,
+    SUMMARY_CHUNK_MAX_TOKENS,
 )
 from app.core.prompts import (
     DAILY_RAW_CONVERSION_PROMPT,
@@ -15,8 +32,22 @@ from app.core.prompts import (
     HIERARCHICAL_SUMMARY_PROMPT,
 )
 from app.crud import memory as memory_crud
+from app.memory.llm import (
+    LLMCallController,
+    LLMConcurrencyLimiter,
+    get_llm_provider,
+    llm_call_controller,
+    llm_concurrency_limiter,
+)
+from app.memory.llm_cache import LLMResponseCache, get_llm_response_cache
+from app.memory.routing import ModelRouter
+from app.memory.tokens import estimate_tokens
 from app.models import Character, Memory
 
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
 
 class MemoryGenerator:
     """記憶生成エンジン
@@ -29,6 +60,12 @@ class MemoryGenerator:
         db: Session,
         character_id: uuid.UUID,
         model: str = "gemini/gemini-2.0-flash",
+        limiter: Optional[LLMConcurrencyLimiter] = None,
+        response_cache: Optional[LLMResponseCache] = None,
+        call_controller: Optional[LLMCallController] = None,
+        chunk_tokens: Optional[int] = None,
+        router: Optional[ModelRouter] = None,
+        archive_mode: str = LEVEL_ARCHIVE_MODE_INCREMENTAL,
     ):
         """
         記憶生成エンジンの初期化
@@ -37,39 +74,268 @@ class MemoryGenerator:
             db: データベースセッション
             character_id: キャラクターID
             model: 使用するLLMモデル
+            limiter: 非同期のLLM呼び出しの同時実行数制限（Noneの場合は共有の制限）
+            response_cache: LLM応答キャッシュ（Noneの場合は共有のキャッシュ）
+            call_controller: レート制限・再試行・サーキットブレーカーを行う
+                LLM呼び出しの実行制御（Noneの場合は共有の実行制御）
+            chunk_tokens: 階層的要約の入力1グループの最大トークン数
+                （Noneの場合はモデルのコンテキストウィンドウから決める）
+            router: 記憶タイプと入力トークン数ごとのモデルのルーティング
+                （Noneの場合はすべての呼び出しで model を使用する）
+            archive_mode: 長期archiveの生成方法（incremental: 直前のarchiveに
+                新しいlevel_1000を統合する、full: すべてのlevel_1000を要約し直す）
         """
+        if archive_mode not in (
+            LEVEL_ARCHIVE_MODE_INCREMENTAL,
+            LEVEL_ARCHIVE_MODE_FULL,
+        ):
+            raise ValueError(f"無効なarchiveの生成方法です: {archive_mode}")
+
         self.db = db
         self.character_id = character_id
         self.model = model
+        self.limiter = limiter or llm_concurrency_limiter
+        self.response_cache = response_cache or get_llm_response_cache()
+        self.call_controller = call_controller or llm_call_controller
+        self.chunk_tokens = chunk_tokens
+        self.router = router
+        self.archive_mode = archive_mode
         self.character = (
             db.query(Character).filter(Character.id == character_id).first()
         )
         if not self.character:
             raise ValueError(f"キャラクターID {character_id} が見つかりません")
         self.user_id = self.character.user_id
+        # データベースセッションを使用する処理をスレッドで1つずつ実行するためのロック
+        self._db_lock = asyncio.Lock()
+
+    async def run_db(self, func: Callable[..., T], *args: Any) -> T:
+        """
+        データベースセッションを使用する処理をスレッドで実行する
+
+        イベントループを止めないようスレッドで実行する。セッションはスレッドセーフでは
+        ないため、同じ生成エンジン（と同じセッションを使う睡眠処理エンジン）の処理は
+        並行に実行されるタスクの間でも1つずつ実行する。
+
+        Args:
+            func: データベースセッションを使用する関数
+            *args: 関数の引数
+
+        Returns:
+            関数の戻り値
+        """
+        async with self._db_lock:
+            return await asyncio.to_thread(func, *args)
+
+    def _route_models(self, memory_type: Optional[str]) -> List[str]:
+        """
+        記憶タイプの生成に使用する可能性のあるモデルを取得する
+
+        Args:
+            memory_type: 生成する記憶タイプ
+
+        Returns:
+            モデルのリスト（ルーティングを使用しない場合は self.model のみ）
+        """
+        if self.router is None:
+            return [self.model]
+
+        models = []
+        for _, route_models in self.router.routes.get(memory_type, []):
+            for model in route_models:
+                if model not in models:
+                    models.append(model)
+        return models or self.router.default_models or [self.model]
+
+    def _select_route(
+        self, messages: List[Dict[str, str]], memory_type: Optional[str]
+    ) -> Tuple[Optional[str], List[str]]:
+        """
+        記憶タイプと入力トークン数から呼び出すモデルを選択する
+
+        Args:
+            messages: LLMに送信するメッセージリスト
+            memory_type: 生成する記憶タイプ
+
+        Returns:
+            (ルート名（ルーティングを使用しない場合はNone）, 順に試行するモデルのリスト)
+        """
+        # ルートが定義されていない呼び出しは model を使用する
+        if self.router is None or (
+            memory_type not in self.router.routes and not self.router.default_models
+        ):
+            return None, [self.model]
+
+        input_tokens = sum(
+            estimate_tokens(message.get("content", "")) for message in messages
+        )
+        return self.router.select(memory_type, input_tokens)
+
+    def _record_route(
+        self,
+        route: Optional[str],
+        model: str,
+        started: float,
+        messages: List[Dict[str, str]],
+        response=None,
+        content: str = "",
+    ) -> None:
+        """
+        呼び出しの遅延とトークン数をルートの統計に記録する
+
+        トークン数は応答の usage を優先し、ない場合は推定値を使用する。
+        """
+        if route is None:
+            return
+
+        latency = time.perf_counter() - started
+        if response is None:
+            self.router.record(route, model, latency, success=False)
+            return
+
+        usage = getattr(response, "usage", None)
+        prompt_tokens = getattr(usage, "prompt_tokens", None)
+        completion_tokens = getattr(usage, "completion_tokens", None)
+        if not isinstance(prompt_tokens, int):
+            prompt_tokens = sum(
+                estimate_tokens(message.get("content", "")) for message in messages
+            )
+        if not isinstance(completion_tokens, int):
+            completion_tokens = estimate_tokens(content or "")
+        self.router.record(route, model, latency, prompt_tokens, completion_tokens)
+
+    def _call_model(
+        self, model: str, messages: List[Dict[str, str]], route: Optional[str]
+    ) -> str:
+        if self.response_cache is not None:
+            cached = self.response_cache.get(model, messages)
+            if cached is not None:
+                return cached
+
+        started = time.perf_counter()
+        try:
+            response = self.call_controller.call(
+                model,
+                messages,
+                lambda: completion(model=model, messages=messages, stream=False),
+            )
+            content = response.choices[0].message.content
+        except Exception:
+            self._record_route(route, model, started, messages)
+            raise
+        self._record_route(route, model, started, messages, response, content)
+
+        if self.response_cache is not None and content is not None:
+            self.response_cache.put(model, messages, content)
+        return content
+
+    async def _acall_model(
+        self, model: str, messages: List[Dict[str, str]], route: Optional[str]
+    ) -> str:
+        # 応答キャッシュはSQLiteファイルの読み書きを行うためスレッドで実行する
+        if self.response_cache is not None:
+            cached = await asyncio.to_thread(self.response_cache.get, model, messages)
+            if cached is not None:
+                return cached
+
+        async def request():
+            # 同時実行数の枠は再試行の待機中には保持しない
+            async with self.limiter.limit(model):
+                return await acompletion(model=model, messages=messages, stream=False)
+
+        started = time.perf_counter()
+        try:
+            response = await self.call_controller.acall(model, messages, request)
+            content = response.choices[0].message.content
+        except Exception:
+            self._record_route(route, model, started, messages)
+            raise
+        self._record_route(route, model, started, messages, response, content)
+
+        if self.response_cache is not None and content is not None:
+            await asyncio.to_thread(self.response_cache.put, model, messages, content)
+        return content
 
     def _call_llm(
-        self, prompt: str, messages: Optional[List[Dict[str, str]]] = None
+        self,
+        prompt: str,
+        messages: Optional[List[Dict[str, str]]] = None,
+        memory_type: Optional[str] = None,
     ) -> str:
         """
         LLMを呼び出して応答を取得する
 
+        レート制限の待機と一時的な障害の再試行は call_controller が行う。
+        ルーティングを使用する場合は、選択したルートのモデルを失敗するたびに順に試す。
+
         Args:
             prompt: プロンプト文字列
             messages: メッセージリスト（プロンプトがNoneの場合に使用）
+            memory_type: 生成する記憶タイプ（モデルのルーティングに使用）
 
         Returns:
-            LLMの応答テキスト
+            LLMの応答テキスト（どのモデルも応答を返さなかった場合は空文字列）
+
+        Raises:
+            Exception: どのモデルも応答を返さず、いずれかの呼び出しが失敗した場合
+                （再試行の上限に達した場合やサーキットが開いている場合など）
         """
-        try:
-            if messages is None:
-                messages = [{"role": "user", "content": prompt}]
+        if messages is None:
+            messages = [{"role": "user", "content": prompt}]
+        route, models = self._select_route(messages, memory_type)
+
+        error: Optional[Exception] = None
+        for model in models:
+            try:
+                content = self._call_model(model, messages, route)
+            except Exception as e:
+                logger.warning("LLM呼び出し中にエラーが発生しました (%s): %s", model, e)
+                error = e
+                continue
+            if content:
+                return content
+        if error is not None:
+            raise error
+        return ""
 
-            response = completion(model=self.model, messages=messages, stream=False)
-            return response.choices[0].message.content
-        except Exception as e:
-            print(f"LLM呼び出し中にエラーが発生しました: {str(e)}")
-            return ""
+    async def _acall_llm(
+        self,
+        prompt: str,
+        messages: Optional[List[Dict[str, str]]] = None,
+        memory_type: Optional[str] = None,
+    ) -> str:
+        """
+        同時実行数の制限内で非同期にLLMを呼び出して応答を取得する
+
+        Args:
+            prompt: プロンプト文字列
+            messages: メッセージリスト（プロンプトがNoneの場合に使用）
+            memory_type: 生成する記憶タイプ（モデルのルーティングに使用）
+
+        Returns:
+            LLMの応答テキスト（どのモデルも応答を返さなかった場合は空文字列）
+
+        Raises:
+            Exception: どのモデルも応答を返さず、いずれかの呼び出しが失敗した場合
+                （再試行の上限に達した場合やサーキットが開いている場合など）
+        """
+        if messages is None:
+            messages = [{"role": "user", "content": prompt}]
+        route, models = self._select_route(messages, memory_type)
+
+        error: Optional[Exception] = None
+        for model in models:
+            try:
+                content = await self._acall_model(model, messages, route)
+            except Exception as e:
+                logger.warning("LLM呼び出し中にエラーが発生しました (%s): %s", model, e)
+                error = e
+                continue
+            if content:
+                return content
+        if error is not None:
+            raise error
+        return ""
 
     def convert_raw_conversation_to_daily_raw(
         self, conversation_history: str, day: int
@@ -87,7 +353,7 @@ class MemoryGenerator:
         prompt = DAILY_RAW_CONVERSION_PROMPT.format(
             conversation_history=conversation_history
         )
-        memory_content = self._call_llm(prompt)
+        memory_content = self._call_llm(prompt, memory_type=MEMORY_TYPE_DAILY_RAW)
 
         if not memory_content:
             return None
@@ -102,50 +368,244 @@ class MemoryGenerator:
             content=memory_content,
         )
 
-    def generate_daily_summary(self, day: int) -> Optional[Memory]:
+    def _get_daily_raw_inputs(self, day: int) -> List[Memory]:
         """
-        特定の日のdaily_raw記憶からdaily_summaryを生成する
+        daily_summaryの入力となる特定の日のdaily_raw記憶を取得する
 
         Args:
             day: 記憶が関連する日
 
         Returns:
-            生成されたdaily_summary記憶オブジェクト
+            daily_raw記憶のリスト
         """
-        raw_memories = memory_crud.get_memories_by_character(
-            db=self.db,
-            character_id=self.character_id,
-            memory_type=MEMORY_TYPE_DAILY_RAW,
-            start_day=day,
-            end_day=day,
+        return list(
+            memory_crud.iter_memories_by_character(
+                db=self.db,
+                character_id=self.character_id,
+                memory_type=MEMORY_TYPE_DAILY_RAW,
+                start_day=day,
+                end_day=day,
+            )
+        )
+
+    def _check_existing_summary(
+        self, memory_type: str, start_day: int, end_day: int, inputs: List[Memory]
+    ) -> Tuple[Optional[Memory], str, List[Memory]]:
+        """
+        同じ期間の要約が既に同じ入力から生成されているかを確認する
+
+        Args:
+            memory_type: 記憶タイプ
+            start_day: 開始日
+            end_day: 終了日
+            inputs: 要約の入力となる記憶のリスト
+
+        Returns:
+            (入力が変わっていない既存の要約（ない場合はNone）,
+             入力のフィンガープリント, 同じ期間の既存の要約のリスト)
+        """
+        fingerprint = compute_source_fingerprint(inputs)
+        existing = memory_crud.get_memories_for_range(
+            self.db, self.character_id, memory_type, start_day, end_day
         )
+        if len(existing) == 1 and existing[0].source_fingerprint == fingerprint:
+            return existing[0], fingerprint, existing
+        return None, fingerprint, existing
+
+    def _prepare_daily_summary(
+        self, day: int
+    ) -> Optional[Tuple[Optional[Memory], str, List[Memory], str]]:
+        """
+        daily_summaryの入力を取得し、生成済みの要約の確認とプロンプトの作成を行う
 
+        Args:
+            day: 記憶が関連する日
+
+        Returns:
+            入力がない場合はNone、ある場合は(入力が変わっていない既存の要約,
+            入力のフィンガープリント, 同じ期間の既存の要約のリスト, プロンプト)
+        """
+        raw_memories = self._get_daily_raw_inputs(day)
         if not raw_memories:
             return None
 
-        combined_raw = "\n\n".join([mem.content for mem in raw_memories])
+        unchanged, fingerprint, existing = self._check_existing_summary(
+            MEMORY_TYPE_DAILY_SUMMARY, day, day, raw_memories
+        )
+        return (
+            unchanged,
+            fingerprint,
+            existing,
+            _build_daily_summary_prompt(raw_memories),
+        )
 
-        prompt = DAILY_SUMMARY_PROMPT.format(daily_raw_memory=combined_raw)
-        summary_content = self._call_llm(prompt)
+    def _save_summary(
+        self,
+        memory_type: str,
+        start_day: int,
+        end_day: int,
+        content: str,
+        source_fingerprint: Optional[str] = None,
+        existing: Optional[List[Memory]] = None,
+        checkpoint: Optional[Callable[[], None]] = None,
+    ) -> Optional[Memory]:
+        """
+        LLMが生成した要約を記憶として保存する
+
+        同じ期間の既存の要約がある場合は1件目を置き換え、残りの重複は削除する。
+        置き換えと削除は同じトランザクションでコミットする。
+
+        Args:
+            memory_type: 記憶タイプ
+            start_day: 開始日
+            end_day: 終了日
+            content: 要約の内容
+            source_fingerprint: 要約の入力となった記憶のフィンガープリント
+            existing: 同じ期間の既存の要約のリスト
+            checkpoint: 要約を保存するトランザクション内で、コミットの前に呼び出す関数
 
-        if not summary_content:
+        Returns:
+            保存された記憶オブジェクト（要約が空の場合はNone）
+        """
+        if not content:
             return None
 
-        return memory_crud.add_memory(
-            db=self.db,
-            user_id=self.user_id,
-            character_id=self.character_id,
-            memory_type=MEMORY_TYPE_DAILY_SUMMARY,
-            start_day=day,
-            end_day=day,
-            content=summary_content,
+        if not existing:
+            if checkpoint is not None:
+                checkpoint()
+            return memory_crud.add_memory(
+                db=self.db,
+                user_id=self.user_id,
+                character_id=self.character_id,
+                memory_type=memory_type,
+                start_day=start_day,
+                end_day=end_day,
+                content=content,
+                source_fingerprint=source_fingerprint,
+            )
+
+        # 重複の削除と置き換えは1つのトランザクションで行い、途中で失敗した場合は
+        # 既存の要約をすべて残す
+        with memory_crud.batched_writes(self.db):
+            for duplicate in existing[1:]:
+                memory_crud.delete_memory(self.db, duplicate.id)
+            if checkpoint is not None:
+                checkpoint()
+            memory = memory_crud.update_memory(
+                self.db,
+                existing[0].id,
+                content=content,
+                source_fingerprint=source_fingerprint,
+            )
+        return memory
+
+    def _save_hierarchical_summary(
+        self,
+        memory_type: str,
+        start_day: int,
+        end_day: int,
+        content: str,
+        source_fingerprint: Optional[str] = None,
+        existing: Optional[List[Memory]] = None,
+        checkpoint: Optional[Callable[[], None]] = None,
+    ) -> Optional[Memory]:
+        """
+        階層的要約を保存し、incrementalモードでは古いarchiveを削除する
+        """
+        memory = self._save_summary(
+            memory_type,
+            start_day,
+            end_day,
+            content,
+            source_fingerprint,
+            existing,
+            checkpoint,
         )
+        if (
+            memory is not None
+            and memory_type == MEMORY_TYPE_LEVEL_ARCHIVE
+            and self.archive_mode == LEVEL_ARCHIVE_MODE_INCREMENTAL
+        ):
+            self._prune_archive_chain()
+        return memory
 
-    def generate_hierarchical_summary(
-        self, memory_type: str, start_day: int, end_day: int
+    def generate_daily_summary(
+        self, day: int, checkpoint: Optional[Callable[[], None]] = None
     ) -> Optional[Memory]:
         """
-        より低レベルの記憶から階層的な要約を生成する
+        特定の日のdaily_raw記憶からdaily_summaryを生成する
+
+        同じ日のdaily_summaryが同じ入力から生成済みの場合はLLMを呼び出さずに返す。
+
+        Args:
+            day: 記憶が関連する日
+            checkpoint: 要約を保存するトランザクション内で、コミットの前に呼び出す関数
+
+        Returns:
+            生成されたdaily_summary記憶オブジェクト
+        """
+        prepared = self._prepare_daily_summary(day)
+        if prepared is None:
+            return None
+
+        unchanged, fingerprint, existing, prompt = prepared
+        if unchanged is not None:
+            return unchanged
+
+        summary_content = self._call_llm(prompt, memory_type=MEMORY_TYPE_DAILY_SUMMARY)
+        return self._save_summary(
+            MEMORY_TYPE_DAILY_SUMMARY,
+            day,
+            day,
+            summary_content,
+            fingerprint,
+            existing,
+            checkpoint,
+        )
+
+    async def agenerate_daily_summary(
+        self, day: int, checkpoint: Optional[Callable[[], None]] = None
+    ) -> Optional[Memory]:
+        """
+        特定の日のdaily_raw記憶からdaily_summaryを非同期に生成する
+
+        データベースの読み込みと保存は run_db でスレッドで実行し、
+        イベントループではLLMの呼び出しのみを待つ。
+
+        Args:
+            day: 記憶が関連する日
+            checkpoint: 要約を保存するトランザクション内で、コミットの前に呼び出す関数
+
+        Returns:
+            生成されたdaily_summary記憶オブジェクト
+        """
+        prepared = await self.run_db(self._prepare_daily_summary, day)
+        if prepared is None:
+            return None
+
+        unchanged, fingerprint, existing, prompt = prepared
+        if unchanged is not None:
+            return unchanged
+
+        summary_content = await self._acall_llm(
+            prompt, memory_type=MEMORY_TYPE_DAILY_SUMMARY
+        )
+        return await self.run_db(
+            self._save_summary,
+            MEMORY_TYPE_DAILY_SUMMARY,
+            day,
+            day,
+            summary_content,
+            fingerprint,
+            existing,
+            checkpoint,
+        )
+
+    def _get_hierarchical_inputs(
+        self, memory_type: str, start_day: int, end_day: int
+    ) -> List[Memory]:
+        """
+        階層的な要約の入力となる、より低レベルの記憶を取得する
 
         Args:
             memory_type: 生成する記憶タイプ（level_10, level_100, level_1000, level_archive）
@@ -153,8 +613,14 @@ class MemoryGenerator:
             end_day: 終了日
 
         Returns:
-            生成された階層的要約記憶オブジェクト
+            記憶のリスト
         """
+        if (
+            memory_type == MEMORY_TYPE_LEVEL_ARCHIVE
+            and self.archive_mode == LEVEL_ARCHIVE_MODE_INCREMENTAL
+        ):
+            return self.get_rolling_archive_inputs(end_day)
+
         hierarchy_level = MEMORY_HIERARCHY.get(memory_type)
         if hierarchy_level is None or hierarchy_level <= 1:
             raise ValueError(f"無効な記憶タイプです: {memory_type}")
@@ -170,36 +636,389 @@ class MemoryGenerator:
                 f"記憶タイプ {memory_type} の入力記憶タイプが見つかりません"
             )
 
-        input_memories = memory_crud.get_memories_by_character(
-            db=self.db,
-            character_id=self.character_id,
-            memory_type=input_memory_type,
-            start_day=start_day,
-            end_day=end_day,
+        return list(
+            memory_crud.iter_memories_by_character(
+                db=self.db,
+                character_id=self.character_id,
+                memory_type=input_memory_type,
+                start_day=start_day,
+                end_day=end_day,
+            )
         )
 
+    def _prepare_hierarchical_summary(
+        self, memory_type: str, start_day: int, end_day: int
+    ) -> Optional[
+        Tuple[Optional[Memory], str, List[Memory], List[Tuple[int, int, str]]]
+    ]:
+        """
+        階層的要約の入力を取得し、生成済みの要約の確認と要約の入力の作成を行う
+
+        Args:
+            memory_type: 生成する記憶タイプ
+            start_day: 開始日
+            end_day: 終了日
+
+        Returns:
+            入力がない場合はNone、ある場合は(入力が変わっていない既存の要約,
+            入力のフィンガープリント, 同じ期間の既存の要約のリスト,
+            (開始日, 終了日, 記憶内容)のリスト)
+        """
+        input_memories = self._get_hierarchical_inputs(memory_type, start_day, end_day)
         if not input_memories:
             return None
 
-        combined_input = "\n\n".join(
-            [
-                f"Day {mem.start_day}-{mem.end_day}: {mem.content}"
-                for mem in input_memories
-            ]
+        unchanged, fingerprint, existing = self._check_existing_summary(
+            memory_type, start_day, end_day, input_memories
         )
+        return unchanged, fingerprint, existing, _to_summary_inputs(input_memories)
 
-        prompt = HIERARCHICAL_SUMMARY_PROMPT.format(input_memories=combined_input)
-        summary_content = self._call_llm(prompt)
+    def get_rolling_archive_inputs(self, end_day: int) -> List[Memory]:
+        """
+        incrementalモードの長期archiveの入力を取得する
 
-        if not summary_content:
-            return None
+        直前のarchiveと、その後に終わるlevel_1000（通常は最新の1件）を入力とするため、
+        キャラクターの年齢にかかわらず1回の要約の入力の大きさは一定になる。
+        直前のarchiveがない場合はすべてのlevel_1000を入力とする。
 
-        return memory_crud.add_memory(
+        Args:
+            end_day: 生成するarchiveの終了日
+
+        Returns:
+            直前のarchive（ある場合）とlevel_1000のリスト
+        """
+        previous = memory_crud.get_latest_memory_before(
+            self.db, self.character_id, MEMORY_TYPE_LEVEL_ARCHIVE, end_day
+        )
+        blocks = memory_crud.iter_memories_by_character(
             db=self.db,
-            user_id=self.user_id,
             character_id=self.character_id,
-            memory_type=memory_type,
-            start_day=start_day,
+            memory_type=MEMORY_TYPE_LEVEL_1000,
+            start_day=previous.end_day + 1 if previous is not None else None,
             end_day=end_day,
-            content=summary_content,
         )
+        inputs = [previous] if previous is not None else []
+        inputs.extend(sorted(blocks, key=lambda memory: memory.start_day))
+        return inputs
+
+    def _prune_archive_chain(self) -> None:
+        """
+        incrementalモードで保持数を超えた古いarchiveを削除する
+        """
+        archives = sorted(
+            memory_crud.iter_memories_by_character(
+                db=self.db,
+                character_id=self.character_id,
+                memory_type=MEMORY_TYPE_LEVEL_ARCHIVE,
+            ),
+            key=lambda memory: memory.end_day,
+            reverse=True,
+        )
+        for archive in archives[LEVEL_ARCHIVE_CHAIN_LENGTH:]:
+            memory_crud.delete_memory(self.db, archive.id)
+
+    def _get_chunk_tokens(self, memory_type: Optional[str] = None) -> int:
+        """
+        モデルのコンテキストウィンドウから要約の入力1グループの最大トークン数を決める
+
+        ルーティングを使用する場合は、フォールバック先を含めて最も小さい
+        コンテキストウィンドウに合わせる。
+        """
+        if self.chunk_tokens is not None:
+            return self.chunk_tokens
+
+        context_window = min(
+            LLM_CONTEXT_WINDOWS.get(model, DEFAULT_LLM_CONTEXT_WINDOW)
+            for model in self._route_models(memory_type)
+        )
+        reserved = (
+            estimate_tokens(HIERARCHICAL_SUMMARY_PROMPT) + LLM_EXPECTED_OUTPUT_TOKENS
+        )
+        return max(
+            min(
+                int(context_window * SUMMARY_CHUNK_CONTEXT_RATIO),
+                SUMMARY_CHUNK_MAX_TOKENS,
+            )
+            - reserved,
+            1,
+        )
+
+    def _plan_summary_round(
+        self,
+        entries: List[Tuple[int, int, str]],
+        reduce: bool = False,
+        memory_type: Optional[str] = None,
+    ) -> List[List[Tuple[int, int, str]]]:
+        """
+        要約の入力をトークン数の上限に収まるグループに分割する
+
+        1件で上限を超える入力は単独のグループとする。部分要約を統合する段階で
+        件数が減らない場合は、要約が収束するように2件ずつのグループにする。
+
+        Args:
+            entries: (開始日, 終了日, 記憶内容)のリスト
+            reduce: 部分要約を統合する段階かどうか
+            memory_type: 生成する記憶タイプ
+
+        Returns:
+            グループのリスト
+        """
+        max_tokens = self._get_chunk_tokens(memory_type)
+        chunks = []
+        current = []
+        current_tokens = 0
+        for entry in entries:
+            tokens = estimate_tokens(_format_summary_input(*entry))
+            if current and current_tokens + tokens > max_tokens:
+                chunks.append(current)
+                current = []
+                current_tokens = 0
+            current.append(entry)
+            current_tokens += tokens
+        if current:
+            chunks.append(current)
+
+        if reduce and len(chunks) > 1 and len(chunks) == len(entries):
+            chunks = [entries[i : i + 2] for i in range(0, len(entries), 2)]
+        return chunks
+
+    def _summarize_inputs(
+        self, entries: List[Tuple[int, int, str]], memory_type: Optional[str] = None
+    ) -> str:
+        """
+        入力の記憶を要約する（入力が大きい場合は分割して要約した結果をさらに要約する）
+
+        Args:
+            entries: (開始日, 終了日, 記憶内容)のリスト
+            memory_type: 生成する記憶タイプ
+
+        Returns:
+            要約テキスト（LLMが応答を返さなかった場合は空文字列）
+        """
+        reduce = False
+        while True:
+            chunks = self._plan_summary_round(entries, reduce, memory_type)
+            if len(chunks) == 1:
+                return self._call_llm(
+                    _build_summary_prompt(chunks[0]), memory_type=memory_type
+                )
+
+            # 各グループの要約を並行して生成する
+            workers = min(
+                len(chunks),
+                LLM_PROVIDER_CONCURRENCY.get(
+                    get_llm_provider(self._route_models(memory_type)[0]),
+                    DEFAULT_LLM_PROVIDER_CONCURRENCY,
+                ),
+            )
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                partials = list(
+                    executor.map(
+                        lambda chunk: self._call_llm(
+                            _build_summary_prompt(chunk), memory_type=memory_type
+                        ),
+                        chunks,
+                    )
+                )
+            if not all(partials):
+                return ""
+            entries = _merge_partial_summaries(chunks, partials)
+            reduce = True
+
+    async def _asummarize_inputs(
+        self, entries: List[Tuple[int, int, str]], memory_type: Optional[str] = None
+    ) -> str:
+        """
+        入力の記憶を非同期に要約する（入力が大きい場合は分割して要約した結果をさらに要約する）
+
+        Args:
+            entries: (開始日, 終了日, 記憶内容)のリスト
+            memory_type: 生成する記憶タイプ
+
+        Returns:
+            要約テキスト（LLMが応答を返さなかった場合は空文字列）
+        """
+        reduce = False
+        while True:
+            chunks = self._plan_summary_round(entries, reduce, memory_type)
+            if len(chunks) == 1:
+                return await self._acall_llm(
+                    _build_summary_prompt(chunks[0]), memory_type=memory_type
+                )
+
+            # 各グループの要約を並行して生成する（同時実行数は limiter で制御）
+            # 失敗したグループがあっても、残りの呼び出しの完了を待ってから例外を送出する
+            partials = await asyncio.gather(
+                *(
+                    self._acall_llm(
+                        _build_summary_prompt(chunk), memory_type=memory_type
+                    )
+                    for chunk in chunks
+                ),
+                return_exceptions=True,
+            )
+            for partial in partials:
+                if isinstance(partial, BaseException):
+                    raise partial
+            if not all(partials):
+                return ""
+            entries = _merge_partial_summaries(chunks, partials)
+            reduce = True
+
+    def generate_hierarchical_summary(
+        self,
+        memory_type: str,
+        start_day: int,
+        end_day: int,
+        checkpoint: Optional[Callable[[], None]] = None,
+    ) -> Optional[Memory]:
+        """
+        より低レベルの記憶から階層的な要約を生成する
+
+        入力がモデルのコンテキストに収まらない場合は、トークン数で分割した
+        グループごとに要約してから統合する。同じ期間の要約が同じ入力から
+        生成済みの場合はLLMを呼び出さずに返す。
+
+        Args:
+            memory_type: 生成する記憶タイプ（level_10, level_100, level_1000, level_archive）
+            start_day: 開始日
+            end_day: 終了日
+            checkpoint: 要約を保存するトランザクション内で、コミットの前に呼び出す関数
+
+        Returns:
+            生成された階層的要約記憶オブジェクト
+        """
+        prepared = self._prepare_hierarchical_summary(memory_type, start_day, end_day)
+        if prepared is None:
+            return None
+
+        unchanged, fingerprint, existing, entries = prepared
+        if unchanged is not None:
+            return unchanged
+
+        summary_content = self._summarize_inputs(entries, memory_type)
+        return self._save_hierarchical_summary(
+            memory_type,
+            start_day,
+            end_day,
+            summary_content,
+            fingerprint,
+            existing,
+            checkpoint,
+        )
+
+    async def agenerate_hierarchical_summary(
+        self,
+        memory_type: str,
+        start_day: int,
+        end_day: int,
+        checkpoint: Optional[Callable[[], None]] = None,
+    ) -> Optional[Memory]:
+        """
+        より低レベルの記憶から階層的な要約を非同期に生成する
+
+        データベースの読み込みと保存は run_db でスレッドで実行し、
+        イベントループではLLMの呼び出しのみを待つ。
+
+        Args:
+            memory_type: 生成する記憶タイプ（level_10, level_100, level_1000, level_archive）
+            start_day: 開始日
+            end_day: 終了日
+            checkpoint: 要約を保存するトランザクション内で、コミットの前に呼び出す関数
+
+        Returns:
+            生成された階層的要約記憶オブジェクト
+        """
+        prepared = await self.run_db(
+            self._prepare_hierarchical_summary, memory_type, start_day, end_day
+        )
+        if prepared is None:
+            return None
+
+        unchanged, fingerprint, existing, entries = prepared
+        if unchanged is not None:
+            return unchanged
+
+        summary_content = await self._asummarize_inputs(entries, memory_type)
+        return await self.run_db(
+            self._save_hierarchical_summary,
+            memory_type,
+            start_day,
+            end_day,
+            summary_content,
+            fingerprint,
+            existing,
+            checkpoint,
+        )
+
+
+def compute_source_fingerprint(memories: List[Memory]) -> str:
+    """
+    要約の入力となる記憶のIDと内容からフィンガープリントを計算する
+
+    Args:
+        memories: 入力となる記憶のリスト
+
+    Returns:
+        SHA-256の16進文字列（入力の順序には依存しない）
+    """
+    digest = hashlib.sha256()
+    for memory_id, content_hash in sorted(
+        (str(memory.id), hashlib.sha256(memory.content.encode("utf-8")).hexdigest())
+        for memory in memories
+    ):
+        digest.update(f"{memory_id}:{content_hash}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _build_daily_summary_prompt(raw_memories: List[Memory]) -> str:
+    """
+    daily_raw記憶からdaily_summary生成用のプロンプトを作成する
+
+    Args:
+        raw_memories: daily_raw記憶のリスト
+
+    Returns:
+        プロンプト文字列
+    """
+    combined_raw = "\n\n".join([mem.content for mem in raw_memories])
+
+    return DAILY_SUMMARY_PROMPT.format(daily_raw_memory=combined_raw)
+
+
+def _to_summary_inputs(memories: List[Memory]) -> List[Tuple[int, int, str]]:
+    return [(mem.start_day, mem.end_day, mem.content) for mem in memories]
+
+
+def _format_summary_input(start_day: int, end_day: int, content: str) -> str:
+    return f"Day {start_day}-{end_day}: {content}"
+
+
+def _build_summary_prompt(entries: List[Tuple[int, int, str]]) -> str:
+    """
+    階層的な要約のプロンプトを作成する
+
+    Args:
+        entries: (開始日, 終了日, 記憶内容)のリスト
+
+    Returns:
+        プロンプト文字列
+    """
+    combined_input = "\n\n".join([_format_summary_input(*entry) for entry in entries])
+    return HIERARCHICAL_SUMMARY_PROMPT.format(input_memories=combined_input)
+
+
+def _merge_partial_summaries(
+    chunks: List[List[Tuple[int, int, str]]], partials: List[str]
+) -> List[Tuple[int, int, str]]:
+    """
+    グループごとの要約を、グループの日付範囲を持つ次の段階の入力にする
+    """
+    return [
+        (
+            min(start for start, _, _ in chunk),
+            max(end for _, end, _ in chunk),
+            partial,
+        )
+        for chunk, partial in zip(chunks, partials)
+    ]
@@ -0,0 +1,593 @@
+"""
+LLM呼び出しの実行制御
+
+非同期のLLM呼び出しを全体とプロバイダーごとの同時実行数の上限で制御し、
+プロバイダーのレート制限・一時的な障害に対してレート制御・再試行・
+サーキットブレーカーで対処する。
+"""
+
+import asyncio
+import random
+import threading
+import time
+import weakref
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+import litellm
+
+from app.core.constants import (
+    DEFAULT_LLM_PROVIDER_CONCURRENCY,
+    DEFAULT_LLM_RATE_LIMIT,
+    LLM_CIRCUIT_FAILURE_THRESHOLD,
+    LLM_CIRCUIT_RESET_TIMEOUT,
+    LLM_EXPECTED_OUTPUT_TOKENS,
+    LLM_MAX_CONCURRENCY,
+    LLM_MAX_RETRIES,
+    LLM_PROVIDER_CONCURRENCY,
+    LLM_RATE_LIMITS,
+    LLM_RETRY_BASE_DELAY,
+    LLM_RETRY_MAX_DELAY,
+)
+from app.memory.tokens import estimate_tokens
+
+# 再試行するHTTPステータスコード
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+def get_llm_provider(model: str) -> str:
+    """
+    モデル名からLLMプロバイダー名を取得する
+
+    Args:
+        model: LiteLLMのモデル名（例: "gemini/gemini-2.0-flash"）
+
+    Returns:
+        プロバイダー名（判定できない場合はモデル名）
+    """
+    if "/" in model:
+        return model.split("/", 1)[0]
+    try:
+        return litellm.get_llm_provider(model)[1]
+    except Exception:
+        return model
+
+
+class LLMConcurrencyLimiter:
+    """LLM呼び出しの同時実行数制限
+
+    全体の上限とプロバイダーごとの上限の両方を満たすように呼び出しを待機させる。
+    セマフォはイベントループごとに作成する。
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = LLM_MAX_CONCURRENCY,
+        provider_limits: Optional[Dict[str, int]] = None,
+        default_provider_limit: int = DEFAULT_LLM_PROVIDER_CONCURRENCY,
+    ):
+        """
+        同時実行数制限の初期化
+
+        Args:
+            max_concurrency: 全体の同時実行数の上限
+            provider_limits: プロバイダーごとの同時実行数の上限
+            default_provider_limit: provider_limits にないプロバイダーの上限
+        """
+        if max_concurrency <= 0 or default_provider_limit <= 0:
+            raise ValueError("同時実行数の上限は1以上である必要があります")
+
+        self.max_concurrency = max_concurrency
+        self.provider_limits = dict(
+            LLM_PROVIDER_CONCURRENCY if provider_limits is None else provider_limits
+        )
+        self.default_provider_limit = default_provider_limit
+        # イベントループ -> (全体のセマフォ, プロバイダー名 -> セマフォ)
+        self._loops = weakref.WeakKeyDictionary()
+
+    def _get_semaphores(
+        self, provider: str
+    ) -> Tuple[asyncio.Semaphore, asyncio.Semaphore]:
+        loop = asyncio.get_running_loop()
+        state = self._loops.get(loop)
+        if state is None:
+            state = (asyncio.Semaphore(self.max_concurrency), {})
+            self._loops[loop] = state
+
+        global_semaphore, provider_semaphores = state
+        provider_semaphore = provider_semaphores.get(provider)
+        if provider_semaphore is None:
+            provider_semaphore = asyncio.Semaphore(
+                self.provider_limits.get(provider, self.default_provider_limit)
+            )
+            provider_semaphores[provider] = provider_semaphore
+        return global_semaphore, provider_semaphore
+
+    @asynccontextmanager
+    async def limit(self, model: str) -> AsyncIterator[None]:
+        """
+        モデルのプロバイダーの実行枠を確保する
+
+        Args:
+            model: LiteLLMのモデル名
+        """
+        global_semaphore, provider_semaphore = self._get_semaphores(
+            get_llm_provider(model)
+        )
+        # プロバイダーの枠を先に確保し、待機中に全体の枠を占有しないようにする
+        async with provider_semaphore:
+            async with global_semaphore:
+                yield
+
+
+# アプリケーション全体で共有する同時実行数制限
+llm_concurrency_limiter = LLMConcurrencyLimiter()
+
+
+class CircuitOpenError(Exception):
+    """プロバイダーのサーキットが開いているため呼び出しを行わなかったことを示す例外"""
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """
+    例外に含まれるRetry-Afterヘッダーの待機秒数を取得する
+
+    Args:
+        error: LLM呼び出しの例外
+
+    Returns:
+        待機秒数（ヘッダーがない場合はNone）
+    """
+    headers = getattr(error, "litellm_response_headers", None)
+    if not headers:
+        try:
+            headers = error.response.headers
+        except Exception:
+            return None
+
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """
+    再試行で回復する可能性のある例外かどうかを判定する
+
+    Args:
+        error: LLM呼び出しの例外
+
+    Returns:
+        レート制限・タイムアウト・サーバーエラー・接続エラーの場合はTrue
+    """
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    return getattr(error, "status_code", None) in RETRYABLE_STATUS_CODES
+
+
+class TokenBucket:
+    """トークンバケット
+
+    消費量を先に差し引き、不足分が補充されるまでの待機時間を返すことで、
+    待機中の呼び出しが到着順に上限の速度で実行されるようにする。
+    """
+
+    def __init__(
+        self,
+        per_minute: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        トークンバケットの初期化
+
+        Args:
+            per_minute: 1分あたりの補充量（バケットの容量も同じ）
+            clock: 現在時刻（秒）を返す関数
+        """
+        if per_minute <= 0:
+            raise ValueError(f"無効なレート制限です: {per_minute}")
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self._clock = clock
+        self._tokens = self.capacity
+        self._updated_at = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        """
+        指定量を予約して実行までの待機秒数を取得する
+
+        Args:
+            amount: 消費量（容量を超える場合は容量として扱う）
+
+        Returns:
+            待機秒数
+        """
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated_at) * self.rate
+            )
+            self._updated_at = now
+            self._tokens -= min(amount, self.capacity)
+            return max(-self._tokens / self.rate, 0.0)
+
+    def adjust(self, amount: float) -> None:
+        """
+        予約済みの消費量を実際の消費量に合わせて補正する
+
+        Args:
+            amount: 追加で消費した量（負の場合は返却）
+        """
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens - amount)
+
+
+class LLMRateLimiter:
+    """LLM呼び出しのレート制限
+
+    モデル名（設定がない場合はプロバイダー名）ごとに、リクエスト数とトークン数の
+    2つのトークンバケットで1分あたりの上限を守る。
+    """
+
+    def __init__(
+        self,
+        limits: Optional[Dict[str, Dict[str, int]]] = None,
+        default_limit: Optional[Dict[str, int]] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        レート制限の初期化
+
+        Args:
+            limits: モデル名またはプロバイダー名ごとの
+                requests_per_minute と tokens_per_minute の上限
+            default_limit: limits にないプロバイダーの上限
+            clock: 現在時刻（秒）を返す関数
+        """
+        self.limits = dict(LLM_RATE_LIMITS if limits is None else limits)
+        self.default_limit = dict(default_limit or DEFAULT_LLM_RATE_LIMIT)
+        self._clock = clock
+        self._buckets: Dict[str, Tuple[TokenBucket, TokenBucket]] = {}
+        self._lock = threading.Lock()
+
+    def _get_buckets(self, model: str) -> Tuple[TokenBucket, TokenBucket]:
+        key = model if model in self.limits else get_llm_provider(model)
+        with self._lock:
+            buckets = self._buckets.get(key)
+            if buckets is None:
+                limit = self.limits.get(key, self.default_limit)
+                buckets = (
+                    TokenBucket(limit["requests_per_minute"], self._clock),
+                    TokenBucket(limit["tokens_per_minute"], self._clock),
+                )
+                self._buckets[key] = buckets
+            return buckets
+
+    def reserve(self, model: str, tokens: int) -> float:
+        """
+        1回の呼び出しと見積もりトークン数を予約する
+
+        Args:
+            model: LiteLLMのモデル名
+            tokens: 見積もりトークン数
+
+        Returns:
+            呼び出しまでの待機秒数
+        """
+        request_bucket, token_bucket = self._get_buckets(model)
+        return max(request_bucket.reserve(1), token_bucket.reserve(tokens))
+
+    def record_usage(self, model: str, estimated: int, actual: int) -> None:
+        """
+        見積もりと実際のトークン数の差をレート制限に反映する
+
+        Args:
+            model: LiteLLMのモデル名
+            estimated: 予約した見積もりトークン数
+            actual: 実際に消費したトークン数
+        """
+        _, token_bucket = self._get_buckets(model)
+        token_bucket.adjust(actual - estimated)
+
+
+class CircuitBreaker:
+    """プロバイダーごとのサーキットブレーカー
+
+    連続した障害が閾値に達するとサーキットを開き、一定時間は呼び出しを即座に
+    失敗させる。時間経過後は1回だけ試行を許可し、成功した場合は閉じる。
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = LLM_CIRCUIT_FAILURE_THRESHOLD,
+        reset_timeout: float = LLM_CIRCUIT_RESET_TIMEOUT,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        サーキットブレーカーの初期化
+
+        Args:
+            failure_threshold: サーキットを開く連続障害数
+            reset_timeout: サーキットを開いてから試行を許可するまでの秒数
+            clock: 現在時刻（秒）を返す関数
+        """
+        if failure_threshold < 1:
+            raise ValueError(f"無効な障害数の閾値です: {failure_threshold}")
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._failures: Dict[str, int] = {}
+        self._opened_at: Dict[str, float] = {}
+        self._trial_in_progress: Dict[str, bool] = {}
+        self._lock = threading.Lock()
+
+    def before_call(self, provider: str) -> bool:
+        """
+        呼び出し前にサーキットの状態を確認する
+
+        Args:
+            provider: プロバイダー名
+
+        Returns:
+            サーキットを閉じるための試行を許可した場合はTrue
+            （呼び出しの終了時に release_trial を呼び出す必要がある）
+
+        Raises:
+            CircuitOpenError: サーキットが開いている場合
+        """
+        with self._lock:
+            opened_at = self._opened_at.get(provider)
+            if opened_at is None:
+                return False
+            if (
+                self._clock() - opened_at < self.reset_timeout
+                or self._trial_in_progress.get(provider)
+            ):
+                raise CircuitOpenError(
+                    f"プロバイダー {provider} への呼び出しは一時的に停止されています"
+                )
+            self._trial_in_progress[provider] = True
+            return True
+
+    def release_trial(self, provider: str) -> None:
+        """
+        試行を終了する（キャンセルなどで成功・障害を記録せずに終わった場合は
+        サーキットを開いたまま次の試行を許可する）
+        """
+        with self._lock:
+            self._trial_in_progress.pop(provider, None)
+
+    def record_success(self, provider: str) -> None:
+        """
+        呼び出しの成功を記録してサーキットを閉じる
+        """
+        with self._lock:
+            self._failures.pop(provider, None)
+            self._opened_at.pop(provider, None)
+            self._trial_in_progress.pop(provider, None)
+
+    def record_failure(self, provider: str) -> None:
+        """
+        呼び出しの障害を記録し、閾値に達した場合はサーキットを開く
+        """
+        with self._lock:
+            failures = self._failures.get(provider, 0) + 1
+            self._failures[provider] = failures
+            self._trial_in_progress.pop(provider, None)
+            if provider in self._opened_at or failures >= self.failure_threshold:
+                self._opened_at[provider] = self._clock()
+
+    def state(self, provider: str) -> str:
+        """
+        サーキットの状態（"closed", "open", "half_open"）を取得する
+        """
+        with self._lock:
+            opened_at = self._opened_at.get(provider)
+            if opened_at is None:
+                return "closed"
+            if self._clock() - opened_at < self.reset_timeout:
+                return "open"
+            return "half_open"
+
+
+class LLMCallController:
+    """LLM呼び出しの実行制御
+
+    呼び出しごとにサーキットの確認とレート制限の待機を行い、
+    再試行可能な障害はRetry-Afterを考慮したジッター付き指数バックオフで再試行する。
+    """
+
+    def __init__(
+        self,
+        rate_limiter: Optional[LLMRateLimiter] = None,
+        circuit_breaker: Optional[CircuitBreaker] = None,
+        max_retries: int = LLM_MAX_RETRIES,
+        base_delay: float = LLM_RETRY_BASE_DELAY,
+        max_delay: float = LLM_RETRY_MAX_DELAY,
+        expected_output_tokens: int = LLM_EXPECTED_OUTPUT_TOKENS,
+        sleep: Callable[[float], None] = time.sleep,
+        async_sleep: Callable[[float], Awaitable[None]] = asyncio.sleep,
+    ):
+        """
+        LLM呼び出しの実行制御の初期化
+
+        Args:
+            rate_limiter: レート制限（Noneの場合は新しく作成）
+            circuit_breaker: サーキットブレーカー（Noneの場合は新しく作成）
+            max_retries: 最大再試行回数
+            base_delay: バックオフの基準秒数
+            max_delay: バックオフの最大秒数（Retry-Afterの指定は除く）
+            expected_output_tokens: レート制限の見積もりに加える応答のトークン数
+            sleep: 同期呼び出しで待機する関数
+            async_sleep: 非同期呼び出しで待機する関数
+        """
+        self.rate_limiter = rate_limiter or LLMRateLimiter()
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.expected_output_tokens = expected_output_tokens
+        self._sleep = sleep
+        self._async_sleep = async_sleep
+
+    def backoff_delay(self, attempt: int, error: Exception) -> float:
+        """
+        再試行までの待機秒数を計算する
+
+        Args:
+            attempt: 失敗した試行の番号（0から）
+            error: 失敗の原因の例外
+
+        Returns:
+            待機秒数
+        """
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def call(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        request: Callable[[], Any],
+    ) -> Any:
+        """
+        LLMを同期的に呼び出す
+
+        Args:
+            model: LiteLLMのモデル名
+            messages: LLMに送信するメッセージリスト
+            request: LLMを呼び出して応答を返す関数
+
+        Returns:
+            LLMの応答
+
+        Raises:
+            CircuitOpenError: プロバイダーのサーキットが開いている場合
+            Exception: 再試行できない障害、または再試行回数を超えた場合の最後の例外
+        """
+        provider = get_llm_provider(model)
+        tokens = self._estimate_tokens(messages)
+        attempt = 0
+        while True:
+            trial = self.circuit_breaker.before_call(provider)
+            try:
+                wait = self.rate_limiter.reserve(model, tokens)
+                if wait > 0:
+                    self._sleep(wait)
+                try:
+                    response = request()
+                except Exception as e:
+                    delay = self._handle_failure(provider, attempt, e)
+                else:
+                    self._handle_success(model, provider, tokens, response)
+                    return response
+            finally:
+                if trial:
+                    self.circuit_breaker.release_trial(provider)
+            self._sleep(delay)
+            attempt += 1
+
+    async def acall(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        request: Callable[[], Awaitable[Any]],
+    ) -> Any:
+        """
+        LLMを非同期に呼び出す
+
+        Args:
+            model: LiteLLMのモデル名
+            messages: LLMに送信するメッセージリスト
+            request: LLMを呼び出して応答を返すコルーチン関数
+
+        Returns:
+            LLMの応答
+
+        Raises:
+            CircuitOpenError: プロバイダーのサーキットが開いている場合
+            Exception: 再試行できない障害、または再試行回数を超えた場合の最後の例外
+        """
+        provider = get_llm_provider(model)
+        tokens = self._estimate_tokens(messages)
+        attempt = 0
+        while True:
+            trial = self.circuit_breaker.before_call(provider)
+            try:
+                wait = self.rate_limiter.reserve(model, tokens)
+                if wait > 0:
+                    await self._async_sleep(wait)
+                try:
+                    response = await request()
+                except Exception as e:
+                    delay = self._handle_failure(provider, attempt, e)
+                else:
+                    self._handle_success(model, provider, tokens, response)
+                    return response
+            finally:
+                # キャンセルされた場合も試行を終了し、サーキットが開いたままにならないようにする
+                if trial:
+                    self.circuit_breaker.release_trial(provider)
+            await self._async_sleep(delay)
+            attempt += 1
+
+    def _estimate_tokens(self, messages: List[Dict[str, str]]) -> int:
+        return self.expected_output_tokens + sum(
+            estimate_tokens(message.get("content", "")) for message in messages
+        )
+
+    def _handle_success(
+        self, model: str, provider: str, tokens: int, response: Any
+    ) -> None:
+        self.circuit_breaker.record_success(provider)
+        usage = getattr(response, "usage", None)
+        total_tokens = getattr(usage, "total_tokens", None)
+        if isinstance(total_tokens, int):
+            self.rate_limiter.record_usage(model, tokens, total_tokens)
+
+    def _handle_failure(self, provider: str, attempt: int, error: Exception) -> float:
+        """
+        失敗を記録し、再試行する場合は待機秒数を返す（再試行しない場合は例外を送出する）
+        """
+        retryable = is_retryable_error(error)
+        status_code = getattr(error, "status_code", None)
+        if (
+            isinstance(status_code, int)
+            and 400 <= status_code < 500
+            and (not retryable or status_code == 429)
+        ):
+            # プロバイダーが4xxで応答しているためサーキットの障害には数えない
+            self.circuit_breaker.record_success(provider)
+        else:
+            # 分類できない例外はプロバイダーが応答したとは限らないため障害として扱う
+            self.circuit_breaker.record_failure(provider)
+
+        if not retryable or attempt >= self.max_retries:
+            raise error
+        return self.backoff_delay(attempt, error)
+
+
+# アプリケーション全体で共有するLLM呼び出しの実行制御
+llm_call_controller = LLMCallController()
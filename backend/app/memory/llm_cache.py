@@ -0,0 +1,337 @@
+"""
+LLM応答のディスクキャッシュ
+
+(モデル, プロンプトのバージョン, メッセージ)のハッシュをキーとしてLLMの応答を
+SQLiteファイルに保存し、睡眠処理の再実行時に同じプロンプトの呼び出しを省略する。
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.core.prompts import PROMPT_TEMPLATE_VERSION
+
+logger = logging.getLogger(__name__)
+
+# 保存する応答の合計サイズの上限（バイト）と有効期間（秒）
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_TTL_SECONDS = 30 * 24 * 60 * 60
+
+# 環境変数でキャッシュファイルのパスを指定した場合のみ共有キャッシュを有効にする
+LLM_RESPONSE_CACHE_PATH = os.environ.get("LLM_RESPONSE_CACHE_PATH")
+
+
+def make_cache_key(
+    model: str,
+    messages: List[Dict[str, str]],
+    template_version: str = PROMPT_TEMPLATE_VERSION,
+) -> str:
+    """
+    LLM呼び出しのキャッシュキーを作成する
+
+    Args:
+        model: LiteLLMのモデル名
+        messages: LLMに送信するメッセージリスト
+        template_version: プロンプトのバージョン
+
+    Returns:
+        SHA-256の16進文字列
+    """
+    payload = json.dumps(
+        [model, template_version, messages], ensure_ascii=False, sort_keys=True
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    """LLM応答キャッシュ
+
+    応答をSQLiteファイルに保存し、有効期間を過ぎた応答は破棄する。
+    合計サイズが上限を超えた場合は最も長く参照されていない応答から削除する。
+    読み書き中のSQLiteのエラー（ロック中など）はログに記録し、取得はミス、
+    保存は何もしなかったものとして扱う（キャッシュの障害でLLM呼び出しを失敗させない）。
+
+    保存のたびに表全体を集計しないよう、応答の合計サイズは開いた時点の値から
+    追加・削除の差分で更新する（他のプロセスによる書き込みは次に開いた時点で反映される）。
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        ttl_seconds: Optional[float] = DEFAULT_TTL_SECONDS,
+    ):
+        """
+        LLM応答キャッシュの初期化
+
+        Args:
+            path: SQLiteファイルのパス（":memory:"の場合はメモリ上）
+            max_bytes: 保存する応答の合計サイズの上限
+            ttl_seconds: 応答の有効期間（秒、Noneの場合は無期限）
+        """
+        if max_bytes <= 0:
+            raise ValueError(f"無効なキャッシュサイズです: {max_bytes}")
+
+        directory = os.path.dirname(path)
+        if path != ":memory:" and directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS llm_responses (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_llm_responses_accessed_at "
+            "ON llm_responses (accessed_at)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_llm_responses_created_at "
+            "ON llm_responses (created_at)"
+        )
+        self._conn.commit()
+        (self._total_bytes,) = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM llm_responses"
+        ).fetchone()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_saved = 0
+        self.errors = 0
+
+    def get(self, model: str, messages: List[Dict[str, str]]) -> Optional[str]:
+        """
+        キャッシュされた応答を取得する
+
+        Args:
+            model: LiteLLMのモデル名
+            messages: LLMに送信するメッセージリスト
+
+        Returns:
+            キャッシュされた応答、存在しないか期限切れの場合はNone
+        """
+        key = make_cache_key(model, messages)
+        now = time.time()
+        with self._lock:
+            try:
+                row = self._conn.execute(
+                    "SELECT response, size, created_at FROM llm_responses "
+                    "WHERE key = ?",
+                    (key,),
+                ).fetchone()
+            except sqlite3.Error as e:
+                self._record_error("取得", e)
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+
+            response, size, created_at = row
+            if self.ttl_seconds is not None and now - created_at > self.ttl_seconds:
+                if self._write("DELETE FROM llm_responses WHERE key = ?", (key,)):
+                    self._total_bytes -= size
+                self.misses += 1
+                return None
+
+            # 参照日時の更新に失敗しても取得した応答は返す
+            self._write(
+                "UPDATE llm_responses SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            self.hits += 1
+            # 送信しなかったプロンプトと受信しなかった応答のバイト数
+            self.bytes_saved += size + _messages_size(messages)
+            return response
+
+    def put(self, model: str, messages: List[Dict[str, str]], response: str) -> None:
+        """
+        応答をキャッシュに保存する
+
+        Args:
+            model: LiteLLMのモデル名
+            messages: LLMに送信したメッセージリスト
+            response: LLMの応答
+        """
+        if not response:
+            return
+
+        key = make_cache_key(model, messages)
+        size = len(response.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+
+        now = time.time()
+        with self._lock:
+            try:
+                replaced = self._conn.execute(
+                    "SELECT size FROM llm_responses WHERE key = ?", (key,)
+                ).fetchone()
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO llm_responses "
+                    "(key, model, response, size, created_at, accessed_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, model, response, size, now, now),
+                )
+                total = self._total_bytes + size - (replaced[0] if replaced else 0)
+                total, evicted = self._evict(now, total)
+                self._conn.commit()
+            except sqlite3.Error as e:
+                self._record_error("保存", e)
+                return
+            # コミットに成功した場合のみ合計サイズと統計に反映する
+            self._total_bytes = total
+            self.evictions += evicted
+
+    def clear(self) -> None:
+        """
+        すべての応答と統計情報を削除する
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM llm_responses")
+            self._conn.commit()
+            self._total_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.bytes_saved = 0
+            self.errors = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        キャッシュの統計情報を取得する
+
+        Returns:
+            ヒット数・ミス数・ヒット率・追い出し数・節約したバイト数・エラー数・現在のサイズ
+        """
+        with self._lock:
+            entries, size_bytes = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_responses"
+            ).fetchone()
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "bytes_saved": self.bytes_saved,
+                "errors": self.errors,
+                "entries": entries,
+                "size_bytes": size_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def close(self) -> None:
+        """
+        キャッシュファイルを閉じる
+        """
+        with self._lock:
+            self._conn.close()
+
+    def _write(self, sql: str, parameters: tuple) -> bool:
+        """
+        1文の書き込みをコミットする（失敗した場合はエラーを記録する）
+
+        Returns:
+            コミットに成功したかどうか
+        """
+        try:
+            self._conn.execute(sql, parameters)
+            self._conn.commit()
+        except sqlite3.Error as e:
+            self._record_error("更新", e)
+            return False
+        return True
+
+    def _record_error(self, operation: str, error: sqlite3.Error) -> None:
+        """
+        SQLiteのエラーを記録し、途中までの変更を取り消す（ロックを保持した状態で呼び出す）
+        """
+        self.errors += 1
+        logger.warning("LLM応答キャッシュの%sに失敗しました: %s", operation, error)
+        try:
+            self._conn.rollback()
+        except sqlite3.Error:
+            pass
+
+    def _evict(self, now: float, total: int) -> Tuple[int, int]:
+        """
+        期限切れの応答と合計サイズの上限を超えた分の応答を削除する
+        （ロックを保持した状態で、コミットの前に呼び出す）
+
+        Args:
+            now: 現在時刻
+            total: 削除前の応答の合計サイズ
+
+        Returns:
+            (削除後の応答の合計サイズ, 削除した応答の数)
+        """
+        evicted = 0
+        if self.ttl_seconds is not None:
+            cutoff = now - self.ttl_seconds
+            expired_count, expired_bytes = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_responses "
+                "WHERE created_at < ?",
+                (cutoff,),
+            ).fetchone()
+            if expired_count:
+                self._conn.execute(
+                    "DELETE FROM llm_responses WHERE created_at < ?", (cutoff,)
+                )
+                evicted += expired_count
+                total -= expired_bytes
+
+        if total <= self.max_bytes:
+            return total, evicted
+
+        # 最も長く参照されていない応答から上限を下回るまで削除する
+        expired = []
+        for key, size in self._conn.execute(
+            "SELECT key, size FROM llm_responses ORDER BY accessed_at"
+        ):
+            expired.append((key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+        self._conn.executemany("DELETE FROM llm_responses WHERE key = ?", expired)
+        return total, evicted + len(expired)
+
+
+def _messages_size(messages: List[Dict[str, str]]) -> int:
+    return sum(len(message.get("content", "").encode("utf-8")) for message in messages)
+
+
+_shared_cache: Optional[LLMResponseCache] = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_llm_response_cache() -> Optional[LLMResponseCache]:
+    """
+    アプリケーション全体で共有するLLM応答キャッシュを取得する
+
+    Returns:
+        LLM_RESPONSE_CACHE_PATH で指定したファイルのキャッシュ、未設定の場合はNone
+    """
+    global _shared_cache
+    if not LLM_RESPONSE_CACHE_PATH:
+        return None
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = LLMResponseCache(LLM_RESPONSE_CACHE_PATH)
+        return _shared_cache
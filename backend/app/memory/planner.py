@@ -0,0 +1,184 @@
+"""
+睡眠処理の追いつき計画
+
+キャラクターの既存の記憶と現在の日までに期待される記憶階層を比較し、
+不足している要約とその依存関係（daily_summary → level_10 → level_100 → …）を
+有向非巡回グラフとして作成する。
+"""
+
+from collections import defaultdict
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from app.core.constants import (
+    LEVEL_ARCHIVE_MODE_INCREMENTAL,
+    MEMORY_TYPE_DAILY_RAW,
+    MEMORY_TYPE_DAILY_SUMMARY,
+    MEMORY_TYPE_LEVEL_10,
+    MEMORY_TYPE_LEVEL_100,
+    MEMORY_TYPE_LEVEL_1000,
+    MEMORY_TYPE_LEVEL_ARCHIVE,
+)
+
+# 階層的要約の記憶タイプと周期（日）を下位の階層から順に並べたもの
+SUMMARY_PERIODS = [
+    (MEMORY_TYPE_LEVEL_10, 10),
+    (MEMORY_TYPE_LEVEL_100, 100),
+    (MEMORY_TYPE_LEVEL_1000, 1000),
+]
+
+
+class SummaryTask(NamedTuple):
+    """生成する要約（記憶タイプと期間）"""
+
+    memory_type: str
+    start_day: int
+    end_day: int
+
+
+def build_catch_up_plan(
+    periods: Iterable[Tuple[str, int, int]],
+    current_day: int,
+    archive_mode: str = LEVEL_ARCHIVE_MODE_INCREMENTAL,
+) -> Dict[SummaryTask, Set[SummaryTask]]:
+    """
+    現在の日までに不足している要約の依存関係グラフを作成する
+
+    daily_rawがある日のdaily_summaryと、入力となる下位の要約がある期間の
+    階層的要約のうち、存在しないものを生成対象とする。既存の要約でも
+    入力となる下位の要約を新しく生成する場合は、再生成の対象とする。
+
+    Args:
+        periods: 既存の記憶の(記憶タイプ, 開始日, 終了日)のリスト
+        current_day: 現在の日
+        archive_mode: 長期archiveの生成方法（incremental の場合は、
+            直前のarchiveに続くlevel_1000ごとにarchiveを順に生成する）
+
+    Returns:
+        生成する要約ごとの、先に生成する必要がある要約の集合
+    """
+    existing: Dict[str, Set[Tuple[int, int]]] = defaultdict(set)
+    for memory_type, start_day, end_day in periods:
+        if 1 <= start_day and end_day <= current_day:
+            existing[memory_type].add((start_day, end_day))
+
+    graph: Dict[SummaryTask, Set[SummaryTask]] = {}
+
+    # daily_rawがある日のdaily_summary
+    available = set(existing[MEMORY_TYPE_DAILY_SUMMARY])
+    planned: Dict[Tuple[int, int], SummaryTask] = {}
+    for day, _ in sorted(
+        period for period in existing[MEMORY_TYPE_DAILY_RAW] if period[0] == period[1]
+    ):
+        if (day, day) not in available:
+            task = SummaryTask(MEMORY_TYPE_DAILY_SUMMARY, day, day)
+            graph[task] = set()
+            planned[(day, day)] = task
+            available.add((day, day))
+
+    # 下位の要約がある期間の階層的要約
+    for memory_type, period in SUMMARY_PERIODS:
+        inputs_by_index: Dict[int, List[Tuple[int, int]]] = defaultdict(list)
+        for start_day, end_day in available:
+            inputs_by_index[(end_day - 1) // period].append((start_day, end_day))
+
+        lower_planned = planned
+        available = set(existing[memory_type])
+        planned = {}
+        for end_day in range(period, current_day + 1, period):
+            start_day = max(1, end_day - period + 1)
+            inputs = [
+                input_period
+                for input_period in inputs_by_index.get((end_day - 1) // period, [])
+                if input_period[0] >= start_day
+            ]
+            if not inputs:
+                continue
+
+            dependencies = {
+                lower_planned[input_period]
+                for input_period in inputs
+                if input_period in lower_planned
+            }
+            if (start_day, end_day) in available and not dependencies:
+                continue
+
+            task = SummaryTask(memory_type, start_day, end_day)
+            graph[task] = dependencies
+            planned[(start_day, end_day)] = task
+            available.add((start_day, end_day))
+
+    # 複数のlevel_1000をまとめた長期archive
+    if archive_mode == LEVEL_ARCHIVE_MODE_INCREMENTAL:
+        graph.update(
+            _plan_rolling_archives(
+                existing[MEMORY_TYPE_LEVEL_ARCHIVE], available, planned
+            )
+        )
+    elif current_day > 1000 and planned and len(available) >= 2:
+        task = SummaryTask(
+            MEMORY_TYPE_LEVEL_ARCHIVE,
+            min(start_day for start_day, _ in available),
+            max(end_day for _, end_day in available),
+        )
+        graph[task] = set(planned.values())
+
+    return graph
+
+
+def _plan_rolling_archives(
+    archives: Set[Tuple[int, int]],
+    blocks: Set[Tuple[int, int]],
+    planned_blocks: Dict[Tuple[int, int], SummaryTask],
+) -> Dict[SummaryTask, Set[SummaryTask]]:
+    """
+    直前のarchiveにlevel_1000を1件ずつ統合するarchiveの依存関係グラフを作成する
+
+    新しく生成するlevel_1000より前に終わる最新のarchiveを起点とし、
+    それ以降のlevel_1000ごとに、1つ前のarchiveとそのlevel_1000を入力とする
+    archiveを生成する。archiveがない場合は最初の2件のlevel_1000から生成する。
+
+    Args:
+        archives: 既存のarchiveの(開始日, 終了日)の集合
+        blocks: 既存と生成予定のlevel_1000の(開始日, 終了日)の集合
+        planned_blocks: 生成予定のlevel_1000
+
+    Returns:
+        生成するarchiveごとの、先に生成する必要がある要約の集合
+    """
+    cut = max((end_day for _, end_day in archives), default=0)
+    if planned_blocks:
+        cut = min(cut, min(end_day for _, end_day in planned_blocks) - 1)
+    previous = max(
+        (period for period in archives if period[1] <= cut),
+        key=lambda period: period[1],
+        default=None,
+    )
+
+    graph: Dict[SummaryTask, Set[SummaryTask]] = {}
+    previous_task: Optional[SummaryTask] = None
+    input_count = 0 if previous is None else 1
+    start_day = None if previous is None else previous[0]
+    dependencies: Set[SummaryTask] = set()
+    for block in sorted(blocks, key=lambda period: period[1]):
+        if previous is not None and block[1] <= previous[1]:
+            continue
+
+        input_count += 1
+        start_day = block[0] if start_day is None else min(start_day, block[0])
+        if block in planned_blocks:
+            dependencies.add(planned_blocks[block])
+        if input_count < 2:
+            continue
+
+        task = SummaryTask(MEMORY_TYPE_LEVEL_ARCHIVE, start_day, block[1])
+        if previous_task is not None:
+            dependencies.add(previous_task)
+        if (start_day, block[1]) in archives and not dependencies:
+            previous_task = None
+        else:
+            graph[task] = dependencies
+            previous_task = task
+        input_count = 1
+        dependencies = set()
+
+    return graph
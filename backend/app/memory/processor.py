@@ -1,22 +1,52 @@
+import asyncio
+import logging
 import uuid
+from contextlib import asynccontextmanager, nullcontext
 from datetime import datetime
-from typing import Any, Dict, List
+from graphlib import TopologicalSorter
+from functools import partial
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    ContextManager,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, sessionmaker
 
 from app.core.constants import (
+    LEVEL_ARCHIVE_MODE_INCREMENTAL,
+    MEMORY_TYPE_DAILY_SUMMARY,
     MEMORY_TYPE_LEVEL_10,
     MEMORY_TYPE_LEVEL_100,
     MEMORY_TYPE_LEVEL_1000,
     MEMORY_TYPE_LEVEL_ARCHIVE,
     SESSION_STATUS_COMPLETED,
+    SESSION_PROP_COMPLETED_STEPS,
+    SESSION_PROP_CURRENT_DAY,
+    SESSION_PROP_RESUMED_FROM,
     SESSION_STATUS_ERROR,
     SESSION_TYPE_SLEEP,
 )
+from app.core.database import SessionLocal
 from app.crud import memory as memory_crud
-from app.crud.session import create_session, end_session
+from app.crud.session import create_session, end_session, get_sessions_by_character
+from app.memory.cache import memory_context_cache
 from app.memory.generator import MemoryGenerator
+from app.memory.llm import LLMConcurrencyLimiter
+from app.memory.planner import SummaryTask, build_catch_up_plan
+from app.memory.routing import ModelRouter
 from app.models import Character, Memory
+from app.models import Session as DbSession
+
+logger = logging.getLogger(__name__)
 
 
 class SleepProcessor:
@@ -30,6 +60,10 @@ class SleepProcessor:
         db: Session,
         character_id: uuid.UUID,
         model: str = "gemini/gemini-2.0-flash",
+        limiter: Optional[LLMConcurrencyLimiter] = None,
+        router: Optional[ModelRouter] = None,
+        batch_writes: bool = False,
+        archive_mode: str = LEVEL_ARCHIVE_MODE_INCREMENTAL,
     ):
         """
         睡眠中の記憶処理エンジンの初期化
@@ -38,11 +72,21 @@ class SleepProcessor:
             db: データベースセッション
             character_id: キャラクターID
             model: 使用するLLMモデル
+            limiter: 非同期のLLM呼び出しの同時実行数制限（Noneの場合は共有の制限）
+            router: 記憶タイプと入力トークン数ごとのモデルのルーティング
+                （Noneの場合はすべての呼び出しで model を使用する）
+            batch_writes: 睡眠処理1回分の書き込みを最後に1つのトランザクションで
+                コミットするかどうか（途中で失敗した場合は処理全体が破棄されるため、
+                ステップごとの進捗の記録も最後にまとめてコミットされる）
+            archive_mode: 長期archiveの生成方法（incremental または full）
         """
         self.db = db
+        self.batch_writes = batch_writes
         self.character_id = character_id
         self.model = model
-        self.memory_generator = MemoryGenerator(db, character_id, model)
+        self.memory_generator = MemoryGenerator(
+            db, character_id, model, limiter, router=router, archive_mode=archive_mode
+        )
 
         self.character = (
             db.query(Character).filter(Character.id == character_id).first()
@@ -51,92 +95,430 @@ class SleepProcessor:
             raise ValueError(f"キャラクターID {character_id} が見つかりません")
         self.user_id = self.character.user_id
 
-    def process_daily_memories(self, current_day: int) -> List[Memory]:
+    def _iter_summary_steps(self, current_day: int) -> Iterator[Tuple[str, int, int]]:
         """
-        睡眠セッション中に記憶を処理する
+        現在の日に生成する階層的要約を生成順に列挙する
+
+        長期archiveの範囲は直前のlevel_1000生成後の記憶から計算するため、
+        前の要約を生成してから次の要素を取得する必要がある。
 
         Args:
             current_day: 現在の日
 
         Returns:
-            処理された記憶のリスト
+            (記憶タイプ, 開始日, 終了日)のイテレータ
         """
-        processed_memories = []
-
-        # daily_summaryの生成
-        daily_summary = self.memory_generator.generate_daily_summary(current_day)
-        if daily_summary:
-            processed_memories.append(daily_summary)
-
         # 10日ごとのlevel_10生成
         if current_day > 0 and current_day % 10 == 0:
-            level_10_memory = self.memory_generator.generate_hierarchical_summary(
-                MEMORY_TYPE_LEVEL_10,
-                start_day=max(1, current_day - 9),
-                end_day=current_day,
-            )
-            if level_10_memory:
-                processed_memories.append(level_10_memory)
+            yield MEMORY_TYPE_LEVEL_10, max(1, current_day - 9), current_day
 
         # 100日ごとのlevel_100生成
         if current_day > 0 and current_day % 100 == 0:
-            level_100_memory = self.memory_generator.generate_hierarchical_summary(
-                MEMORY_TYPE_LEVEL_100,
-                start_day=max(1, current_day - 99),
-                end_day=current_day,
-            )
-            if level_100_memory:
-                processed_memories.append(level_100_memory)
+            yield MEMORY_TYPE_LEVEL_100, max(1, current_day - 99), current_day
 
         # 1000日ごとのlevel_1000生成
         if current_day > 0 and current_day % 1000 == 0:
-            level_1000_memory = self.memory_generator.generate_hierarchical_summary(
-                MEMORY_TYPE_LEVEL_1000,
-                start_day=max(1, current_day - 999),
-                end_day=current_day,
-            )
-            if level_1000_memory:
-                processed_memories.append(level_1000_memory)
+            yield MEMORY_TYPE_LEVEL_1000, max(1, current_day - 999), current_day
 
         # 長期archive記憶生成（複数のlevel_1000から）
-        if current_day > 1000 and current_day % 1000 == 0:
-            level_1000_memories = memory_crud.get_memories_by_character(
+        if (
+            current_day > 1000
+            and current_day % 1000 == 0
+            and self.memory_generator.archive_mode == LEVEL_ARCHIVE_MODE_INCREMENTAL
+        ):
+            # 直前のarchiveに新しいlevel_1000を統合する
+            inputs = self.memory_generator.get_rolling_archive_inputs(current_day)
+            if len(inputs) >= 2:
+                yield (
+                    MEMORY_TYPE_LEVEL_ARCHIVE,
+                    min(memory.start_day for memory in inputs),
+                    current_day,
+                )
+        elif current_day > 1000 and current_day % 1000 == 0:
+            # 全履歴を順次走査して件数と日付範囲のみを集計する
+            level_1000_count = 0
+            min_start_day = None
+            max_end_day = None
+            for memory in memory_crud.iter_memories_by_character(
                 db=self.db,
                 character_id=self.character_id,
                 memory_type=MEMORY_TYPE_LEVEL_1000,
-            )
+            ):
+                level_1000_count += 1
+                if min_start_day is None or memory.start_day < min_start_day:
+                    min_start_day = memory.start_day
+                if max_end_day is None or memory.end_day > max_end_day:
+                    max_end_day = memory.end_day
+
+            if level_1000_count >= 2:
+                yield MEMORY_TYPE_LEVEL_ARCHIVE, min_start_day, max_end_day
+
+    def _finish_processing(self) -> None:
+        """
+        記憶処理の完了を記録する
+        """
+        # 最終記憶処理日時を更新
+        self.character.last_memory_processing_date = datetime.now()
+        memory_crud.commit_writes(self.db)
+
+        # 睡眠処理で記憶が変わったためキャッシュ済みのコンテキストを破棄
+        memory_crud.after_commit(
+            self.db, partial(memory_context_cache.invalidate, self.character_id)
+        )
+
+    def _write_scope(self) -> ContextManager:
+        """
+        睡眠処理1回分の書き込みの範囲（batch_writes の場合は1つのトランザクション）
+        """
+        if self.batch_writes:
+            return memory_crud.batched_writes(self.db)
+        return nullcontext()
+
+    @asynccontextmanager
+    async def _awrite_scope(self) -> AsyncIterator[None]:
+        """
+        _write_scope の開始と終了（batch_writes の場合はコミット）をスレッドで実行する
+        """
+        scope = self._write_scope()
+        run_db = self.memory_generator.run_db
+        await run_db(scope.__enter__)
+        try:
+            yield
+        except BaseException as e:
+            if not await run_db(scope.__exit__, type(e), e, e.__traceback__):
+                raise
+        else:
+            await run_db(scope.__exit__, None, None, None)
+
+    def _iter_steps(self, current_day: int) -> Iterator[SummaryTask]:
+        """
+        現在の日の睡眠処理のステップ（daily_summaryと階層的要約）を生成順に列挙する
+        """
+        yield SummaryTask(MEMORY_TYPE_DAILY_SUMMARY, current_day, current_day)
+        for step in self._iter_summary_steps(current_day):
+            yield SummaryTask(*step)
+
+    def _record_step(self, session: Optional[DbSession], step: str) -> None:
+        """
+        ステップの完了を睡眠セッションのプロパティに記録する
+
+        コミットは行わないため、要約の保存と同じトランザクションで記録される。
+        """
+        if session is None:
+            return
+
+        properties = dict(session.properties or {})
+        completed_steps = list(properties.get(SESSION_PROP_COMPLETED_STEPS, []))
+        if step in completed_steps:
+            return
+        completed_steps.append(step)
+        properties[SESSION_PROP_COMPLETED_STEPS] = completed_steps
+        session.properties = properties
+
+    def _get_completed_step(
+        self, session: Optional[DbSession], step: SummaryTask
+    ) -> Tuple[bool, Optional[Memory]]:
+        """
+        ステップが睡眠セッションで完了済みかを確認する
+
+        Returns:
+            (完了済みかどうか, 完了済みの場合は保存済みの要約)
+        """
+        if session is None or _step_key(step) not in (session.properties or {}).get(
+            SESSION_PROP_COMPLETED_STEPS, []
+        ):
+            return False, None
+
+        existing = memory_crud.get_memories_for_range(self.db, self.character_id, *step)
+        return True, existing[0] if existing else None
 
-            if len(level_1000_memories) >= 2:
-                min_start_day = min(mem.start_day for mem in level_1000_memories)
-                max_end_day = max(mem.end_day for mem in level_1000_memories)
+    def _finish_step(
+        self, session: Optional[DbSession], step: SummaryTask, memory: Optional[Memory]
+    ) -> None:
+        """
+        要約を保存せずに完了したステップ（入力が変わっていない場合）の完了を記録する
+        """
+        if memory and session is not None:
+            self._record_step(session, _step_key(step))
+            memory_crud.commit_writes(self.db)
+
+    def process_daily_memories(
+        self, current_day: int, session: Optional[DbSession] = None
+    ) -> List[Memory]:
+        """
+        睡眠セッション中に記憶を処理する
+
+        session を指定した場合、各ステップの完了を要約の保存と同じトランザクションで
+        セッションのプロパティに記録し、完了済みのステップはLLMを呼び出さずに飛ばす。
+
+        Args:
+            current_day: 現在の日
+            session: 進捗を記録する睡眠セッション（オプション）
+
+        Returns:
+            処理された記憶のリスト
+        """
+        processed_memories = []
 
-                level_archive_memory = (
-                    self.memory_generator.generate_hierarchical_summary(
-                        MEMORY_TYPE_LEVEL_ARCHIVE,
-                        start_day=min_start_day,
-                        end_day=max_end_day,
+        with self._write_scope():
+            for step in self._iter_steps(current_day):
+                completed, memory = self._get_completed_step(session, step)
+                if not completed:
+                    memory = self._generate_task(
+                        step, partial(self._record_step, session, _step_key(step))
                     )
+                    self._finish_step(session, step, memory)
+                if memory:
+                    processed_memories.append(memory)
+
+            self._finish_processing()
+
+        return processed_memories
+
+    async def aprocess_daily_memories(
+        self, current_day: int, session: Optional[DbSession] = None
+    ) -> List[Memory]:
+        """
+        睡眠セッション中に記憶を非同期に処理する
+
+        1キャラクター内の要約は前の階層の結果に依存するため順に生成する。
+        複数キャラクターの処理は process_daily_memories_for_characters で並行に実行する。
+        データベースの処理はすべてスレッドで実行し、イベントループを止めない。
+
+        Args:
+            current_day: 現在の日
+            session: 進捗を記録する睡眠セッション（オプション）
+
+        Returns:
+            処理された記憶のリスト
+        """
+        processed_memories = []
+        run_db = self.memory_generator.run_db
+
+        async with self._awrite_scope():
+            # 長期archiveのステップは列挙時に記憶を読み込むため、列挙もスレッドで行う
+            steps = self._iter_steps(current_day)
+            while True:
+                step = await run_db(next, steps, None)
+                if step is None:
+                    break
+
+                completed, memory = await run_db(
+                    self._get_completed_step, session, step
                 )
-                if level_archive_memory:
-                    processed_memories.append(level_archive_memory)
+                if not completed:
+                    memory = await self._agenerate_task(
+                        step, partial(self._record_step, session, _step_key(step))
+                    )
+                    await run_db(self._finish_step, session, step, memory)
+                if memory:
+                    processed_memories.append(memory)
 
-        # 最終記憶処理日時を更新
-        self.character.last_memory_processing_date = datetime.now()
-        self.db.commit()
+            await run_db(self._finish_processing)
 
         return processed_memories
 
-    def start_sleep_session(self, current_day: int) -> Dict[str, Any]:
+    def plan_catch_up(self, current_day: int) -> Dict[SummaryTask, Set[SummaryTask]]:
+        """
+        現在の日までに不足している要約の依存関係グラフを作成する
+
+        Args:
+            current_day: 現在の日
+
+        Returns:
+            生成する要約ごとの、先に生成する必要がある要約の集合
+        """
+        periods = memory_crud.get_memory_periods(
+            self.db, self.character_id, max_day=current_day
+        )
+        return build_catch_up_plan(
+            periods, current_day, archive_mode=self.memory_generator.archive_mode
+        )
+
+    def _generate_task(
+        self, task: SummaryTask, checkpoint: Optional[Callable[[], None]] = None
+    ) -> Optional[Memory]:
+        if task.memory_type == MEMORY_TYPE_DAILY_SUMMARY:
+            return self.memory_generator.generate_daily_summary(
+                task.start_day, checkpoint
+            )
+        return self.memory_generator.generate_hierarchical_summary(
+            task.memory_type,
+            start_day=task.start_day,
+            end_day=task.end_day,
+            checkpoint=checkpoint,
+        )
+
+    async def _agenerate_task(
+        self, task: SummaryTask, checkpoint: Optional[Callable[[], None]] = None
+    ) -> Optional[Memory]:
+        if task.memory_type == MEMORY_TYPE_DAILY_SUMMARY:
+            return await self.memory_generator.agenerate_daily_summary(
+                task.start_day, checkpoint
+            )
+        return await self.memory_generator.agenerate_hierarchical_summary(
+            task.memory_type,
+            start_day=task.start_day,
+            end_day=task.end_day,
+            checkpoint=checkpoint,
+        )
+
+    def catch_up_memories(self, current_day: int) -> List[Memory]:
+        """
+        睡眠処理が行われなかった日を含め、現在の日までに不足している要約を生成する
+
+        要約は依存関係の順に1件ずつ生成する。生成に失敗した要約に依存する
+        要約は生成せず、次回の追いつき処理で再び計画される。LLMの呼び出しが
+        失敗した場合も依存関係のない要約の生成は続け、生成できた要約を保存
+        してから最初のエラーを送出する。
+
+        Args:
+            current_day: 現在の日
+
+        Returns:
+            生成された記憶のリスト（生成順）
+        """
+        processed_memories = []
+        failed = set()
+        errors: List[Exception] = []
+        with self._write_scope():
+            graph = self.plan_catch_up(current_day)
+            for task in TopologicalSorter(graph).static_order():
+                if graph[task] & failed:
+                    failed.add(task)
+                    continue
+
+                try:
+                    memory = self._generate_task(task)
+                except Exception as e:
+                    _log_task_failure(task, e)
+                    errors.append(e)
+                    memory = None
+                if memory:
+                    processed_memories.append(memory)
+                else:
+                    failed.add(task)
+
+            self._finish_processing()
+
+        if errors:
+            raise errors[0]
+        return processed_memories
+
+    async def acatch_up_memories(self, current_day: int) -> List[Memory]:
+        """
+        現在の日までに不足している要約を依存関係グラフに沿って非同期に生成する
+
+        依存する要約がすべて生成された要約から順に並行して生成するため、
+        同じ階層の要約と、依存関係のない別の期間の上位の要約のLLM呼び出しが
+        重なる。同時実行数は limiter の上限で制御する。データベースの処理は
+        すべてスレッドで1つずつ実行し、イベントループを止めない。失敗した要約の
+        扱いは catch_up_memories と同じ。
+
+        Args:
+            current_day: 現在の日
+
+        Returns:
+            生成された記憶のリスト（生成が完了した順）
+        """
+        run_db = self.memory_generator.run_db
+        graph = await run_db(self.plan_catch_up, current_day)
+        sorter = TopologicalSorter(graph)
+        sorter.prepare()
+        processed_memories = []
+        failed = set()
+        errors: List[Exception] = []
+        pending: Dict[asyncio.Future, SummaryTask] = {}
+        async with self._awrite_scope():
+            try:
+                while sorter.is_active():
+                    for task in sorter.get_ready():
+                        if graph[task] & failed:
+                            failed.add(task)
+                            sorter.done(task)
+                        else:
+                            pending[
+                                asyncio.ensure_future(self._agenerate_task(task))
+                            ] = task
+                    if not pending:
+                        continue
+
+                    done, _ = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for future in done:
+                        task = pending.pop(future)
+                        try:
+                            memory = future.result()
+                        except Exception as e:
+                            _log_task_failure(task, e)
+                            errors.append(e)
+                            memory = None
+                        if memory:
+                            processed_memories.append(memory)
+                        else:
+                            failed.add(task)
+                        sorter.done(task)
+            finally:
+                for future in pending:
+                    future.cancel()
+
+            await run_db(self._finish_processing)
+
+        if errors:
+            raise errors[0]
+        return processed_memories
+
+    def _find_resumable_session(self, current_day: int) -> Optional[DbSession]:
+        """
+        同じ日の処理中にエラーで終了した直前の睡眠セッションを取得する
+
+        Args:
+            current_day: 現在の日
+
+        Returns:
+            再開できる睡眠セッション、ない場合はNone
+        """
+        sessions = get_sessions_by_character(
+            self.db, self.character_id, session_type=SESSION_TYPE_SLEEP, limit=1
+        )
+        if not sessions:
+            return None
+
+        previous = sessions[0]
+        properties = previous.properties or {}
+        if (
+            previous.status == SESSION_STATUS_ERROR
+            and properties.get(SESSION_PROP_CURRENT_DAY) == current_day
+        ):
+            return previous
+        return None
+
+    def start_sleep_session(
+        self, current_day: int, resume: bool = True
+    ) -> Dict[str, Any]:
         """
         睡眠セッションを開始し、記憶処理を実行する
 
+        同じ日の直前の睡眠セッションがエラーで終了していた場合は、その完了済みの
+        ステップを引き継ぎ、最初の未完了のステップから処理を再開する。
+
         Args:
             current_day: 現在の日
+            resume: エラーで終了した睡眠セッションから再開するかどうか
 
         Returns:
             処理結果の要約
         """
         try:
+            properties = {SESSION_PROP_CURRENT_DAY: current_day}
+            previous = self._find_resumable_session(current_day) if resume else None
+            if previous is not None:
+                properties[SESSION_PROP_COMPLETED_STEPS] = list(
+                    previous.properties.get(SESSION_PROP_COMPLETED_STEPS, [])
+                )
+                properties[SESSION_PROP_RESUMED_FROM] = str(previous.id)
+
             # 睡眠セッションを作成
             session = create_session(
                 db=self.db,
@@ -144,11 +526,13 @@ class SleepProcessor:
                 character_id=self.character_id,
                 device_id="system",  # システム処理用のデバイスID
                 session_type=SESSION_TYPE_SLEEP,
-                properties={"current_day": current_day},
+                properties=properties,
             )
 
-            # 記憶処理を実行
-            processed_memories = self.process_daily_memories(current_day)
+            # 記憶処理を実行（各ステップの完了をセッションに記録する）
+            processed_memories = self.process_daily_memories(
+                current_day, session=session
+            )
 
             # セッションを完了状態に更新
             end_session(
@@ -173,8 +557,12 @@ class SleepProcessor:
                     mem.memory_type for mem in processed_memories
                 ],
                 "processing_date": datetime.now().isoformat(),
+                "resumed_from": str(previous.id) if previous is not None else None,
             }
         except Exception as e:
+            # 保存に失敗したステップの完了を記録しないよう未コミットの変更を破棄
+            self.db.rollback()
+
             # エラーが発生した場合、セッションをエラー状態で終了
             if "session" in locals():
                 end_session(
@@ -189,3 +577,65 @@ class SleepProcessor:
                 "character_id": str(self.character_id),
                 "error": str(e),
             }
+
+
+async def process_daily_memories_for_characters(
+    character_ids: List[uuid.UUID],
+    current_day: int,
+    model: str = "gemini/gemini-2.0-flash",
+    limiter: Optional[LLMConcurrencyLimiter] = None,
+    router: Optional[ModelRouter] = None,
+    session_factory: sessionmaker = SessionLocal,
+) -> Dict[uuid.UUID, Union[List[Memory], Exception]]:
+    """
+    複数キャラクターの睡眠中の記憶処理を並行に実行する
+
+    LLM呼び出しの待ち時間を重ね合わせ、同時実行数は limiter の上限で制御する。
+    並行に実行する処理の間でトランザクションが混ざらないよう、キャラクターごとに
+    session_factory で作成したデータベースセッションを使用し、データベースの処理は
+    スレッドで実行するため、キャラクターごとの読み込みと書き込みも重なる。
+    1キャラクターの処理が失敗しても他のキャラクターの処理は続ける。
+
+    Args:
+        character_ids: キャラクターIDのリスト
+        current_day: 現在の日
+        model: 使用するLLMモデル
+        limiter: LLM呼び出しの同時実行数制限（Noneの場合は共有の制限）
+        router: 記憶タイプと入力トークン数ごとのモデルのルーティング
+            （全キャラクターで共有し、ルートごとの統計をまとめて記録する）
+        session_factory: データベースセッションを作成するファクトリ
+
+    Returns:
+        キャラクターIDごとの処理された記憶のリスト（失敗したキャラクターは発生した例外）
+    """
+
+    def refresh_all(db: Session, memories: List[Memory]) -> None:
+        # セッションを閉じた後も属性を参照できるよう読み込んでおく
+        for memory in memories:
+            db.refresh(memory)
+
+    async def process(character_id: uuid.UUID) -> List[Memory]:
+        db = session_factory()
+        try:
+            processor = await asyncio.to_thread(
+                SleepProcessor, db, character_id, model, limiter, router
+            )
+            memories = await processor.aprocess_daily_memories(current_day)
+            await processor.memory_generator.run_db(refresh_all, db, memories)
+            return memories
+        finally:
+            await asyncio.to_thread(db.close)
+
+    results = await asyncio.gather(
+        *(process(character_id) for character_id in character_ids),
+        return_exceptions=True,
+    )
+    return dict(zip(character_ids, results))
+
+
+def _step_key(step: SummaryTask) -> str:
+    return f"{step.memory_type}:{step.start_day}-{step.end_day}"
+
+
+def _log_task_failure(task: SummaryTask, error: Exception) -> None:
+    logger.error("要約 %s の生成に失敗しました: %s", _step_key(task), error)
@@ -1,9 +1,12 @@
 import uuid
-from typing import Dict, List, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 from sqlalchemy.orm import Session
 
 from app.core.constants import (
+    DEFAULT_MEMORY_TOKEN_BUDGET,
+    MEMORY_HIERARCHY,
+    MEMORY_TOKEN_BUDGETS,
     MEMORY_TYPE_DAILY_RAW,
     MEMORY_TYPE_DAILY_SUMMARY,
     MEMORY_TYPE_LEVEL_10,
@@ -12,8 +15,242 @@ from app.core.constants import (
     MEMORY_TYPE_LEVEL_ARCHIVE,
 )
 from app.crud import memory as memory_crud
+from app.memory.cache import MemoryContextCache, memory_context_cache
+from app.memory.embeddings import memory_embedding_store
+from app.memory.scoring import HybridScorer
+from app.memory.search import memory_search_index
+from app.memory.tokens import estimate_tokens
 from app.models import Character, Memory
 
+# 複数キャラクターの一括取得で1回のクエリに含めるキャラクター数
+BATCH_CHUNK_SIZE = 500
+
+# 会話セッションで参照する記憶タイプごとの日付範囲を包含する、現在の日からの相対範囲
+# (記憶タイプ, 開始日の下限として引く日数, 終了日の上限として引く日数)
+# _get_session_windows のすべての範囲を含み、正確な範囲は _bucket_session_memories で判定する
+SESSION_WINDOW_OFFSETS = [
+    (MEMORY_TYPE_DAILY_RAW, 0, 0),
+    (MEMORY_TYPE_DAILY_SUMMARY, 9, 0),
+    (MEMORY_TYPE_LEVEL_10, 100, 10),
+    (MEMORY_TYPE_LEVEL_100, 1000, 101),
+    (MEMORY_TYPE_LEVEL_1000, 10000, 1001),
+    (MEMORY_TYPE_LEVEL_ARCHIVE, None, 10001),
+]
+
+# プロンプト用の記憶テキストの見出しと記憶がない場合のテキスト
+MEMORY_HEADER = "【記憶データ】\n"
+NO_MEMORY_TEXT = "記憶データはありません。"
+
+
+def _format_memory_entry(label: str, content: str) -> str:
+    """
+    プロンプト用に1件の記憶を整形する
+
+    Args:
+        label: 記憶のラベル
+        content: 記憶内容
+
+    Returns:
+        整形された記憶テキスト
+    """
+    return f"--- {label} ---\n{content}\n\n"
+
+
+def _get_session_windows(
+    current_day: int,
+) -> Dict[str, List[Tuple[Optional[int], Optional[int]]]]:
+    """
+    会話セッションで参照する記憶タイプごとの日付範囲を計算する
+
+    Args:
+        current_day: 現在の日
+
+    Returns:
+        記憶タイプごとの(開始日の下限, 終了日の上限)のリスト
+    """
+    windows = {
+        MEMORY_TYPE_DAILY_RAW: [],
+        MEMORY_TYPE_DAILY_SUMMARY: [],
+        MEMORY_TYPE_LEVEL_10: [],
+        MEMORY_TYPE_LEVEL_100: [],
+        MEMORY_TYPE_LEVEL_1000: [],
+        MEMORY_TYPE_LEVEL_ARCHIVE: [],
+    }
+
+    # その日のdaily_raw（あれば）
+    windows[MEMORY_TYPE_DAILY_RAW].append((current_day, current_day))
+
+    # 直近10日分のdaily_summary
+    for day in range(max(1, current_day - 9), current_day + 1):
+        windows[MEMORY_TYPE_DAILY_SUMMARY].append((day, day))
+
+    # 11-100日前の10日単位level_10
+    for start_day in range(max(1, current_day - 100), current_day - 9, 10):
+        end_day = min(start_day + 9, current_day - 10)
+        if start_day <= end_day:
+            windows[MEMORY_TYPE_LEVEL_10].append((start_day, end_day))
+
+    # 101-1000日前の100日単位level_100
+    for start_day in range(max(1, current_day - 1000), current_day - 100, 100):
+        end_day = min(start_day + 99, current_day - 101)
+        if start_day <= end_day:
+            windows[MEMORY_TYPE_LEVEL_100].append((start_day, end_day))
+
+    # 1001日以降の1000日単位level_1000と長期archive
+    if current_day > 1000:
+        # 1001-10000日前のlevel_1000
+        for start_day in range(max(1, current_day - 10000), current_day - 1000, 1000):
+            end_day = min(start_day + 999, current_day - 1001)
+            if start_day <= end_day:
+                windows[MEMORY_TYPE_LEVEL_1000].append((start_day, end_day))
+
+        # 10001日以降のlevel_archive
+        if current_day > 10000:
+            windows[MEMORY_TYPE_LEVEL_ARCHIVE].append((None, current_day - 10001))
+
+    return windows
+
+
+def _get_session_window_bounds(
+    windows: Dict[str, List[Tuple[Optional[int], Optional[int]]]],
+) -> List[Tuple[str, Optional[int], Optional[int]]]:
+    """
+    記憶タイプごとにすべての日付範囲を包含する範囲を計算する
+
+    Args:
+        windows: 記憶タイプごとの(開始日の下限, 終了日の上限)のリスト
+
+    Returns:
+        (記憶タイプ, 開始日の下限, 終了日の上限)のリスト
+    """
+    bounds = []
+    for memory_type, ranges in windows.items():
+        if not ranges:
+            continue
+        starts = [start for start, _ in ranges]
+        lower = None if None in starts else min(starts)
+        upper = max(end for _, end in ranges)
+        bounds.append((memory_type, lower, upper))
+    return bounds
+
+
+def _bucket_session_memories(
+    windows: Dict[str, List[Tuple[Optional[int], Optional[int]]]],
+    candidates: List[Memory],
+) -> Dict[str, List[Memory]]:
+    """
+    開始日の降順に並んだ候補の記憶を日付範囲ごとに振り分ける
+
+    範囲をまたぐ記憶は範囲ごとの個別クエリと同様に除外する。
+
+    Args:
+        windows: 記憶タイプごとの(開始日の下限, 終了日の上限)のリスト
+        candidates: 候補の記憶のリスト
+
+    Returns:
+        階層別の記憶のディクショナリ
+    """
+    buckets = {
+        memory_type: [[] for _ in ranges] for memory_type, ranges in windows.items()
+    }
+    for memory in candidates:
+        ranges = windows.get(memory.memory_type, [])
+        for index, (start_day, end_day) in enumerate(ranges):
+            if (
+                start_day is None or memory.start_day >= start_day
+            ) and memory.end_day <= end_day:
+                buckets[memory.memory_type][index].append(memory)
+                break
+
+    memories = {memory_type: [] for memory_type in windows}
+    for memory_type, type_buckets in buckets.items():
+        for bucket in type_buckets:
+            memories[memory_type].extend(bucket)
+    return memories
+
+
+def _label_session_memories(
+    memories_dict: Dict[str, List[Memory]], current_day: int
+) -> List[Tuple[str, Memory]]:
+    """
+    階層別の記憶にシステムプロンプト用のラベルを付けて整理する
+
+    Args:
+        memories_dict: 階層別の記憶のディクショナリ
+        current_day: 現在の日
+
+    Returns:
+        (記憶タイプのラベル, 記憶オブジェクト)のタプルのリスト
+    """
+    # 整理されたタプルのリストを作成
+    memory_tuples = []
+
+    # daily_rawの追加
+    for memory in memories_dict["daily_raw"]:
+        memory_tuples.append(("今日の記録", memory))
+
+    # daily_summaryの追加
+    for memory in memories_dict["daily_summary"]:
+        days_ago = current_day - memory.start_day
+        if days_ago == 0:
+            label = "今日の記憶"
+        elif days_ago == 1:
+            label = "昨日の記憶"
+        else:
+            label = f"{days_ago}日前の記憶"
+        memory_tuples.append((label, memory))
+
+    # level_10の追加
+    for memory in memories_dict["level_10"]:
+        start_days_ago = current_day - memory.start_day
+        end_days_ago = current_day - memory.end_day
+        label = f"{end_days_ago}〜{start_days_ago}日前の記憶"
+        memory_tuples.append((label, memory))
+
+    # level_100の追加
+    for memory in memories_dict["level_100"]:
+        start_days_ago = current_day - memory.start_day
+        end_days_ago = current_day - memory.end_day
+        label = f"{end_days_ago}〜{start_days_ago}日前の記憶"
+        memory_tuples.append((label, memory))
+
+    # level_1000の追加
+    for memory in memories_dict["level_1000"]:
+        start_days_ago = current_day - memory.start_day
+        end_days_ago = current_day - memory.end_day
+        label = f"{end_days_ago}〜{start_days_ago}日前の記憶"
+        memory_tuples.append((label, memory))
+
+    # level_archiveの追加
+    for memory in memories_dict["level_archive"]:
+        days_ago = current_day - memory.end_day
+        label = f"{days_ago}日以前の記憶"
+        memory_tuples.append((label, memory))
+
+    # 日付順にソート（最新から最古へ）
+    memory_tuples.sort(key=lambda x: x[1].start_day, reverse=True)
+
+    return memory_tuples
+
+
+def _render_memories(memory_tuples: List[Tuple[str, Memory]]) -> str:
+    """
+    ラベル付きの記憶をプロンプト用のテキストに整形する
+
+    Args:
+        memory_tuples: (記憶タイプのラベル, 記憶オブジェクト)のタプルのリスト
+
+    Returns:
+        プロンプト用に整形された記憶テキスト
+    """
+    if not memory_tuples:
+        return NO_MEMORY_TEXT
+
+    # 整形されたテキストを作成
+    return MEMORY_HEADER + "".join(
+        _format_memory_entry(label, memory.content) for label, memory in memory_tuples
+    )
+
 
 class MemoryRetriever:
     """記憶取得エンジン
@@ -38,190 +275,499 @@ class MemoryRetriever:
             raise ValueError(f"キャラクターID {character_id} が見つかりません")
         self.user_id = self.character.user_id
 
-    def get_memories_for_session(self, current_day: int) -> Dict[str, List[Memory]]:
+    def get_memories_for_session(
+        self, current_day: int, single_query: bool = True
+    ) -> Dict[str, List[Memory]]:
         """
         会話セッションに必要な記憶を階層パターンに従って取得する
 
         Args:
             current_day: 現在の日
+            single_query: Trueの場合は全階層の候補を1回のクエリで取得してメモリ上で振り分け、
+                Falseの場合は日付範囲ごとに個別のクエリを発行する
 
         Returns:
             階層別の記憶のディクショナリ
         """
-        memories = {
-            "daily_raw": [],
-            "daily_summary": [],
-            "level_10": [],
-            "level_100": [],
-            "level_1000": [],
-            "level_archive": [],
-        }
+        windows = _get_session_windows(current_day)
+        memories = {memory_type: [] for memory_type in windows}
+
+        if not single_query:
+            for memory_type, ranges in windows.items():
+                for start_day, end_day in ranges:
+                    memories[memory_type].extend(
+                        memory_crud.iter_memories_by_character(
+                            db=self.db,
+                            character_id=self.character_id,
+                            memory_type=memory_type,
+                            start_day=start_day,
+                            end_day=end_day,
+                        )
+                    )
+            return memories
+
+        # 記憶タイプごとに全範囲を包含する条件で1回だけ取得する
+        candidates = memory_crud.get_memories_in_ranges(
+            db=self.db,
+            character_id=self.character_id,
+            ranges=_get_session_window_bounds(windows),
+        )
+        return _bucket_session_memories(windows, candidates)
+
+    def get_memory_metadata_for_session(self, current_day: int) -> Dict[str, List[Any]]:
+        """
+        会話セッションに必要な記憶のメタデータのみを階層パターンに従って取得する
+
+        get_memories_for_session と同じ記憶を選択するが、記憶内容は読み込まず
+        (id, memory_type, start_day, end_day, content_length) の行を返す。
 
-        # その日のdaily_raw（あれば）
-        daily_raw = memory_crud.get_memories_by_character(
+        Args:
+            current_day: 現在の日
+
+        Returns:
+            階層別の記憶のメタデータのディクショナリ
+        """
+        windows = _get_session_windows(current_day)
+        candidates = memory_crud.get_memory_metadata_in_ranges(
             db=self.db,
             character_id=self.character_id,
-            memory_type=MEMORY_TYPE_DAILY_RAW,
-            start_day=current_day,
-            end_day=current_day,
+            ranges=_get_session_window_bounds(windows),
         )
-        memories["daily_raw"].extend(daily_raw)
-
-        # 直近10日分のdaily_summary
-        for day in range(max(1, current_day - 9), current_day + 1):
-            summaries = memory_crud.get_memories_by_character(
-                db=self.db,
-                character_id=self.character_id,
-                memory_type=MEMORY_TYPE_DAILY_SUMMARY,
-                start_day=day,
-                end_day=day,
-            )
-            memories["daily_summary"].extend(summaries)
-
-        # 11-100日前の10日単位level_10
-        for start_day in range(max(1, current_day - 100), current_day - 9, 10):
-            end_day = min(start_day + 9, current_day - 10)
-            if start_day > end_day:
-                continue
-
-            level_10s = memory_crud.get_memories_by_character(
-                db=self.db,
-                character_id=self.character_id,
-                memory_type=MEMORY_TYPE_LEVEL_10,
-                start_day=start_day,
-                end_day=end_day,
-            )
-            memories["level_10"].extend(level_10s)
-
-        # 101-1000日前の100日単位level_100
-        for start_day in range(max(1, current_day - 1000), current_day - 100, 100):
-            end_day = min(start_day + 99, current_day - 101)
-            if start_day > end_day:
-                continue
-
-            level_100s = memory_crud.get_memories_by_character(
-                db=self.db,
-                character_id=self.character_id,
-                memory_type=MEMORY_TYPE_LEVEL_100,
-                start_day=start_day,
-                end_day=end_day,
-            )
-            memories["level_100"].extend(level_100s)
-
-        # 1001日以降の1000日単位level_1000と長期archive
-        if current_day > 1000:
-            # 1001-10000日前のlevel_1000
-            for start_day in range(
-                max(1, current_day - 10000), current_day - 1000, 1000
-            ):
-                end_day = min(start_day + 999, current_day - 1001)
-                if start_day > end_day:
-                    continue
+        return _bucket_session_memories(windows, candidates)
 
-                level_1000s = memory_crud.get_memories_by_character(
-                    db=self.db,
-                    character_id=self.character_id,
-                    memory_type=MEMORY_TYPE_LEVEL_1000,
-                    start_day=start_day,
-                    end_day=end_day,
-                )
-                memories["level_1000"].extend(level_1000s)
-
-            # 10001日以降のlevel_archive
-            if current_day > 10000:
-                archives = memory_crud.get_memories_by_character(
-                    db=self.db,
-                    character_id=self.character_id,
-                    memory_type=MEMORY_TYPE_LEVEL_ARCHIVE,
-                    end_day=current_day - 10001,
-                )
-                memories["level_archive"].extend(archives)
+    def load_memory_contents(self, metadata: List[Any]) -> List[Memory]:
+        """
+        メタデータで選択した記憶の内容を1回のクエリでまとめて取得する
 
-        return memories
+        Args:
+            metadata: 記憶のメタデータ（idを持つ行）のリスト
+
+        Returns:
+            メタデータと同じ順序の記憶オブジェクトのリスト（削除済みの記憶は除く）
+        """
+        memories = memory_crud.get_memories_by_ids(
+            self.db, [row.id for row in metadata]
+        )
+        memories_by_id = {memory.id: memory for memory in memories}
+        return [memories_by_id[row.id] for row in metadata if row.id in memories_by_id]
 
     def get_memories_for_system_prompt(
-        self, current_day: int
+        self,
+        current_day: int,
+        memories_dict: Optional[Dict[str, List[Memory]]] = None,
     ) -> List[Tuple[str, Memory]]:
         """
         システムプロンプト用に整理された記憶のリストを取得する
 
         Args:
             current_day: 現在の日
+            memories_dict: 取得済みの階層別の記憶（Noneの場合はDBから取得）
 
         Returns:
             (記憶タイプのラベル, 記憶オブジェクト)のタプルのリスト
         """
-        memories_dict = self.get_memories_for_session(current_day)
+        if memories_dict is None:
+            memories_dict = self.get_memories_for_session(current_day)
+
+        return _label_session_memories(memories_dict, current_day)
+
+    def rank_memories_for_prompt(
+        self,
+        current_day: int,
+        user_message: Optional[str] = None,
+        scorer: Optional[HybridScorer] = None,
+        top_k: Optional[int] = None,
+        memories_dict: Optional[Dict[str, List[Memory]]] = None,
+    ) -> List[Tuple[str, Memory, float]]:
+        """
+        システムプロンプト用の記憶をハイブリッドスコアの高い順に取得する
 
-        # 整理されたタプルのリストを作成
-        memory_tuples = []
+        経過日数・記憶階層・ユーザーメッセージとの関連度（埋め込みの類似度）を
+        組み合わせたスコアで並べ替える。
 
-        # daily_rawの追加
-        for memory in memories_dict["daily_raw"]:
-            memory_tuples.append(("今日の記録", memory))
+        Args:
+            current_day: 現在の日
+            user_message: 現在のユーザーメッセージ（Noneの場合は関連度を使用しない）
+            scorer: スコアリングエンジン（Noneの場合はデフォルトの重み）
+            top_k: 取得する件数（Noneの場合はすべて）
+            memories_dict: 取得済みの階層別の記憶（Noneの場合はDBから取得）
 
-        # daily_summaryの追加
-        for memory in memories_dict["daily_summary"]:
-            days_ago = current_day - memory.start_day
-            if days_ago == 0:
-                label = "今日の記憶"
-            elif days_ago == 1:
-                label = "昨日の記憶"
-            else:
-                label = f"{days_ago}日前の記憶"
-            memory_tuples.append((label, memory))
-
-        # level_10の追加
-        for memory in memories_dict["level_10"]:
-            start_days_ago = current_day - memory.start_day
-            end_days_ago = current_day - memory.end_day
-            label = f"{end_days_ago}〜{start_days_ago}日前の記憶"
-            memory_tuples.append((label, memory))
-
-        # level_100の追加
-        for memory in memories_dict["level_100"]:
-            start_days_ago = current_day - memory.start_day
-            end_days_ago = current_day - memory.end_day
-            label = f"{end_days_ago}〜{start_days_ago}日前の記憶"
-            memory_tuples.append((label, memory))
-
-        # level_1000の追加
-        for memory in memories_dict["level_1000"]:
-            start_days_ago = current_day - memory.start_day
-            end_days_ago = current_day - memory.end_day
-            label = f"{end_days_ago}〜{start_days_ago}日前の記憶"
-            memory_tuples.append((label, memory))
-
-        # level_archiveの追加
-        for memory in memories_dict["level_archive"]:
-            days_ago = current_day - memory.end_day
-            label = f"{days_ago}日以前の記憶"
-            memory_tuples.append((label, memory))
-
-        # 日付順にソート（最新から最古へ）
-        memory_tuples.sort(key=lambda x: x[1].start_day, reverse=True)
-
-        return memory_tuples
-
-    def format_memories_for_prompt(self, current_day: int) -> str:
+        Returns:
+            スコアの高い順の(記憶タイプのラベル, 記憶オブジェクト, スコア)のリスト
+        """
+        memory_tuples = self.get_memories_for_system_prompt(current_day, memories_dict)
+        if not memory_tuples:
+            return []
+
+        labels = {id(memory): label for label, memory in memory_tuples}
+        memories = [memory for _, memory in memory_tuples]
+
+        relevance = None
+        if user_message:
+            if not memory_embedding_store.has_character(self.character_id):
+                memory_embedding_store.build_character(
+                    self.character_id,
+                    memory_crud.get_memory_contents(self.db, self.character_id),
+                )
+            relevance = memory_embedding_store.similarity(
+                self.character_id, user_message, [memory.id for memory in memories]
+            )
+
+        ranked = (scorer or HybridScorer()).rank(
+            memories, current_day, relevance=relevance, top_k=top_k
+        )
+        return [(labels[id(memory)], memory, score) for memory, score in ranked]
+
+    def format_memories_for_prompt(
+        self,
+        current_day: int,
+        memories_dict: Optional[Dict[str, List[Memory]]] = None,
+    ) -> str:
         """
         システムプロンプト用に記憶を整形する
 
         Args:
             current_day: 現在の日
+            memories_dict: 取得済みの階層別の記憶（Noneの場合はDBから取得）
 
         Returns:
             プロンプト用に整形された記憶テキスト
         """
-        memory_tuples = self.get_memories_for_system_prompt(current_day)
+        return _render_memories(
+            self.get_memories_for_system_prompt(current_day, memories_dict)
+        )
 
-        if not memory_tuples:
-            return "記憶データはありません。"
+    def format_memories_with_budget(
+        self,
+        current_day: int,
+        model: Optional[str] = None,
+        token_budget: Optional[int] = None,
+        memories_dict: Optional[Dict[str, List[Memory]]] = None,
+        token_counter: Callable[[str], int] = estimate_tokens,
+        deferred_content: bool = False,
+    ) -> Dict[str, Any]:
+        """
+        トークン予算内に収まるように記憶を選択して整形する
+
+        記憶は階層の低いもの（より詳細なもの）を優先し、同じ階層では新しいものから
+        予算に収まる限り詰め込む。選択された記憶は通常の整形と同じ順序で出力する。
+
+        deferred_content が True の場合は、まずメタデータのみを取得して記憶内容の
+        トークン数を文字数で見積もって選択し、選択された記憶の内容だけを1回の
+        クエリで取得する。文字数は estimate_tokens の見積もりの上限となるため、
+        通常の選択より保守的になることがある。取得後は token_counter で数え直し、
+        予算を超える場合（文字数より多く数える token_counter の場合）は
+        優先度の低い記憶から除外する。
+
+        Args:
+            current_day: 現在の日
+            model: 使用するLLMモデル（予算の決定に使用）
+            token_budget: トークン予算（指定した場合はモデルの予算より優先）
+            memories_dict: 取得済みの階層別の記憶（Noneの場合はDBから取得）
+            token_counter: テキストのトークン数を数える関数
+            deferred_content: 記憶内容の取得を選択後まで遅延するかどうか
+                （memories_dict を指定した場合は無視される）
+
+        Returns:
+            整形されたテキスト、予算、使用トークン数、除外された記憶の情報
+        """
+        if token_budget is None:
+            token_budget = MEMORY_TOKEN_BUDGETS.get(model, DEFAULT_MEMORY_TOKEN_BUDGET)
+
+        deferred_content = deferred_content and memories_dict is None
+        if deferred_content:
+            memory_tuples = _label_session_memories(
+                self.get_memory_metadata_for_session(current_day), current_day
+            )
+            costs = [
+                token_counter(_format_memory_entry(label, "")) + row.content_length
+                for label, row in memory_tuples
+            ]
+        else:
+            memory_tuples = self.get_memories_for_system_prompt(
+                current_day, memories_dict
+            )
+            costs = [
+                token_counter(_format_memory_entry(label, memory.content))
+                for label, memory in memory_tuples
+            ]
+
+        # 優先度順（階層の低い順、新しい順）に予算内で選択する
+        priority = sorted(
+            range(len(memory_tuples)),
+            key=lambda index: (
+                MEMORY_HIERARCHY.get(
+                    memory_tuples[index][1].memory_type, len(MEMORY_HIERARCHY)
+                ),
+                -memory_tuples[index][1].start_day,
+            ),
+        )
+        header_tokens = token_counter(MEMORY_HEADER)
+        remaining = token_budget - header_tokens
+        selected = set()
+        dropped = []
+        for index in priority:
+            label, memory = memory_tuples[index]
+            tokens = costs[index]
+            if tokens <= remaining:
+                selected.add(index)
+                remaining -= tokens
+            else:
+                dropped.append(
+                    {
+                        "id": str(memory.id),
+                        "memory_type": memory.memory_type,
+                        "label": label,
+                        "tokens": tokens,
+                    }
+                )
+
+        chosen = [
+            memory_tuples[index]
+            for index in range(len(memory_tuples))
+            if index in selected
+        ]
+        if deferred_content:
+            # 選択された記憶の内容のみを取得する（取得までに削除された記憶は除く）
+            loaded = {
+                memory.id: memory
+                for memory in self.load_memory_contents([row for _, row in chosen])
+            }
+            entries = {
+                index: (memory_tuples[index][0], loaded[memory_tuples[index][1].id])
+                for index in sorted(selected)
+                if memory_tuples[index][1].id in loaded
+            }
+
+            # 文字数が token_counter の上限になるとは限らないため取得後に数え直し、
+            # 予算を超える場合は優先度の低い記憶から除外する
+            actual_costs = {
+                index: token_counter(_format_memory_entry(label, memory.content))
+                for index, (label, memory) in entries.items()
+            }
+            total = header_tokens + sum(actual_costs.values())
+            for index in reversed(priority):
+                if total <= token_budget:
+                    break
+                if index not in entries:
+                    continue
+                label, memory = entries.pop(index)
+                total -= actual_costs[index]
+                dropped.append(
+                    {
+                        "id": str(memory.id),
+                        "memory_type": memory.memory_type,
+                        "label": label,
+                        "tokens": actual_costs[index],
+                    }
+                )
+            chosen = list(entries.values())
+
+        if not chosen:
+            text = NO_MEMORY_TEXT
+            used_tokens = token_counter(text)
+        else:
+            entry_texts = [
+                _format_memory_entry(label, memory.content) for label, memory in chosen
+            ]
+            text = MEMORY_HEADER + "".join(entry_texts)
+            used_tokens = header_tokens + sum(map(token_counter, entry_texts))
+
+        return {
+            "text": text,
+            "token_budget": token_budget,
+            "used_tokens": used_tokens,
+            "included_count": len(chosen),
+            "dropped": dropped,
+        }
+
+    def search_memories(
+        self, query: str, top_k: int = 10
+    ) -> List[Tuple[Memory, float]]:
+        """
+        全文検索インデックスを使って関連度の高い記憶を取得する
+
+        キャラクターのインデックスが読み込まれていない場合はDBから構築する。
+
+        Args:
+            query: 検索クエリ
+            top_k: 取得する件数
+
+        Returns:
+            関連度の高い順の(記憶オブジェクト, BM25スコア)のリスト
+        """
+        if not memory_search_index.has_character(self.character_id):
+            memory_search_index.build_character(
+                self.character_id,
+                memory_crud.get_memory_contents(self.db, self.character_id),
+            )
+
+        results = memory_search_index.search(self.character_id, query, top_k)
+        return self._attach_memories(results)
+
+    def _attach_memories(
+        self, results: List[Tuple[uuid.UUID, float]]
+    ) -> List[Tuple[Memory, float]]:
+        """
+        (記憶ID, スコア)のリストを1回のクエリで記憶オブジェクトに置き換える
+
+        Args:
+            results: (記憶ID, スコア)のリスト
+
+        Returns:
+            順序を保った(記憶オブジェクト, スコア)のリスト
+        """
+        memories = {
+            memory.id: memory
+            for memory in memory_crud.get_memories_by_ids(
+                self.db, [memory_id for memory_id, _ in results]
+            )
+        }
+        return [
+            (memories[memory_id], score)
+            for memory_id, score in results
+            if memory_id in memories
+        ]
+
+    def recall_similar_memories(
+        self, query: str, top_k: int = 10
+    ) -> List[Tuple[Memory, float]]:
+        """
+        埋め込みベクトルの類似度で意味的に近い記憶を取得する
+
+        キャラクターのベクトルストアが読み込まれていない場合はDBから構築する。
 
-        # 整形されたテキストを作成
-        formatted_text = "【記憶データ】\n"
+        Args:
+            query: 検索クエリ（ユーザーのメッセージなど）
+            top_k: 取得する件数
+
+        Returns:
+            類似度の高い順の(記憶オブジェクト, コサイン類似度)のリスト
+        """
+        if not memory_embedding_store.has_character(self.character_id):
+            memory_embedding_store.build_character(
+                self.character_id,
+                memory_crud.get_memory_contents(self.db, self.character_id),
+            )
+
+        results = memory_embedding_store.search(self.character_id, query, top_k)
+        return self._attach_memories(results)
+
+
+def get_memory_context(
+    db: Session,
+    character_id: uuid.UUID,
+    current_day: int,
+    cache: Optional[MemoryContextCache] = None,
+) -> Tuple[Dict[str, List[Memory]], str]:
+    """
+    キャッシュを利用して会話用の記憶コンテキストを取得する
 
-        for label, memory in memory_tuples:
-            formatted_text += f"--- {label} ---\n{memory.content}\n\n"
+    キャッシュにヒットした場合はデータベースにアクセスしない。キャッシュは
+    プロセスごとに保持するため、他のプロセスによる記憶の書き込みは反映されない
+    （MemoryContextCache を参照）。
 
-        return formatted_text
+    Args:
+        db: データベースセッション
+        character_id: キャラクターID
+        current_day: 現在の日
+        cache: 使用するキャッシュ（Noneの場合は共有キャッシュ）
+
+    Returns:
+        (階層別の記憶のディクショナリ, プロンプト用に整形された記憶テキスト)
+    """
+    if cache is None:
+        cache = memory_context_cache
+
+    cached = cache.get(character_id, current_day)
+    if cached is not None:
+        return cached
+
+    # 読み込み中に書き込みがあった場合は古い内容をキャッシュしない
+    generation = cache.generation(character_id)
+    retriever = MemoryRetriever(db, character_id)
+    memories = retriever.get_memories_for_session(current_day)
+    text = retriever.format_memories_for_prompt(current_day, memories)
+    cache.put(character_id, current_day, memories, text, generation)
+    return memories, text
+
+
+def get_memories_for_sessions(
+    db: Session,
+    targets: List[Tuple[uuid.UUID, int]],
+    chunk_size: int = BATCH_CHUNK_SIZE,
+) -> Dict[Tuple[uuid.UUID, int], Dict[str, List[Memory]]]:
+    """
+    複数キャラクターの会話セッション用の記憶を一括で取得する
+
+    キャラクターごとの取得結果は MemoryRetriever.get_memories_for_session と同じになる。
+    chunk_size 件ずつ(キャラクターID, 現在の日)を結合した1回のクエリで取得するため、
+    クエリ数は現在の日の種類数によらず対象数のみで決まる。
+    存在しないキャラクターには空の階層別ディクショナリを返す。
+
+    Args:
+        db: データベースセッション
+        targets: (キャラクターID, 現在の日)のリスト
+        chunk_size: 1回のクエリに含める対象数
+
+    Returns:
+        (キャラクターID, 現在の日)ごとの階層別の記憶のディクショナリ
+    """
+    unique_targets = list(dict.fromkeys(targets))
+    windows_by_day = {}
+    results = {}
+    for offset in range(0, len(unique_targets), chunk_size):
+        chunk = unique_targets[offset : offset + chunk_size]
+        rows = memory_crud.get_memories_in_relative_ranges_for_targets(
+            db=db, targets=chunk, ranges=SESSION_WINDOW_OFFSETS
+        )
+
+        candidates_by_target = {}
+        for memory, current_day in rows:
+            candidates_by_target.setdefault(
+                (memory.character_id, current_day), []
+            ).append(memory)
+
+        for target in chunk:
+            current_day = target[1]
+            if current_day not in windows_by_day:
+                windows_by_day[current_day] = _get_session_windows(current_day)
+            results[target] = _bucket_session_memories(
+                windows_by_day[current_day], candidates_by_target.get(target, [])
+            )
+
+    return results
+
+
+def warm_memory_context_cache(
+    db: Session,
+    targets: List[Tuple[uuid.UUID, int]],
+    cache: Optional[MemoryContextCache] = None,
+) -> int:
+    """
+    複数キャラクターの記憶コンテキストを一括で取得してキャッシュに保存する
+
+    Args:
+        db: データベースセッション
+        targets: (キャラクターID, 現在の日)のリスト
+        cache: 使用するキャッシュ（Noneの場合は共有キャッシュ）
+
+    Returns:
+        キャッシュに保存したエントリの数
+    """
+    if cache is None:
+        cache = memory_context_cache
+
+    generations = {
+        character_id: cache.generation(character_id) for character_id, _ in targets
+    }
+    memories_by_target = get_memories_for_sessions(db, targets)
+    stored = 0
+    for (character_id, current_day), memories in memories_by_target.items():
+        text = _render_memories(_label_session_memories(memories, current_day))
+        if cache.put(
+            character_id, current_day, memories, text, generations[character_id]
+        ):
+            stored += 1
+
+    return stored
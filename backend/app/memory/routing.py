@@ -0,0 +1,149 @@
+"""
+記憶タイプごとのLLMモデルのルーティング
+
+記憶タイプと入力トークン数から使用するモデルの候補（フォールバックの順序）を選び、
+ルートごとの遅延とトークン数の統計を記録する。
+"""
+
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from app.core.constants import LLM_MODEL_ROUTES
+
+
+class ModelRouter:
+    """LLMモデルのルーティングテーブル
+
+    記憶タイプごとに(入力トークン数の上限, モデルのリスト)を上限の昇順に持ち、
+    入力トークン数が上限以下の最初のルートを使用する。
+    """
+
+    def __init__(
+        self,
+        routes: Optional[
+            Dict[str, Sequence[Tuple[Optional[int], Sequence[str]]]]
+        ] = None,
+        default_models: Optional[Sequence[str]] = None,
+    ):
+        """
+        ルーティングテーブルの初期化
+
+        Args:
+            routes: 記憶タイプごとの(入力トークン数の上限, モデルのリスト)のリスト
+                （上限がNoneの場合は上限なし）
+            default_models: 記憶タイプが指定されていないか一致するルートがない場合の
+                モデルのリスト
+        """
+        self.routes: Dict[str, List[Tuple[Optional[int], List[str]]]] = {}
+        for memory_type, type_routes in (
+            LLM_MODEL_ROUTES if routes is None else routes
+        ).items():
+            for _, models in type_routes:
+                if not models:
+                    raise ValueError(
+                        f"記憶タイプ {memory_type} のルートにモデルがありません"
+                    )
+            self.routes[memory_type] = sorted(
+                ((max_tokens, list(models)) for max_tokens, models in type_routes),
+                key=lambda route: float("inf") if route[0] is None else route[0],
+            )
+        self.default_models = list(default_models or [])
+        self._stats: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def select(
+        self, memory_type: Optional[str], input_tokens: int
+    ) -> Tuple[str, List[str]]:
+        """
+        記憶タイプと入力トークン数からルートを選択する
+
+        Args:
+            memory_type: 生成する記憶タイプ
+            input_tokens: 入力のトークン数
+
+        Returns:
+            (ルート名, 試行するモデルのリスト)
+
+        Raises:
+            ValueError: 一致するルートがなく、デフォルトのモデルもない場合
+        """
+        for max_tokens, models in self.routes.get(memory_type, []):
+            if max_tokens is None or input_tokens <= max_tokens:
+                limit = "max" if max_tokens is None else f"<={max_tokens}"
+                return f"{memory_type}:{limit}", list(models)
+
+        if not self.default_models:
+            raise ValueError(f"記憶タイプ {memory_type} のルートが見つかりません")
+        return "default", list(self.default_models)
+
+    def record(
+        self,
+        route: str,
+        model: str,
+        latency: float,
+        prompt_tokens: int = 0,
+        completion_tokens: int = 0,
+        success: bool = True,
+    ) -> None:
+        """
+        1回の呼び出しの結果をルートの統計に記録する
+
+        Args:
+            route: ルート名
+            model: 呼び出したモデル
+            latency: 呼び出しの所要時間（秒）
+            prompt_tokens: 入力のトークン数
+            completion_tokens: 出力のトークン数
+            success: 呼び出しが成功したかどうか
+        """
+        with self._lock:
+            stats = self._stats.setdefault(
+                route,
+                {
+                    "calls": 0,
+                    "failures": 0,
+                    "total_latency": 0.0,
+                    "max_latency": 0.0,
+                    "prompt_tokens": 0,
+                    "completion_tokens": 0,
+                    "models": {},
+                },
+            )
+            stats["calls"] += 1
+            stats["total_latency"] += latency
+            stats["max_latency"] = max(stats["max_latency"], latency)
+            if success:
+                stats["prompt_tokens"] += prompt_tokens
+                stats["completion_tokens"] += completion_tokens
+                stats["models"][model] = stats["models"].get(model, 0) + 1
+            else:
+                stats["failures"] += 1
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        ルートごとの統計情報を取得する
+
+        Returns:
+            ルート名ごとの呼び出し数・失敗数・平均/最大遅延・トークン数・
+            成功したモデルごとの呼び出し数
+        """
+        with self._lock:
+            return {
+                route: {
+                    **stats,
+                    "models": dict(stats["models"]),
+                    "average_latency": (
+                        stats["total_latency"] / stats["calls"]
+                        if stats["calls"]
+                        else 0.0
+                    ),
+                }
+                for route, stats in self._stats.items()
+            }
+
+    def reset_stats(self) -> None:
+        """
+        統計情報を削除する
+        """
+        with self._lock:
+            self._stats.clear()
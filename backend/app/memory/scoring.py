@@ -0,0 +1,150 @@
+"""
+記憶のハイブリッドスコアリング
+
+現在の日からの経過日数による減衰、記憶階層による重み、ユーザーメッセージとの
+関連度を重み付きで合算し、候補の記憶をNumPy配列上でまとめてスコアリングする。
+経過日数は記憶の期間の中央の日から数えるため、長い期間を要約した記憶は
+終了日が同じでも短い期間の記憶より古いものとして扱われる。
+"""
+
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.core.constants import MEMORY_HIERARCHY
+from app.models import Memory
+
+# デフォルトの重みと経過日数の半減期
+DEFAULT_RECENCY_WEIGHT = 0.5
+DEFAULT_TIER_WEIGHT = 0.3
+DEFAULT_RELEVANCE_WEIGHT = 0.2
+DEFAULT_RECENCY_HALF_LIFE = 30.0
+
+
+class HybridScorer:
+    """ハイブリッドスコアリングエンジン
+
+    score = recency_weight * 0.5 ** (経過日数 / 半減期)
+          + tier_weight * 階層の重み
+          + relevance_weight * 関連度
+
+    経過日数は現在の日から記憶の期間（開始日〜終了日）の中央の日までの日数とする。
+    """
+
+    def __init__(
+        self,
+        recency_weight: float = DEFAULT_RECENCY_WEIGHT,
+        tier_weight: float = DEFAULT_TIER_WEIGHT,
+        relevance_weight: float = DEFAULT_RELEVANCE_WEIGHT,
+        recency_half_life: float = DEFAULT_RECENCY_HALF_LIFE,
+        tier_weights: Optional[Dict[str, float]] = None,
+    ):
+        """
+        ハイブリッドスコアリングエンジンの初期化
+
+        Args:
+            recency_weight: 経過日数による減衰の重み
+            tier_weight: 記憶階層の重み
+            relevance_weight: 関連度の重み
+            recency_half_life: 経過日数による減衰の半減期（日）
+            tier_weights: 記憶タイプごとの重み（Noneの場合は階層レベルに比例）
+        """
+        if recency_half_life <= 0:
+            raise ValueError(f"無効な半減期です: {recency_half_life}")
+
+        self.recency_weight = recency_weight
+        self.tier_weight = tier_weight
+        self.relevance_weight = relevance_weight
+        self.recency_half_life = recency_half_life
+
+        max_level = max(MEMORY_HIERARCHY.values())
+        if tier_weights is None:
+            tier_weights = {
+                memory_type: level / max_level
+                for memory_type, level in MEMORY_HIERARCHY.items()
+            }
+
+        # 階層レベルをインデックスとする重みのベクトル
+        self.tier_weight_table = np.zeros(max_level + 1, dtype=np.float64)
+        for memory_type, weight in tier_weights.items():
+            self.tier_weight_table[MEMORY_HIERARCHY[memory_type]] = weight
+
+    def score(
+        self,
+        current_day: int,
+        end_days: np.ndarray,
+        tier_levels: np.ndarray,
+        relevance: Optional[np.ndarray] = None,
+        start_days: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """
+        候補の記憶をまとめてスコアリングする
+
+        Args:
+            current_day: 現在の日
+            end_days: 候補の終了日の配列
+            tier_levels: 候補の階層レベル（MEMORY_HIERARCHYの値）の配列
+            relevance: 候補の関連度（0〜1）の配列（オプション）
+            start_days: 候補の開始日の配列（Noneの場合は終了日と同じ日とする）
+
+        Returns:
+            候補ごとのスコアの配列
+        """
+        reference_days = np.asarray(end_days, dtype=np.float64)
+        if start_days is not None:
+            reference_days = (
+                np.asarray(start_days, dtype=np.float64) + reference_days
+            ) / 2
+        ages = np.maximum(current_day - reference_days, 0.0)
+        scores = self.recency_weight * np.exp2(-ages / self.recency_half_life)
+        scores += self.tier_weight * self.tier_weight_table[tier_levels]
+        if relevance is not None:
+            scores += self.relevance_weight * np.clip(relevance, 0.0, 1.0)
+        return scores
+
+    def rank(
+        self,
+        memories: Sequence[Memory],
+        current_day: int,
+        relevance: Optional[np.ndarray] = None,
+        top_k: Optional[int] = None,
+    ) -> List[Tuple[Memory, float]]:
+        """
+        記憶をスコアの高い順に並べる
+
+        Args:
+            memories: 候補の記憶のリスト
+            current_day: 現在の日
+            relevance: 候補と同じ順序の関連度の配列（オプション）
+            top_k: 取得する件数（Noneの場合はすべて）
+
+        Returns:
+            スコアの高い順の(記憶オブジェクト, スコア)のリスト
+        """
+        if not memories:
+            return []
+
+        start_days = np.fromiter(
+            (memory.start_day for memory in memories),
+            dtype=np.float64,
+            count=len(memories),
+        )
+        end_days = np.fromiter(
+            (memory.end_day for memory in memories),
+            dtype=np.float64,
+            count=len(memories),
+        )
+        tier_levels = np.fromiter(
+            (MEMORY_HIERARCHY[memory.memory_type] for memory in memories),
+            dtype=np.intp,
+            count=len(memories),
+        )
+        scores = self.score(current_day, end_days, tier_levels, relevance, start_days)
+
+        if top_k is not None and 0 < top_k < len(scores):
+            order = np.argpartition(-scores, top_k - 1)[:top_k]
+            order = order[np.argsort(-scores[order], kind="stable")]
+        else:
+            order = np.argsort(-scores, kind="stable")[:top_k]
+
+        return [(memories[index], float(scores[index])) for index in order]
@@ -0,0 +1,398 @@
+"""
+記憶内容の全文検索インデックス
+
+日本語の記憶内容を文字n-gramで分割した転置インデックスを、キャラクターごとに
+分割して保持し、BM25でスコアリングする。
+"""
+
+import heapq
+import json
+import math
+import os
+import threading
+import unicodedata
+import uuid
+from collections import Counter, OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# BM25のパラメータ
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# メモリ上に保持するキャラクターのインデックスの最大数
+DEFAULT_MAX_CHARACTERS = 1024
+
+
+def _is_word_char(char: str) -> bool:
+    """
+    英数字など空白区切りで単語として扱う文字かどうかを判定する
+    """
+    return char.isascii() and char.isalnum()
+
+
+def _is_cjk(char: str) -> bool:
+    """
+    ひらがな・カタカナ・漢字・長音記号かどうかを判定する
+    """
+    code = ord(char)
+    return (
+        0x3040 <= code <= 0x30FF
+        or 0x3400 <= code <= 0x4DBF
+        or 0x4E00 <= code <= 0x9FFF
+        or 0xF900 <= code <= 0xFAFF
+    )
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    テキストを検索用のトークンに分割する
+
+    NFKC正規化と小文字化の後、英数字の連続は単語として、それ以外の文字
+    （ひらがな・カタカナ・漢字など）の連続は1文字の検索にも一致するよう
+    文字unigramと文字bigramの両方として扱う。
+
+    Args:
+        text: 対象テキスト
+
+    Returns:
+        トークンのリスト
+    """
+    normalized = unicodedata.normalize("NFKC", text or "").lower()
+    tokens = []
+    run = []
+    run_is_word = False
+
+    def flush():
+        if not run:
+            return
+        if run_is_word:
+            tokens.append("".join(run))
+        else:
+            tokens.extend(run)
+            tokens.extend(run[i] + run[i + 1] for i in range(len(run) - 1))
+        run.clear()
+
+    for char in normalized:
+        if char.isspace() or not (char.isalnum() or _is_cjk(char)):
+            flush()
+            continue
+        is_word = _is_word_char(char)
+        if run and is_word != run_is_word:
+            flush()
+        run_is_word = is_word
+        run.append(char)
+    flush()
+
+    return tokens
+
+
+class CharacterSearchIndex:
+    """キャラクター単位の転置インデックス
+
+    記憶IDごとの語の出現回数と、語ごとのポスティングリストを保持する。
+    """
+
+    def __init__(self):
+        self.doc_terms: Dict[str, Dict[str, int]] = {}
+        self.doc_lengths: Dict[str, int] = {}
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.total_length = 0
+
+    def add(self, doc_id: str, text: str) -> None:
+        """
+        記憶をインデックスに追加する（既存の場合は置き換える）
+
+        Args:
+            doc_id: 記憶ID
+            text: 記憶内容
+        """
+        self.remove(doc_id)
+        self._add_terms(doc_id, dict(Counter(tokenize(text))))
+
+    def remove(self, doc_id: str) -> bool:
+        """
+        記憶をインデックスから削除する
+
+        Args:
+            doc_id: 記憶ID
+
+        Returns:
+            削除したかどうか
+        """
+        terms = self.doc_terms.pop(doc_id, None)
+        if terms is None:
+            return False
+
+        for term in terms:
+            posting = self.postings[term]
+            del posting[doc_id]
+            if not posting:
+                del self.postings[term]
+        self.total_length -= self.doc_lengths.pop(doc_id)
+        return True
+
+    def search(self, query: str, top_k: int = 10) -> List[Tuple[str, float]]:
+        """
+        BM25で記憶を検索する
+
+        Args:
+            query: 検索クエリ
+            top_k: 取得する件数
+
+        Returns:
+            スコアの高い順の(記憶ID, スコア)のリスト
+        """
+        doc_count = len(self.doc_terms)
+        if doc_count == 0 or top_k <= 0:
+            return []
+
+        # norm = k1 * (1 - b + b * 文書長 / 平均文書長) をループ外で分解しておく
+        average_length = self.total_length / doc_count or 1.0
+        norm_base = BM25_K1 * (1 - BM25_B)
+        norm_scale = BM25_K1 * BM25_B / average_length
+        doc_lengths = self.doc_lengths
+        scores: Dict[str, float] = {}
+        get_score = scores.get
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (doc_count - len(posting) + 0.5) / (len(posting) + 0.5))
+            weight = idf * (BM25_K1 + 1)
+            for doc_id, frequency in posting.items():
+                norm = norm_base + norm_scale * doc_lengths[doc_id]
+                scores[doc_id] = get_score(doc_id, 0.0) + weight * frequency / (
+                    frequency + norm
+                )
+
+        return heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+
+    def to_dict(self) -> Dict[str, Dict[str, int]]:
+        """
+        永続化用に記憶IDごとの語の出現回数を取得する
+        """
+        return self.doc_terms
+
+    @classmethod
+    def from_dict(cls, doc_terms: Dict[str, Dict[str, int]]) -> "CharacterSearchIndex":
+        """
+        永続化されたデータからインデックスを復元する
+        """
+        index = cls()
+        for doc_id, terms in doc_terms.items():
+            index._add_terms(doc_id, terms)
+        return index
+
+    def _add_terms(self, doc_id: str, terms: Dict[str, int]) -> None:
+        self.doc_terms[doc_id] = terms
+        length = sum(terms.values())
+        self.doc_lengths[doc_id] = length
+        self.total_length += length
+        for term, frequency in terms.items():
+            self.postings.setdefault(term, {})[doc_id] = frequency
+
+
+class MemorySearchIndex:
+    """記憶の全文検索インデックス
+
+    キャラクターごとに分割した転置インデックスを保持する。
+    読み込まれていないキャラクターの更新は無視し、最初の検索時にDBから構築する。
+    保持するキャラクター数が max_characters を超えた場合は最も長く検索されていない
+    キャラクターのインデックスから破棄する（次の検索時にDBから構築し直す）。
+    """
+
+    def __init__(self, max_characters: int = DEFAULT_MAX_CHARACTERS):
+        """
+        全文検索インデックスの初期化
+
+        Args:
+            max_characters: メモリ上に保持するキャラクターのインデックスの最大数
+        """
+        if max_characters < 1:
+            raise ValueError(f"無効なキャラクター数です: {max_characters}")
+        self.max_characters = max_characters
+        self._characters: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def has_character(self, character_id: uuid.UUID) -> bool:
+        """
+        キャラクターのインデックスが読み込まれているかどうかを判定する
+        """
+        return character_id in self._characters
+
+    def build_character(
+        self, character_id: uuid.UUID, documents: Iterable[Tuple[uuid.UUID, str]]
+    ) -> None:
+        """
+        キャラクターのインデックスを構築する（既存の場合は置き換える）
+
+        Args:
+            character_id: キャラクターID
+            documents: (記憶ID, 記憶内容)のリスト
+        """
+        index = CharacterSearchIndex()
+        for memory_id, content in documents:
+            index.add(str(memory_id), content)
+        with self._lock:
+            self._put(character_id, index)
+
+    def add_memory(
+        self, character_id: uuid.UUID, memory_id: uuid.UUID, content: str
+    ) -> None:
+        """
+        記憶を追加または更新する
+
+        Args:
+            character_id: キャラクターID
+            memory_id: 記憶ID
+            content: 記憶内容
+        """
+        with self._lock:
+            index = self._characters.get(character_id)
+            if index is not None:
+                index.add(str(memory_id), content)
+
+    def remove_memory(self, character_id: uuid.UUID, memory_id: uuid.UUID) -> None:
+        """
+        記憶を削除する
+
+        Args:
+            character_id: キャラクターID
+            memory_id: 記憶ID
+        """
+        with self._lock:
+            index = self._characters.get(character_id)
+            if index is not None:
+                index.remove(str(memory_id))
+
+    def drop_character(self, character_id: uuid.UUID) -> None:
+        """
+        キャラクターのインデックスを破棄する
+        """
+        with self._lock:
+            self._characters.pop(character_id, None)
+
+    def search(
+        self, character_id: uuid.UUID, query: str, top_k: int = 10
+    ) -> List[Tuple[uuid.UUID, float]]:
+        """
+        キャラクターの記憶を検索する
+
+        Args:
+            character_id: キャラクターID
+            query: 検索クエリ
+            top_k: 取得する件数
+
+        Returns:
+            スコアの高い順の(記憶ID, スコア)のリスト
+        """
+        with self._lock:
+            index = self._characters.get(character_id)
+            if index is None:
+                return []
+            self._characters.move_to_end(character_id)
+            results = index.search(query, top_k)
+        return [(uuid.UUID(doc_id), score) for doc_id, score in results]
+
+    def save(
+        self, directory: str, watermarks: Optional[Dict[uuid.UUID, str]] = None
+    ) -> int:
+        """
+        インデックスをキャラクターごとのファイルとして保存する
+
+        Args:
+            directory: 保存先ディレクトリ
+            watermarks: キャラクターごとの保存時点の記憶の状態
+                （memory_crud.get_memory_watermarks の値、読み込み時の検証に使用する）
+
+        Returns:
+            保存したキャラクター数
+        """
+        os.makedirs(directory, exist_ok=True)
+        watermarks = watermarks or {}
+        with self._lock:
+            snapshot = {
+                character_id: dict(index.to_dict())
+                for character_id, index in self._characters.items()
+            }
+
+        for character_id, doc_terms in snapshot.items():
+            path = os.path.join(directory, f"{character_id}.json")
+            temp_path = f"{path}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(
+                    {
+                        "watermark": watermarks.get(character_id),
+                        "documents": doc_terms,
+                    },
+                    f,
+                    ensure_ascii=False,
+                )
+            os.replace(temp_path, path)
+
+        return len(snapshot)
+
+    def load(
+        self,
+        directory: str,
+        character_id: Optional[uuid.UUID] = None,
+        watermarks: Optional[Dict[uuid.UUID, str]] = None,
+    ) -> int:
+        """
+        保存されたインデックスを読み込む
+
+        watermarks を指定した場合は、保存時の記憶の状態が一致するキャラクターのみを
+        読み込む。一致しないキャラクター（保存後に記憶が追加・更新・削除された場合など）は
+        読み込まず、次の検索時にDBから構築し直す。
+
+        Args:
+            directory: 保存先ディレクトリ
+            character_id: 読み込むキャラクターID（Noneの場合はすべて）
+            watermarks: キャラクターごとの現在の記憶の状態
+                （memory_crud.get_memory_watermarks の値、Noneの場合は検証しない）
+
+        Returns:
+            読み込んだキャラクター数
+        """
+        if not os.path.isdir(directory):
+            return 0
+
+        if character_id is not None:
+            names = [f"{character_id}.json"]
+        else:
+            names = [name for name in os.listdir(directory) if name.endswith(".json")]
+
+        loaded = 0
+        for name in names:
+            path = os.path.join(directory, name)
+            if not os.path.exists(path):
+                continue
+            loaded_id = uuid.UUID(name[: -len(".json")])
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            if watermarks is not None and (
+                data["watermark"] is None
+                or data["watermark"] != watermarks.get(loaded_id)
+            ):
+                continue
+            index = CharacterSearchIndex.from_dict(data["documents"])
+            with self._lock:
+                self._put(loaded_id, index)
+            loaded += 1
+
+        return loaded
+
+    def _put(self, character_id: uuid.UUID, index: CharacterSearchIndex) -> None:
+        """
+        キャラクターのインデックスを登録する（ロックを保持した状態で呼び出す）
+        """
+        self._characters[character_id] = index
+        self._characters.move_to_end(character_id)
+        while len(self._characters) > self.max_characters:
+            self._characters.popitem(last=False)
+            self.evictions += 1
+
+
+# アプリケーション全体で共有する全文検索インデックス
+memory_search_index = MemorySearchIndex()
@@ -0,0 +1,24 @@
+"""
+トークン数の推定
+
+外部のトークナイザーを使わずに、プロンプトのトークン数を高速に見積もる。
+"""
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    テキストのトークン数を推定する
+
+    日本語などの非ASCII文字は1文字あたり約1トークン、
+    ASCII文字は約4文字で1トークンとして見積もる。
+
+    Args:
+        text: 対象テキスト
+
+    Returns:
+        推定トークン数
+    """
+    if not text:
+        return 0
+    ascii_count = len(text.encode("ascii", "ignore"))
+    return (len(text) - ascii_count) + (ascii_count + 3) // 4
@@ -0,0 +1,399 @@
+"""
+睡眠処理ジョブのワーカー
+
+sleep_jobs テーブルからジョブを取得して睡眠処理を実行する。1プロセス内の
+複数の非同期タスクがジョブを並行に処理し、プロセスやマシンを増やすことで
+水平にスケールする。ジョブのデータベースの処理はスレッドで実行するため、
+1つのジョブの書き込みを待つ間も他のジョブのLLM呼び出しは進む。
+
+    python -m app.memory.worker --processes 4 --concurrency 8
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy.orm import Session, sessionmaker
+
+from app.core.constants import (
+    SLEEP_JOB_HEARTBEAT_INTERVAL,
+    SLEEP_JOB_LEASE_SECONDS,
+    SLEEP_JOB_POLL_INTERVAL,
+    SLEEP_JOB_RETRY_DELAY,
+)
+from app.core.database import SessionLocal
+from app.crud import sleep_job as sleep_job_crud
+from app.memory.processor import SleepProcessor
+from app.memory.routing import ModelRouter
+from app.models import Memory, SleepJob
+
+SleepJobHandler = Callable[[Session, SleepJob], Awaitable[Dict[str, Any]]]
+
+
+def make_worker_id() -> str:
+    """
+    ホスト名・プロセスID・乱数からワーカーIDを作成する
+    """
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class SleepWorker:
+    """睡眠処理ジョブのワーカー
+
+    concurrency 個の非同期タスクがそれぞれジョブを1件ずつ取得して実行する。
+    実行中はハートビートでリースを延長し、リースを失った場合は処理を中断する。
+    失敗したジョブは再試行の上限まで実行待ちに戻し、上限に達したら破棄する。
+    ジョブの取得・完了・失敗の記録はスレッドで実行し、ハートビートは専用のスレッドで
+    行うため、ジョブの処理がイベントループをブロックしてもリースは延長される。
+    """
+
+    def __init__(
+        self,
+        session_factory: sessionmaker = SessionLocal,
+        worker_id: Optional[str] = None,
+        concurrency: int = 4,
+        lease_seconds: float = SLEEP_JOB_LEASE_SECONDS,
+        heartbeat_interval: float = SLEEP_JOB_HEARTBEAT_INTERVAL,
+        poll_interval: float = SLEEP_JOB_POLL_INTERVAL,
+        retry_delay: float = SLEEP_JOB_RETRY_DELAY,
+        handler: Optional[SleepJobHandler] = None,
+        model: str = "gemini/gemini-2.0-flash",
+        router: Optional[ModelRouter] = None,
+        batch_writes: bool = False,
+    ):
+        """
+        ワーカーの初期化
+
+        Args:
+            session_factory: ジョブごとのデータベースセッションを作成するファクトリ
+            worker_id: ワーカーID（Noneの場合はホスト名とプロセスIDから作成）
+            concurrency: 並行に実行するジョブの数
+            lease_seconds: ジョブのリース期間（秒）
+            heartbeat_interval: リースを延長する間隔（秒、lease_secondsより短くする）
+            poll_interval: 実行可能なジョブがない場合の待ち時間（秒）
+            retry_delay: 失敗したジョブを再実行するまでの基本の待ち時間（秒）
+            handler: ジョブを実行する関数（Noneの場合は睡眠処理の追いつき処理）
+            model: 使用するLLMモデル
+            router: 記憶タイプと入力トークン数ごとのモデルのルーティング
+            batch_writes: ジョブ1件分の書き込みを1つのトランザクションでコミットするかどうか
+        """
+        if concurrency <= 0:
+            raise ValueError(f"無効な並行数です: {concurrency}")
+        if heartbeat_interval >= lease_seconds:
+            raise ValueError(
+                f"ハートビート間隔 {heartbeat_interval} はリース期間 {lease_seconds} より短くしてください"
+            )
+
+        self.session_factory = session_factory
+        self.worker_id = worker_id or make_worker_id()
+        self.concurrency = concurrency
+        self.lease_seconds = lease_seconds
+        self.heartbeat_interval = heartbeat_interval
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self.handler = handler or self.run_sleep_job
+        self.model = model
+        self.router = router
+        self.batch_writes = batch_writes
+        self.processed_jobs = 0
+        # 同じプロセスのタスク同士で同じジョブの取得を競合させないよう取得は1件ずつ行う
+        self._claim_lock = asyncio.Lock()
+        # 実行中のジョブごとにハートビートを行うスレッド
+        self._heartbeat_executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="sleep-job-heartbeat"
+        )
+
+    async def run_sleep_job(self, db: Session, job: SleepJob) -> Dict[str, Any]:
+        """
+        ジョブの現在の日までの睡眠処理を実行する
+
+        Args:
+            db: データベースセッション
+            job: 実行するジョブ
+
+        Returns:
+            処理結果の要約
+        """
+        # キャラクターの読み込みなどのデータベースの処理はスレッドで実行し、
+        # 同じイベントループで処理している他のジョブを止めない
+        processor, current_day = await asyncio.to_thread(
+            self._create_processor, db, job
+        )
+        processed_memories = await processor.acatch_up_memories(current_day)
+        return await processor.memory_generator.run_db(
+            _summarize_processed_memories, processed_memories
+        )
+
+    def _create_processor(
+        self, db: Session, job: SleepJob
+    ) -> Tuple[SleepProcessor, int]:
+        """
+        ジョブを実行する睡眠処理エンジンを作成する
+
+        Returns:
+            (睡眠処理エンジン, ジョブの現在の日)
+        """
+        processor = SleepProcessor(
+            db,
+            job.character_id,
+            self.model,
+            router=self.router,
+            batch_writes=self.batch_writes,
+        )
+        return processor, job.current_day
+
+    async def run(
+        self,
+        stop_event: Optional[asyncio.Event] = None,
+        stop_when_idle: bool = False,
+    ) -> int:
+        """
+        ジョブを取得して実行し続ける
+
+        Args:
+            stop_event: セットされると新しいジョブの取得をやめるイベント
+            stop_when_idle: 実行可能なジョブがなくなった時点で終了するかどうか
+
+        Returns:
+            完了したジョブの数
+        """
+        stop_event = stop_event or asyncio.Event()
+        processed_before = self.processed_jobs
+        await asyncio.gather(
+            *(
+                self._run_slot(stop_event, stop_when_idle)
+                for _ in range(self.concurrency)
+            )
+        )
+        return self.processed_jobs - processed_before
+
+    async def _run_slot(self, stop_event: asyncio.Event, stop_when_idle: bool) -> None:
+        while not stop_event.is_set():
+            db = self.session_factory()
+            try:
+                async with self._claim_lock:
+                    jobs = await asyncio.to_thread(
+                        sleep_job_crud.claim_sleep_jobs,
+                        db,
+                        self.worker_id,
+                        limit=1,
+                        lease_seconds=self.lease_seconds,
+                    )
+                if jobs:
+                    await self.process_job(db, jobs[0])
+                    continue
+            finally:
+                await asyncio.to_thread(db.close)
+
+            if stop_when_idle:
+                return
+            try:
+                await asyncio.wait_for(stop_event.wait(), self.poll_interval)
+            except TimeoutError:
+                pass
+
+    async def process_job(self, db: Session, job: SleepJob) -> None:
+        """
+        取得したジョブを実行し、結果を記録する
+
+        Args:
+            db: データベースセッション
+            job: リースを取得したジョブ
+        """
+        job_id = job.id
+        loop = asyncio.get_running_loop()
+        task = asyncio.ensure_future(self.handler(db, job))
+        stop = threading.Event()
+        lease_lost = threading.Event()
+        # ジョブの処理がイベントループに戻る前からリースを延長できるよう直接スレッドで開始する
+        heartbeat = loop.run_in_executor(
+            self._heartbeat_executor,
+            self._heartbeat,
+            job_id,
+            stop,
+            lease_lost,
+            partial(loop.call_soon_threadsafe, task.cancel),
+        )
+        try:
+            result = await task
+        except asyncio.CancelledError:
+            if not lease_lost.is_set():
+                raise
+            # リースを失ったため結果は記録しない（他のワーカーが再実行する）
+            print(f"ジョブ {job_id} のリースを失ったため処理を中断しました")
+            return
+        except Exception as e:
+            await asyncio.to_thread(db.rollback)
+            status = await asyncio.to_thread(
+                sleep_job_crud.fail_sleep_job,
+                db,
+                job_id,
+                self.worker_id,
+                str(e),
+                retry_delay=self.retry_delay,
+            )
+            print(
+                f"ジョブ {job_id} の実行中にエラーが発生しました ({status}): {str(e)}"
+            )
+            return
+        finally:
+            stop.set()
+            await heartbeat
+
+        completed = await asyncio.to_thread(
+            sleep_job_crud.complete_sleep_job, db, job_id, self.worker_id, result
+        )
+        if not completed:
+            # 完了の記録までにリースを失った（他のワーカーが再実行する）
+            print(f"ジョブ {job_id} のリースを失ったため結果を記録しませんでした")
+            return
+        self.processed_jobs += 1
+
+    def _heartbeat(
+        self,
+        job_id: uuid.UUID,
+        stop: threading.Event,
+        lease_lost: threading.Event,
+        cancel: Callable[[], None],
+    ) -> None:
+        """
+        ジョブの実行中にリースを延長する（専用のスレッドで実行する）
+
+        Args:
+            job_id: ジョブID
+            stop: セットされると延長をやめるイベント
+            lease_lost: リースを失った場合にセットするイベント
+            cancel: リースを失った場合にジョブを中断する関数
+        """
+        while not stop.wait(self.heartbeat_interval):
+            db = self.session_factory()
+            try:
+                extended = sleep_job_crud.heartbeat_sleep_job(
+                    db, job_id, self.worker_id, lease_seconds=self.lease_seconds
+                )
+            except Exception as e:
+                print(f"ジョブ {job_id} のハートビートに失敗しました: {str(e)}")
+                continue
+            finally:
+                db.close()
+
+            if not extended:
+                lease_lost.set()
+                cancel()
+                return
+
+
+def _summarize_processed_memories(memories: List[Memory]) -> Dict[str, Any]:
+    """
+    ジョブの結果として記録する処理結果の要約を作成する
+
+    コミット後に期限切れになった属性を読み込むため、スレッドで実行する。
+    """
+    return {
+        "processed_memories_count": len(memories),
+        "processed_memory_types": [memory.memory_type for memory in memories],
+    }
+
+
+def _run_worker_process(concurrency: int, options: Dict[str, Any]) -> None:
+    """
+    1プロセスでワーカーを実行する（SIGTERM/SIGINTで実行中のジョブの完了後に終了する）
+    """
+    router = ModelRouter() if options.pop("use_routing", False) else None
+    worker = SleepWorker(concurrency=concurrency, router=router, **options)
+
+    async def serve():
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop_event.set)
+        await worker.run(stop_event)
+
+    asyncio.run(serve())
+
+
+def run_worker_processes(
+    processes: int, concurrency: int, options: Optional[Dict[str, Any]] = None
+) -> None:
+    """
+    processes 個のプロセスでそれぞれ concurrency 個のジョブを並行に実行する
+
+    Args:
+        processes: 起動するプロセスの数
+        concurrency: 1プロセスあたりの並行に実行するジョブの数
+        options: SleepWorker に渡す引数（use_routing=True でモデルのルーティングを使用）
+    """
+    if processes <= 0:
+        raise ValueError(f"無効なプロセス数です: {processes}")
+
+    # データベース接続をプロセス間で共有しないよう spawn で起動する
+    context = multiprocessing.get_context("spawn")
+    workers: List[multiprocessing.Process] = [
+        context.Process(
+            target=_run_worker_process, args=(concurrency, dict(options or {}))
+        )
+        for _ in range(processes)
+    ]
+    for process in workers:
+        process.start()
+    try:
+        for process in workers:
+            process.join()
+    except KeyboardInterrupt:
+        for process in workers:
+            process.terminate()
+        for process in workers:
+            process.join()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="睡眠処理ジョブのワーカー")
+    parser.add_argument(
+        "--processes", type=int, default=os.cpu_count() or 1, help="プロセス数"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=4, help="1プロセスあたりの並行ジョブ数"
+    )
+    parser.add_argument(
+        "--model", default="gemini/gemini-2.0-flash", help="使用するLLMモデル"
+    )
+    parser.add_argument(
+        "--use-routing",
+        action="store_true",
+        help="記憶タイプごとのモデルのルーティングを使用する",
+    )
+    parser.add_argument(
+        "--batch-writes",
+        action="store_true",
+        help="ジョブ1件分の書き込みを1つのトランザクションでコミットする",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=SLEEP_JOB_POLL_INTERVAL,
+        help="ジョブがない場合の待ち時間（秒）",
+    )
+    args = parser.parse_args(argv)
+
+    run_worker_processes(
+        args.processes,
+        args.concurrency,
+        {
+            "model": args.model,
+            "use_routing": args.use_routing,
+            "batch_writes": args.batch_writes,
+            "poll_interval": args.poll_interval,
+        },
+    )
+
+
+if __name__ == "__main__":
+    main()
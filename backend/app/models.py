@@ -6,9 +6,12 @@ from sqlalchemy import (
     Column,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
+    LargeBinary,
     String,
     Text,
+    text,
 )
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.sql import func
@@ -40,6 +43,18 @@ class Memory(Base):
     """
 
     __tablename__ = "memories"
+    __table_args__ = (
+        # get_memories_by_character などのキャラクター・記憶タイプ・期間の条件と
+        # (start_day, id) の降順の並び替えを1回のインデックススキャンで処理する
+        Index(
+            "idx_memories_character_type_start_day",
+            "character_id",
+            "memory_type",
+            "start_day",
+            "id",
+            postgresql_include=["end_day"],
+        ),
+    )
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     user_id = Column(UUID(as_uuid=True), nullable=False)
@@ -53,9 +68,36 @@ class Memory(Base):
     end_day = Column(Integer, nullable=False)
     content = Column(Text, nullable=False)
     is_processed = Column(Boolean, default=False)
+    source_fingerprint = Column(String, nullable=True)
+    is_compressed = Column(
+        Boolean, nullable=False, default=False
+    )  # Trueの場合は内容を memory_cold_contents に圧縮して保存
+    content_version = Column(
+        Integer, nullable=False, default=1
+    )  # 内容を更新するたびに増加する（保存したインデックスの検証に使用）
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
 
+class MemoryColdContent(Base):
+    """圧縮された記憶内容モデル
+
+    古いdaily_raw記憶の内容をzlibで圧縮して保存する。内容を移した記憶の
+    content列は空になり、取得時に展開される。
+    """
+
+    __tablename__ = "memory_cold_contents"
+
+    memory_id = Column(
+        UUID(as_uuid=True),
+        ForeignKey("memories.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    compressed_content = Column(LargeBinary, nullable=False)
+    original_bytes = Column(Integer, nullable=False)
+    compressed_bytes = Column(Integer, nullable=False)
+    compressed_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
 class Session(Base):
     """セッションモデル
 
@@ -64,6 +106,16 @@ class Session(Base):
     """
 
     __tablename__ = "sessions"
+    __table_args__ = (
+        # キャラクターごとのアクティブなセッションを1つに制限する部分一意インデックス
+        Index(
+            "idx_sessions_one_active_per_character",
+            "character_id",
+            unique=True,
+            postgresql_where=text("is_active"),
+            sqlite_where=text("is_active"),
+        ),
+    )
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     user_id = Column(UUID(as_uuid=True), nullable=False)
@@ -83,3 +135,38 @@ class Session(Base):
     last_updated_at = Column(
         DateTime(timezone=True), server_default=func.now(), onupdate=func.now()
     )
+
+
+class SleepJob(Base):
+    """睡眠処理ジョブモデル
+
+    ワーカーが取得して実行する睡眠処理のキューを保存する。
+    実行中のジョブはリース期限までにハートビートで延長しない場合、
+    他のワーカーが再取得できる。
+    """
+
+    __tablename__ = "sleep_jobs"
+    __table_args__ = (Index("idx_sleep_jobs_status_run_after", "status", "run_after"),)
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    character_id = Column(
+        UUID(as_uuid=True),
+        ForeignKey("characters.id", ondelete="CASCADE"),
+        nullable=False,
+    )
+    current_day = Column(Integer, nullable=False)
+    status = Column(
+        String, nullable=False, default="pending"
+    )  # 'pending', 'running', 'completed', 'dead'
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=5)
+    run_after = Column(DateTime(timezone=True), nullable=False)
+    locked_by = Column(String, nullable=True)
+    lease_expires_at = Column(DateTime(timezone=True), nullable=True)
+    heartbeat_at = Column(DateTime(timezone=True), nullable=True)
+    last_error = Column(Text, nullable=True)
+    result = Column(JSON, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(
+        DateTime(timezone=True), server_default=func.now(), onupdate=func.now()
+    )
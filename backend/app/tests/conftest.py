@@ -1,7 +1,10 @@
+import os
 import uuid
 
 import pytest
+import pytest_asyncio
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import StaticPool
 
@@ -11,6 +14,29 @@ from app.models import Character, Memory
 
 # テスト用データベースの設定 - 常にSQLiteインメモリを使用
 TEST_DATABASE_URL = "sqlite:///:memory:"
+TEST_ASYNC_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--run-slow",
+        action="store_true",
+        default=False,
+        help="slowマーカーのテスト（ベンチマークなど）も実行する",
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    """slowマーカーのテストは --run-slow または RUN_SLOW_TESTS=1 の場合のみ実行する"""
+    if config.getoption("--run-slow") or os.environ.get("RUN_SLOW_TESTS") == "1":
+        return
+
+    skip_slow = pytest.mark.skip(
+        reason="--run-slow または RUN_SLOW_TESTS=1 で実行します"
+    )
+    for item in items:
+        if "slow" in item.keywords:
+            item.add_marker(skip_slow)
 
 
 @pytest.fixture(scope="session")
@@ -45,6 +71,41 @@ def db_session(test_engine):
         session.close()
 
 
+@pytest.fixture
+def session_factory(tmp_path):
+    """スレッドから並行に使用できるセッションファクトリ
+
+    ワーカーや並行な睡眠処理はデータベースの処理をスレッドで実行するため、
+    セッションごとに接続を持つファイルのデータベースを使用する。
+    """
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'threaded.db'}",
+        connect_args={"check_same_thread": False, "timeout": 30},
+    )
+    with engine.connect() as conn:
+        # 読み込み中のセッションが他のセッションの書き込みを妨げないようにする
+        conn.exec_driver_sql("PRAGMA journal_mode=WAL")
+    Base.metadata.create_all(bind=engine)
+    yield sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine.dispose()
+
+
+@pytest_asyncio.fixture
+async def async_db_session():
+    """テスト関数ごとの非同期データベースセッション"""
+    engine = create_async_engine(TEST_ASYNC_DATABASE_URL, poolclass=StaticPool)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    TestingAsyncSessionLocal = async_sessionmaker(
+        bind=engine, autoflush=False, expire_on_commit=False
+    )
+    async with TestingAsyncSessionLocal() as session:
+        yield session
+
+    await engine.dispose()
+
+
 @pytest.fixture
 def test_user_id():
     """テスト用ユーザーID"""
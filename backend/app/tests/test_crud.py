@@ -1,6 +1,25 @@
-import pytest
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from unittest.mock import patch
 
-from app.core.constants import MEMORY_TYPE_DAILY_RAW, SESSION_TYPE_CONVERSATION
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from app.core.constants import (
+    MEMORY_TYPE_DAILY_RAW,
+    MEMORY_TYPE_DAILY_SUMMARY,
+    SESSION_TYPE_CONVERSATION,
+    SLEEP_JOB_STATUS_DEAD,
+    SLEEP_JOB_STATUS_PENDING,
+    SLEEP_JOB_STATUS_RUNNING,
+)
+from app.core.database import Base
+from app.crud import async_crud
 from app.crud.character import (
     create_character,
     delete_character,
@@ -9,12 +28,36 @@ from app.crud.character import (
     update_character,
 )
 from app.crud.memory import (
+    add_memories_bulk,
     add_memory,
+    batched_writes,
+    compress_old_daily_raw,
     delete_memory,
+    get_cold_storage_stats,
     get_memories_by_character,
+    get_memories_page,
+    get_memory_metadata_in_ranges,
+    in_batched_writes,
+    iter_memories_by_character,
     update_memory,
 )
-from app.crud.session import create_session, end_session, get_active_session
+from app.crud.session import (
+    create_session,
+    end_session,
+    get_active_session,
+    get_sessions_by_character,
+)
+from app.crud.sleep_job import (
+    claim_sleep_jobs,
+    complete_sleep_job,
+    enqueue_sleep_job,
+    fail_sleep_job,
+    get_dead_sleep_jobs,
+    get_sleep_job,
+    heartbeat_sleep_job,
+    retry_dead_sleep_job,
+)
+from app.models import Memory, MemoryColdContent, SleepJob
 from app.models import Session as DbSession
 
 
@@ -112,6 +155,61 @@ class TestMemoryCRUD:
 
         assert all(m.memory_type == MEMORY_TYPE_DAILY_RAW for m in filtered)
 
+    def test_get_memories_page_and_iter(self, db_session, test_character):
+        """カーソルによるページ取得と全件の順次取得のテスト"""
+        for day in range(1, 126):
+            for _ in range(2):
+                add_memory(
+                    db=db_session,
+                    user_id=test_character.user_id,
+                    character_id=test_character.id,
+                    memory_type=MEMORY_TYPE_DAILY_RAW,
+                    start_day=day,
+                    end_day=day,
+                    content=f"{day}日目の記録",
+                )
+
+        pages = []
+        cursor = None
+        while True:
+            page, cursor = get_memories_page(
+                db=db_session,
+                character_id=test_character.id,
+                after=cursor,
+                limit=64,
+            )
+            pages.append(page)
+            if cursor is None:
+                break
+
+        paged = [m.id for page in pages for m in page]
+        assert [len(page) for page in pages] == [64, 64, 64, 58]
+        assert len(set(paged)) == 250
+
+        streamed = iter_memories_by_character(
+            db=db_session, character_id=test_character.id, batch_size=16
+        )
+        assert [m.id for m in streamed] == paged
+
+        # デフォルトの件数上限で切り詰められるのはオフセット方式のみ
+        assert len(get_memories_by_character(db_session, test_character.id)) == 100
+
+        windowed = list(
+            iter_memories_by_character(
+                db=db_session,
+                character_id=test_character.id,
+                start_day=10,
+                end_day=19,
+            )
+        )
+        assert len(windowed) == 20
+        assert [m.start_day for m in windowed] == sorted(
+            (m.start_day for m in windowed), reverse=True
+        )
+
+        with pytest.raises(HTTPException):
+            get_memories_page(db=db_session, character_id=test_character.id, limit=0)
+
     def test_update_memory(self, db_session, test_memory):
         """記憶更新のテスト"""
         updated = update_memory(
@@ -139,6 +237,308 @@ class TestMemoryCRUD:
 
         assert result is True
 
+    def test_batched_writes(self, db_session, test_character):
+        """書き込みをまとめて1回のコミットで確定するかのテスト"""
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement.lstrip().upper())
+
+        engine = db_session.get_bind()
+        event.listen(engine, "before_cursor_execute", record)
+        try:
+            with (
+                patch("app.crud.memory.memory_search_index") as search_index,
+                patch.object(db_session, "commit", wraps=db_session.commit) as commit,
+            ):
+                with batched_writes(db_session):
+                    memories = [
+                        add_memory(
+                            db=db_session,
+                            user_id=test_character.user_id,
+                            character_id=test_character.id,
+                            memory_type=MEMORY_TYPE_DAILY_RAW,
+                            start_day=day,
+                            end_day=day,
+                            content=f"{day}日目の記憶",
+                        )
+                        for day in (1, 2, 3)
+                    ]
+                    # サーバー側の既定値は refresh せずに INSERT ... RETURNING で取得する
+                    assert all(memory.created_at is not None for memory in memories)
+                    update_memory(db_session, memories[0].id, content="更新後の記憶")
+                    delete_memory(db_session, memories[2].id)
+                    assert commit.call_count == 0
+                    assert search_index.add_memory.call_count == 0
+
+                assert commit.call_count == 1
+                assert search_index.add_memory.call_count == 4
+                assert search_index.remove_memory.call_count == 1
+        finally:
+            event.remove(engine, "before_cursor_execute", record)
+
+        # update_memory と delete_memory の対象の取得以外に SELECT を発行しない
+        assert len([s for s in statements if s.startswith("SELECT")]) == 2
+        assert len([s for s in statements if s.startswith("INSERT")]) == 3
+        assert [
+            memory.content
+            for memory in get_memories_by_character(db_session, test_character.id)
+        ] == ["2日目の記憶", "更新後の記憶"]
+
+    def test_after_commit_failure_is_isolated(self, db_session, test_character):
+        """コミット後の処理の失敗が書き込みと他の処理に影響しないかのテスト"""
+        with (
+            patch("app.crud.memory.memory_context_cache") as cache,
+            patch("app.crud.memory.memory_search_index") as search_index,
+            patch("app.crud.memory.memory_embedding_store") as embedding_store,
+        ):
+            search_index.add_memory.side_effect = RuntimeError(
+                "インデックスの更新に失敗"
+            )
+            with batched_writes(db_session):
+                for day in (1, 2):
+                    add_memory(
+                        db=db_session,
+                        user_id=test_character.user_id,
+                        character_id=test_character.id,
+                        memory_type=MEMORY_TYPE_DAILY_RAW,
+                        start_day=day,
+                        end_day=day,
+                        content=f"{day}日目の記憶",
+                    )
+            memory = add_memory(
+                db=db_session,
+                user_id=test_character.user_id,
+                character_id=test_character.id,
+                memory_type=MEMORY_TYPE_DAILY_RAW,
+                start_day=3,
+                end_day=3,
+                content="3日目の記憶",
+            )
+
+        assert memory.content == "3日目の記憶"
+        assert cache.invalidate.call_count == 3
+        assert search_index.add_memory.call_count == 3
+        assert embedding_store.add_memory.call_count == 3
+        assert len(get_memories_by_character(db_session, test_character.id)) == 3
+
+    def test_batched_writes_rollback(self, db_session, test_character):
+        """例外が発生した場合にまとめた書き込みをすべて破棄するかのテスト"""
+        with patch("app.crud.memory.memory_search_index") as search_index:
+            with pytest.raises(RuntimeError):
+                with batched_writes(db_session):
+                    add_memory(
+                        db=db_session,
+                        user_id=test_character.user_id,
+                        character_id=test_character.id,
+                        memory_type=MEMORY_TYPE_DAILY_RAW,
+                        start_day=1,
+                        end_day=1,
+                        content="破棄される記憶",
+                    )
+                    raise RuntimeError("処理が中断されました")
+
+        assert search_index.add_memory.call_count == 0
+        assert get_memories_by_character(db_session, test_character.id) == []
+        assert not in_batched_writes(db_session)
+
+    def test_add_memories_bulk(self, db_session, test_character):
+        """チャンクごとに1回のINSERTで記憶をまとめて追加するかのテスト"""
+        rows = [
+            {
+                "user_id": test_character.user_id,
+                "character_id": test_character.id,
+                "memory_type": MEMORY_TYPE_DAILY_RAW,
+                "start_day": day,
+                "end_day": day,
+                "content": f"{day}日目の記憶",
+            }
+            for day in range(1, 2501)
+        ]
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement.lstrip().upper())
+
+        engine = db_session.get_bind()
+        event.listen(engine, "before_cursor_execute", record)
+        try:
+            with (
+                patch("app.crud.memory.memory_context_cache") as cache,
+                patch("app.crud.memory.memory_search_index") as search_index,
+                patch("app.crud.memory.memory_embedding_store") as embedding_store,
+                patch.object(db_session, "commit", wraps=db_session.commit) as commit,
+            ):
+                assert (
+                    add_memories_bulk(db_session, iter(rows), chunk_size=1000) == 2500
+                )
+            assert commit.call_count == 1
+            # 記憶ごとではなくキャラクターごとに1回だけ反映する
+            cache.invalidate.assert_called_once_with(test_character.id, 1)
+            search_index.drop_character.assert_called_once_with(test_character.id)
+            embedding_store.drop_character.assert_called_once_with(test_character.id)
+            assert search_index.add_memory.call_count == 0
+            assert embedding_store.add_memory.call_count == 0
+        finally:
+            event.remove(engine, "before_cursor_execute", record)
+
+        assert len([s for s in statements if s.startswith("INSERT")]) == 3
+        page, _ = get_memories_page(db_session, test_character.id, limit=2)
+        assert [memory.content for memory in page] == [
+            "2500日目の記憶",
+            "2499日目の記憶",
+        ]
+
+        # RETURNING で追加した順の記憶IDを取得する
+        given_ids = [uuid.uuid4() for _ in range(5)]
+        ids = add_memories_bulk(
+            db_session,
+            [
+                {**row, "id": memory_id, "start_day": 3000 + day, "end_day": 3000 + day}
+                for day, (row, memory_id) in enumerate(zip(rows, given_ids))
+            ],
+            chunk_size=2,
+            return_ids=True,
+        )
+        assert ids == given_ids
+        memories = get_memories_by_character(
+            db_session, test_character.id, start_day=3000
+        )
+        assert [memory.id for memory in memories] == given_ids[::-1]
+
+        # 必須の項目がない場合は何も追加しない
+        with pytest.raises(HTTPException) as exc_info:
+            add_memories_bulk(
+                db_session,
+                [
+                    {**rows[0], "start_day": 4000, "end_day": 4000},
+                    {"content": "不完全"},
+                ],
+            )
+        assert exc_info.value.status_code == 400
+        assert (
+            get_memories_by_character(db_session, test_character.id, start_day=4000)
+            == []
+        )
+
+    @pytest.mark.slow
+    def test_add_memories_bulk_benchmark(self, db_session, test_character):
+        """記憶の一括追加の速度のベンチマーク"""
+        count = 20_000
+        rows = [
+            {
+                "user_id": test_character.user_id,
+                "character_id": test_character.id,
+                "memory_type": MEMORY_TYPE_DAILY_RAW,
+                "start_day": day,
+                "end_day": day,
+                "content": f"{day}日目の記憶",
+            }
+            for day in range(1, count + 1)
+        ]
+
+        started = time.perf_counter()
+        add_memories_bulk(db_session, rows)
+        rows_per_second = count / (time.perf_counter() - started)
+
+        # 後続のテストに影響しないよう追加した記憶を削除する
+        db_session.query(Memory).filter(
+            Memory.character_id == test_character.id
+        ).delete()
+        db_session.commit()
+
+        assert rows_per_second > 10_000, f"1秒あたり {rows_per_second:.0f} 件"
+
+    def test_compress_old_daily_raw(self, db_session, test_character):
+        """古いdaily_rawを圧縮し、取得時に展開するかのテスト"""
+        for day in (1, 2, 3):
+            add_memory(
+                db=db_session,
+                user_id=test_character.user_id,
+                character_id=test_character.id,
+                memory_type=MEMORY_TYPE_DAILY_RAW,
+                start_day=day,
+                end_day=day,
+                content=f"{day}日目の会話。" * 50,
+            )
+        for day in (1, 2):
+            add_memory(
+                db=db_session,
+                user_id=test_character.user_id,
+                character_id=test_character.id,
+                memory_type=MEMORY_TYPE_DAILY_SUMMARY,
+                start_day=day,
+                end_day=day,
+                content=f"{day}日目の要約",
+            )
+
+        # 作成から日数が経っていない記憶は対象外
+        assert compress_old_daily_raw(db_session)["compressed_count"] == 0
+
+        # daily_summaryがない3日目は圧縮しない
+        report = compress_old_daily_raw(
+            db_session, now=datetime.now() + timedelta(days=60)
+        )
+        original_bytes = len(("1日目の会話。" * 50).encode("utf-8")) * 2
+        assert report["compressed_count"] == 2
+        assert report["original_bytes"] == original_bytes
+        assert 0 < report["bytes_reclaimed"] < original_bytes
+        assert get_cold_storage_stats(db_session, test_character.id) == report
+
+        # memoriesテーブルの内容は空になり、取得時に展開される
+        db_session.expire_all()
+        hot_contents = dict(
+            db_session.query(Memory.start_day, Memory.content).filter(
+                Memory.character_id == test_character.id,
+                Memory.memory_type == MEMORY_TYPE_DAILY_RAW,
+            )
+        )
+        assert hot_contents == {1: "", 2: "", 3: "3日目の会話。" * 50}
+        raw_memories = get_memories_by_character(
+            db_session, test_character.id, memory_type=MEMORY_TYPE_DAILY_RAW
+        )
+        assert [memory.content for memory in raw_memories] == [
+            f"{day}日目の会話。" * 50 for day in (3, 2, 1)
+        ]
+
+        # 展開した内容はコミットしてもcontent列に書き戻されない
+        db_session.commit()
+        assert (
+            db_session.query(Memory.content)
+            .filter(Memory.id == raw_memories[2].id)
+            .scalar()
+            == ""
+        )
+
+        # メタデータの長さは圧縮前のバイト数を返す
+        lengths = {
+            row.start_day: row.content_length
+            for row in get_memory_metadata_in_ranges(
+                db_session, test_character.id, [(MEMORY_TYPE_DAILY_RAW, None, None)]
+            )
+        }
+        assert lengths == {
+            1: original_bytes // 2,
+            2: original_bytes // 2,
+            3: len("3日目の会話。" * 50),
+        }
+
+        # 内容以外を更新した記憶は展開した内容を返す
+        db_session.expire_all()
+        retagged = update_memory(
+            db_session, raw_memories[2].id, source_fingerprint="retagged"
+        )
+        assert retagged.is_compressed is True
+        assert retagged.content == "1日目の会話。" * 50
+
+        # 更新した記憶は圧縮を解除し、削除した記憶は圧縮済みの内容も削除する
+        updated = update_memory(db_session, raw_memories[2].id, content="更新後の会話")
+        assert updated.content == "更新後の会話"
+        assert updated.is_compressed is False
+        delete_memory(db_session, raw_memories[1].id)
+        assert db_session.query(MemoryColdContent).count() == 0
+        assert get_cold_storage_stats(db_session)["compressed_count"] == 0
+
 
 @pytest.mark.unit
 class TestSessionCRUD:
@@ -158,6 +558,99 @@ class TestSessionCRUD:
         assert session.device_id == "test-device"
         assert session.is_active is True
 
+    def test_create_session_single_statement(
+        self, db_session, test_user_id, test_character
+    ):
+        """アクティブなセッションの確認と作成を1回のINSERTで行うかのテスト"""
+        for active in get_sessions_by_character(
+            db_session, test_character.id, active_only=True
+        ):
+            end_session(db_session, active.id)
+
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement.lstrip().upper())
+
+        engine = db_session.get_bind()
+        event.listen(engine, "before_cursor_execute", record)
+        try:
+            session = create_session(
+                db=db_session,
+                user_id=test_user_id,
+                character_id=test_character.id,
+                device_id="device-a",
+                session_type=SESSION_TYPE_CONVERSATION,
+            )
+        finally:
+            event.remove(engine, "before_cursor_execute", record)
+
+        assert len(statements) == 1
+        assert statements[0].startswith("INSERT INTO SESSIONS")
+        assert "ON CONFLICT" in statements[0] and "RETURNING" in statements[0]
+        assert session.is_active is True
+
+        # 他のデバイスからの開始は409になり、終了後は同じデバイスから再び開始できる
+        with pytest.raises(HTTPException) as exc_info:
+            create_session(
+                db=db_session,
+                user_id=test_user_id,
+                character_id=test_character.id,
+                device_id="device-b",
+                session_type=SESSION_TYPE_CONVERSATION,
+            )
+        assert exc_info.value.status_code == 409
+
+        end_session(db_session, session.id)
+        restarted = create_session(
+            db=db_session,
+            user_id=test_user_id,
+            character_id=test_character.id,
+            device_id="device-a",
+            session_type=SESSION_TYPE_CONVERSATION,
+        )
+        assert restarted.id != session.id
+        end_session(db_session, restarted.id)
+
+    def test_create_session_concurrently(self, tmp_path, test_user_id):
+        """複数のデバイスから同時に開始した場合に1つだけ作成されるかのテスト"""
+        engine = create_engine(
+            f"sqlite:///{tmp_path / 'sessions.db'}",
+            connect_args={"check_same_thread": False, "timeout": 30},
+        )
+        Base.metadata.create_all(bind=engine)
+        factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+        with factory() as db:
+            character_id = create_character(db, test_user_id, "同時開始").id
+
+        barrier = threading.Barrier(8)
+
+        def start(index):
+            with factory() as db:
+                barrier.wait()
+                try:
+                    create_session(
+                        db=db,
+                        user_id=test_user_id,
+                        character_id=character_id,
+                        device_id=f"device-{index}",
+                        session_type=SESSION_TYPE_CONVERSATION,
+                    )
+                    return 201
+                except HTTPException as e:
+                    return e.status_code
+
+        try:
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                results = list(executor.map(start, range(8)))
+            with factory() as db:
+                active = get_sessions_by_character(db, character_id, active_only=True)
+        finally:
+            engine.dispose()
+
+        assert sorted(results) == [201] + [409] * 7
+        assert len(active) == 1
+
     def test_get_active_session(self, db_session, test_user_id, test_character):
         """アクティブセッション取得のテスト"""
         # 既存のアクティブセッションを終了
@@ -220,3 +713,138 @@ class TestSessionCRUD:
         # 確認
         active = get_active_session(db_session, test_character.id)
         assert active is None
+
+
+@pytest.mark.unit
+class TestSleepJobCRUD:
+    def test_claim_complete_and_lease_expiry(self, db_session, test_character):
+        """ジョブの取得・リース期限切れの再取得・完了のテスト"""
+        db_session.query(SleepJob).delete()
+        db_session.commit()
+        now = datetime.now()
+        first = enqueue_sleep_job(db_session, test_character.id, 1, run_after=now)
+        second = enqueue_sleep_job(
+            db_session, test_character.id, 2, run_after=now + timedelta(seconds=1)
+        )
+        enqueue_sleep_job(
+            db_session, test_character.id, 3, run_after=now + timedelta(hours=1)
+        )
+
+        claimed = claim_sleep_jobs(
+            db_session, "worker-a", limit=5, lease_seconds=60, now=now
+        )
+        assert [job.id for job in claimed] == [first.id]
+        assert claimed[0].status == SLEEP_JOB_STATUS_RUNNING
+        assert claimed[0].attempts == 1
+        assert claimed[0].locked_by == "worker-a"
+
+        # リース期間中は他のワーカーに取得されない
+        later = now + timedelta(seconds=30)
+        claimed = claim_sleep_jobs(
+            db_session, "worker-b", limit=5, lease_seconds=60, now=later
+        )
+        assert [job.id for job in claimed] == [second.id]
+        assert heartbeat_sleep_job(
+            db_session, first.id, "worker-a", lease_seconds=60, now=later
+        )
+        assert not heartbeat_sleep_job(db_session, first.id, "worker-b")
+
+        # リース期限を過ぎたジョブは他のワーカーが再取得する
+        expired = later + timedelta(seconds=61)
+        claimed = claim_sleep_jobs(
+            db_session, "worker-b", limit=5, lease_seconds=60, now=expired
+        )
+        assert {job.id for job in claimed} == {first.id, second.id}
+        assert get_sleep_job(db_session, first.id).attempts == 2
+        assert not complete_sleep_job(db_session, first.id, "worker-a")
+        assert complete_sleep_job(db_session, first.id, "worker-b", {"count": 1})
+        assert get_sleep_job(db_session, first.id).result == {"count": 1}
+
+    def test_fail_retry_and_dead_letter(self, db_session, test_character):
+        """失敗したジョブの再試行と破棄のテスト"""
+        db_session.query(SleepJob).delete()
+        db_session.commit()
+        now = datetime.now()
+        job = enqueue_sleep_job(
+            db_session, test_character.id, 1, max_attempts=2, run_after=now
+        )
+
+        claim_sleep_jobs(db_session, "worker-a", now=now)
+        assert (
+            fail_sleep_job(db_session, job.id, "worker-a", "失敗", 10, now=now)
+            == SLEEP_JOB_STATUS_PENDING
+        )
+        assert claim_sleep_jobs(db_session, "worker-a", now=now) == []
+
+        retry_at = now + timedelta(seconds=10)
+        assert len(claim_sleep_jobs(db_session, "worker-a", now=retry_at)) == 1
+        assert (
+            fail_sleep_job(db_session, job.id, "worker-a", "再び失敗", now=retry_at)
+            == SLEEP_JOB_STATUS_DEAD
+        )
+        assert claim_sleep_jobs(db_session, "worker-a", now=retry_at) == []
+        dead = get_dead_sleep_jobs(db_session)
+        assert [dead_job.id for dead_job in dead] == [job.id]
+        assert dead[0].last_error == "再び失敗"
+
+        retried = retry_dead_sleep_job(db_session, job.id)
+        assert retried.status == SLEEP_JOB_STATUS_PENDING
+        assert retried.attempts == 0
+        with pytest.raises(HTTPException) as excinfo:
+            retry_dead_sleep_job(db_session, job.id)
+        assert excinfo.value.status_code == 409
+
+        with pytest.raises(HTTPException):
+            enqueue_sleep_job(db_session, test_character.id, 1, max_attempts=0)
+
+
+@pytest.mark.unit
+class TestAsyncCRUD:
+    @pytest.mark.asyncio
+    async def test_character_and_memory(self, async_db_session, test_user_id):
+        """AsyncSessionでのキャラクター・記憶操作のテスト"""
+        character = await async_crud.create_character(
+            async_db_session, test_user_id, "非同期キャラクター"
+        )
+        assert (
+            await async_crud.get_character(async_db_session, character.id)
+        ).name == ("非同期キャラクター")
+
+        memory = await async_crud.add_memory(
+            async_db_session,
+            user_id=test_user_id,
+            character_id=character.id,
+            memory_type=MEMORY_TYPE_DAILY_RAW,
+            start_day=1,
+            end_day=1,
+            content="非同期の記憶",
+        )
+        memories = await async_crud.get_memories_by_character(
+            async_db_session, character.id
+        )
+        assert [m.id for m in memories] == [memory.id]
+
+        updated = await async_crud.update_memory(
+            async_db_session, memory.id, content="更新された非同期の記憶"
+        )
+        assert updated.content == "更新された非同期の記憶"
+        assert await async_crud.delete_memory(async_db_session, memory.id) is True
+
+    @pytest.mark.asyncio
+    async def test_session(self, async_db_session, test_user_id):
+        """AsyncSessionでのセッション操作のテスト"""
+        character = await async_crud.create_character(
+            async_db_session, test_user_id, "非同期セッション"
+        )
+        session = await async_crud.create_session(
+            async_db_session,
+            user_id=test_user_id,
+            character_id=character.id,
+            device_id="async-device",
+            session_type=SESSION_TYPE_CONVERSATION,
+        )
+        active = await async_crud.get_active_session(async_db_session, character.id)
+        assert active.id == session.id
+
+        ended = await async_crud.end_session(async_db_session, session.id)
+        assert ended.is_active is False
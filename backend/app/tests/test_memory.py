@@ -1,16 +1,71 @@
+import asyncio
+import sqlite3
+import threading
+import time
 import uuid
+from datetime import datetime, timedelta
 from unittest.mock import MagicMock, patch
 
+import httpx
+import litellm
+import numpy as np
 import pytest
+from fastapi import HTTPException
+from sqlalchemy import event
 
 from app.core.constants import (
     MEMORY_TYPE_DAILY_RAW,
     MEMORY_TYPE_DAILY_SUMMARY,
     MEMORY_TYPE_LEVEL_10,
+    MEMORY_TYPE_LEVEL_100,
+    MEMORY_TYPE_LEVEL_1000,
+    MEMORY_TYPE_LEVEL_ARCHIVE,
+    SESSION_PROP_COMPLETED_STEPS,
+    SESSION_STATUS_ERROR,
+    SLEEP_JOB_STATUS_COMPLETED,
+    SLEEP_JOB_STATUS_DEAD,
+    SLEEP_JOB_STATUS_RUNNING,
 )
-from app.memory.generator import MemoryGenerator
-from app.memory.processor import SleepProcessor
-from app.memory.retriever import MemoryRetriever
+from app.crud import async_crud
+from app.crud import memory as memory_crud
+from app.crud import sleep_job as sleep_job_crud
+from app.crud.character import create_character
+from app.crud.memory import add_memory, delete_memory, update_memory
+from app.crud.session import get_sessions_by_character
+from app.crud.sleep_job import enqueue_sleep_job
+from app.memory.async_retriever import AsyncMemoryRetriever, get_memory_context_async
+from app.memory.cache import MemoryContextCache, memory_context_cache
+from app.memory.embeddings import (
+    CharacterVectorStore,
+    HashingEmbeddingProvider,
+    LiteLLMEmbeddingProvider,
+    MemoryEmbeddingStore,
+)
+from app.memory.generator import MemoryGenerator, compute_source_fingerprint
+from app.memory.llm import (
+    CircuitBreaker,
+    CircuitOpenError,
+    LLMCallController,
+    LLMConcurrencyLimiter,
+    LLMRateLimiter,
+    get_llm_provider,
+)
+from app.memory.llm_cache import LLMResponseCache, make_cache_key
+from app.memory.planner import SummaryTask, build_catch_up_plan
+from app.memory.processor import SleepProcessor, process_daily_memories_for_characters
+from app.memory.retriever import (
+    MemoryRetriever,
+    get_memories_for_sessions,
+    get_memory_context,
+    warm_memory_context_cache,
+)
+from app.memory.routing import ModelRouter
+from app.memory.scoring import HybridScorer
+from app.memory.search import MemorySearchIndex, memory_search_index, tokenize
+from app.memory.tokens import estimate_tokens
+from app.memory.worker import SleepWorker
+from app.models import Character, SleepJob
+from app.models import Session as DbSession
 
 
 @pytest.mark.unit
@@ -94,6 +149,973 @@ class TestMemoryGenerator:
             assert level_10.end_day == 10
             assert level_10.content == "これはモックLLMの応答です。"
 
+    def test_summary_skips_unchanged_inputs(self, db_session, test_character):
+        """入力が変わっていない要約の再生成を省略するテスト"""
+        raw = add_memory(
+            db=db_session,
+            user_id=test_character.user_id,
+            character_id=test_character.id,
+            memory_type=MEMORY_TYPE_DAILY_RAW,
+            start_day=1,
+            end_day=1,
+            content="テスト会話",
+        )
+        generator = MemoryGenerator(db_session, test_character.id, "dummy-model")
+
+        with patch.object(
+            generator, "_call_llm", side_effect=["要約1", "要約2", "要約3"]
+        ) as mock_call_llm:
+            first = generator.generate_daily_summary(1)
+            again = generator.generate_daily_summary(1)
+            assert mock_call_llm.call_count == 1
+            assert again.id == first.id
+            assert first.source_fingerprint == compute_source_fingerprint([raw])
+
+            # 入力が変わった場合は同じ行を置き換える
+            update_memory(db=db_session, memory_id=raw.id, content="変更された会話")
+            replaced = generator.generate_daily_summary(1)
+            assert mock_call_llm.call_count == 2
+            assert replaced.id == first.id
+            assert replaced.content == "要約2"
+
+            # 重複した要約は1件にまとめる
+            add_memory(
+                db=db_session,
+                user_id=test_character.user_id,
+                character_id=test_character.id,
+                memory_type=MEMORY_TYPE_DAILY_SUMMARY,
+                start_day=1,
+                end_day=1,
+                content="重複した要約",
+            )
+            merged = generator.generate_daily_summary(1)
+            assert mock_call_llm.call_count == 3
+            assert generator.generate_daily_summary(1).id == merged.id
+            assert mock_call_llm.call_count == 3
+
+        summaries = memory_crud.get_memories_for_range(
+            db_session, test_character.id, MEMORY_TYPE_DAILY_SUMMARY, 1, 1
+        )
+        assert [m.content for m in summaries] == ["要約3"]
+
+    def test_replacing_summary_is_atomic(self, db_session, test_character):
+        """要約の置き換えに失敗した場合に重複の削除も取り消されるかのテスト"""
+        add_memory(
+            db=db_session,
+            user_id=test_character.user_id,
+            character_id=test_character.id,
+            memory_type=MEMORY_TYPE_DAILY_RAW,
+            start_day=1,
+            end_day=1,
+            content="テスト会話",
+        )
+        for content in ("古い要約", "重複した要約"):
+            add_memory(
+                db=db_session,
+                user_id=test_character.user_id,
+                character_id=test_character.id,
+                memory_type=MEMORY_TYPE_DAILY_SUMMARY,
+                start_day=1,
+                end_day=1,
+                content=content,
+            )
+        generator = MemoryGenerator(db_session, test_character.id, "dummy-model")
+
+        with (
+            patch.object(generator, "_call_llm", return_value="新しい要約"),
+            patch(
+                "app.memory.generator.memory_crud.update_memory",
+                side_effect=HTTPException(status_code=500, detail="更新に失敗"),
+            ),
+            pytest.raises(HTTPException),
+        ):
+            generator.generate_daily_summary(1)
+
+        summaries = memory_crud.get_memories_for_range(
+            db_session, test_character.id, MEMORY_TYPE_DAILY_SUMMARY, 1, 1
+        )
+        assert sorted(m.content for m in summaries) == ["古い要約", "重複した要約"]
+
+    def test_hierarchical_summary_skips_unchanged_inputs(
+        self, db_session, test_character
+    ):
+        """入力が変わっていない階層的要約の再生成を省略するテスト"""
+        for day in (1, 2):
+            add_memory(
+                db=db_session,
+                user_id=test_character.user_id,
+                character_id=test_character.id,
+                memory_type=MEMORY_TYPE_DAILY_SUMMARY,
+                start_day=day,
+                end_day=day,
+                content=f"{day}日目の要約",
+            )
+        processor = SleepProcessor(db_session, test_character.id, "dummy-model")
+
+        with patch.object(
+            processor.memory_generator, "_call_llm", return_value="10日間の要約"
+        ) as mock_call_llm:
+            processor.process_daily_memories(current_day=10)
+            processor.process_daily_memories(current_day=10)
+
+        assert mock_call_llm.call_count == 1
+        level_10 = memory_crud.get_memories_for_range(
+            db_session, test_character.id, MEMORY_TYPE_LEVEL_10, 1, 10
+        )
+        assert len(level_10) == 1
+
+    def test_generate_hierarchical_summary_map_reduce(self, db_session, test_character):
+        """入力が大きい場合に分割して要約してから統合するテスト"""
+        for index in range(6):
+            add_memory(
+                db=db_session,
+                user_id=test_character.user_id,
+                character_id=test_character.id,
+                memory_type=MEMORY_TYPE_LEVEL_10,
+                start_day=index * 10 + 1,
+                end_day=index * 10 + 10,
+                content=f"期間{index}の出来事" * 20,
+            )
+        generator = MemoryGenerator(
+            db_session, test_character.id, "dummy-model", chunk_tokens=300
+        )
+        prompts = []
+
+        def fake_call_llm(prompt, messages=None, memory_type=None):
+            prompts.append(prompt)
+            return f"要約{len(prompts)}"
+
+        with patch.object(generator, "_call_llm", side_effect=fake_call_llm):
+            summary = generator.generate_hierarchical_summary(
+                MEMORY_TYPE_LEVEL_100, start_day=1, end_day=100
+            )
+
+        # 2件ずつの3グループを要約した後、部分要約を1回で統合する
+        assert len(prompts) == 4
+        assert all(prompt.count("Day ") == 2 for prompt in prompts[:3])
+        assert "Day 1-60:" not in prompts[-1]
+        assert "Day 1-20:" in prompts[-1] and "Day 41-60:" in prompts[-1]
+        assert summary.content == "要約4"
+        assert summary.memory_type == MEMORY_TYPE_LEVEL_100
+
+        # 入力が小さい場合は1回の呼び出しのみ
+        small = MemoryGenerator(db_session, test_character.id, "dummy-model")
+        assert small._plan_summary_round([(1, 10, "短い記憶")] * 6) == [
+            [(1, 10, "短い記憶")] * 6
+        ]
+
+    def test_generate_rolling_archive(self, db_session, test_character):
+        """直前のarchiveに新しいlevel_1000のみを統合するテスト"""
+        for index in range(5):
+            add_memory(
+                db=db_session,
+                user_id=test_character.user_id,
+                character_id=test_character.id,
+                memory_type=MEMORY_TYPE_LEVEL_1000,
+                start_day=index * 1000 + 1,
+                end_day=index * 1000 + 1000,
+                content=f"期間{index}の出来事",
+            )
+        generator = MemoryGenerator(db_session, test_character.id, "dummy-model")
+        prompts = []
+
+        def fake_call_llm(prompt, messages=None, memory_type=None):
+            prompts.append(prompt)
+            return f"archive{len(prompts)}"
+
+        with patch.object(generator, "_call_llm", side_effect=fake_call_llm):
+            for end_day in range(2000, 5001, 1000):
+                archive = generator.generate_hierarchical_summary(
+                    MEMORY_TYPE_LEVEL_ARCHIVE, start_day=1, end_day=end_day
+                )
+
+        # 最初は2件のlevel_1000、以降は直前のarchiveと最新のlevel_1000のみ
+        assert prompts[0].count("Day ") == 2
+        assert "Day 1-2000: archive1" in prompts[1]
+        assert "Day 2001-3000:" in prompts[1] and "Day 1-1000:" not in prompts[1]
+        assert all(prompt.count("Day ") == 2 for prompt in prompts)
+        assert archive.content == "archive4"
+
+        # 古いarchiveは保持数を超えた分だけ削除される
+        archives = memory_crud.get_memories_by_character(
+            db_session, test_character.id, memory_type=MEMORY_TYPE_LEVEL_ARCHIVE
+        )
+        assert sorted(memory.end_day for memory in archives) == [3000, 4000, 5000]
+
+        # fullモードではすべてのlevel_1000を要約し直す
+        full = MemoryGenerator(
+            db_session, test_character.id, "dummy-model", archive_mode="full"
+        )
+        with patch.object(full, "_call_llm", return_value="full") as call_llm:
+            full.generate_hierarchical_summary(
+                MEMORY_TYPE_LEVEL_ARCHIVE, start_day=1, end_day=5000
+            )
+        assert call_llm.call_args.args[0].count("Day ") == 5
+
+        with pytest.raises(ValueError):
+            MemoryGenerator(db_session, test_character.id, archive_mode="unknown")
+
+    @pytest.mark.asyncio
+    async def test_agenerate_hierarchical_summary_map_reduce(
+        self, db_session, test_character
+    ):
+        """非同期の分割要約のテスト"""
+        for index in range(4):
+            add_memory(
+                db=db_session,
+                user_id=test_character.user_id,
+                character_id=test_character.id,
+                memory_type=MEMORY_TYPE_LEVEL_10,
+                start_day=index * 10 + 1,
+                end_day=index * 10 + 10,
+                content=f"期間{index}の出来事" * 20,
+            )
+        generator = MemoryGenerator(
+            db_session, test_character.id, "dummy-model", chunk_tokens=150
+        )
+        active = 0
+        peak = 0
+
+        async def fake_acall_llm(prompt, messages=None, memory_type=None):
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+            return "統合された要約" if "部分要約" in prompt else "部分要約"
+
+        with patch.object(generator, "_acall_llm", side_effect=fake_acall_llm):
+            summary = await generator.agenerate_hierarchical_summary(
+                MEMORY_TYPE_LEVEL_100, start_day=1, end_day=100
+            )
+
+        assert peak == 4
+        assert summary.content == "統合された要約"
+
+    @pytest.mark.asyncio
+    async def test_acall_llm_respects_concurrency_limits(
+        self, db_session, test_character
+    ):
+        """非同期LLM呼び出しの同時実行数制限テスト"""
+        limiter = LLMConcurrencyLimiter(
+            max_concurrency=3, provider_limits={"gemini": 2}
+        )
+        generators = [
+            MemoryGenerator(db_session, test_character.id, model, limiter)
+            for model in ["gemini/gemini-2.0-flash"] * 4 + ["openai/gpt-4o"] * 4
+        ]
+        active = {"total": 0, "gemini": 0}
+        peak = {"total": 0, "gemini": 0}
+
+        async def fake_acompletion(model, messages, stream):
+            keys = ["total"] + (["gemini"] if model.startswith("gemini/") else [])
+            for key in keys:
+                active[key] += 1
+                peak[key] = max(peak[key], active[key])
+            await asyncio.sleep(0.01)
+            for key in keys:
+                active[key] -= 1
+            return MagicMock(
+                choices=[MagicMock(message=MagicMock(content=messages[0]["content"]))]
+            )
+
+        with patch("app.memory.generator.acompletion", side_effect=fake_acompletion):
+            results = await asyncio.gather(
+                *(
+                    generator._acall_llm(f"プロンプト{i}")
+                    for i, generator in enumerate(generators)
+                )
+            )
+
+        assert results == [f"プロンプト{i}" for i in range(8)]
+        assert peak == {"total": 3, "gemini": 2}
+        assert get_llm_provider("gemini/gemini-2.0-flash") == "gemini"
+
+    @pytest.mark.asyncio
+    async def test_process_daily_memories_for_characters(
+        self, session_factory, test_user_id
+    ):
+        """複数キャラクターの記憶処理を並行に実行するテスト"""
+        setup_db = session_factory()
+        characters = [
+            create_character(db=setup_db, user_id=test_user_id, name=f"並行{i}")
+            for i in range(3)
+        ]
+        for character in characters:
+            for day in range(1, 11):
+                add_memory(
+                    db=setup_db,
+                    user_id=test_user_id,
+                    character_id=character.id,
+                    memory_type=MEMORY_TYPE_DAILY_RAW,
+                    start_day=day,
+                    end_day=day,
+                    content=f"{character.name}の{day}日目",
+                )
+
+        # キャラクターの属性はコミット後にDBから読み込み直されるため事前に取り出す
+        names = {character.id: character.name for character in characters}
+
+        async def fake_acall_llm(self, prompt, messages=None, memory_type=None):
+            await asyncio.sleep(0)
+            return f"{names[self.character_id]}の要約"
+
+        sessions = []
+
+        def tracking_session_factory():
+            session = session_factory()
+            sessions.append(session)
+            return session
+
+        # データベースの処理はイベントループのスレッドでは実行しない
+        loop_thread = threading.get_ident()
+        statement_threads = set()
+
+        def record_thread(*args):
+            statement_threads.add(threading.get_ident())
+
+        engine = session_factory.kw["bind"]
+        event.listen(engine, "before_cursor_execute", record_thread)
+        try:
+            with patch.object(MemoryGenerator, "_acall_llm", fake_acall_llm):
+                results = await process_daily_memories_for_characters(
+                    [character.id for character in characters],
+                    10,
+                    session_factory=tracking_session_factory,
+                )
+        finally:
+            event.remove(engine, "before_cursor_execute", record_thread)
+
+        assert statement_threads
+        assert loop_thread not in statement_threads
+
+        # キャラクターごとに別のセッションを使用する
+        assert len({id(session) for session in sessions}) == len(characters)
+        for character in characters:
+            processed = results[character.id]
+            assert [m.memory_type for m in processed] == [
+                MEMORY_TYPE_DAILY_SUMMARY,
+                MEMORY_TYPE_LEVEL_10,
+            ]
+            assert all(m.content == f"{character.name}の要約" for m in processed)
+        setup_db.close()
+
+    @pytest.mark.asyncio
+    async def test_process_daily_memories_for_characters_partial_failure(
+        self, session_factory, test_user_id
+    ):
+        """1キャラクターの処理が途中で失敗しても他のキャラクターの処理を続けるかのテスト"""
+        db = session_factory()
+        succeeding, failing = [
+            create_character(db=db, user_id=test_user_id, name=name)
+            for name in ("成功", "失敗")
+        ]
+        for character in (succeeding, failing):
+            for day in range(1, 11):
+                add_memory(
+                    db=db,
+                    user_id=test_user_id,
+                    character_id=character.id,
+                    memory_type=MEMORY_TYPE_DAILY_RAW,
+                    start_day=day,
+                    end_day=day,
+                    content=f"{character.name}の{day}日目",
+                )
+
+        names = {succeeding.id: "成功", failing.id: "失敗"}
+
+        async def fake_acall_llm(self, prompt, messages=None, memory_type=None):
+            await asyncio.sleep(0)
+            name = names[self.character_id]
+            if name == "失敗" and memory_type == MEMORY_TYPE_LEVEL_10:
+                raise RuntimeError("LLM呼び出しに失敗しました")
+            return f"{name}の要約"
+
+        with patch.object(MemoryGenerator, "_acall_llm", fake_acall_llm):
+            results = await process_daily_memories_for_characters(
+                [succeeding.id, failing.id], 10, session_factory=session_factory
+            )
+
+        assert [m.memory_type for m in results[succeeding.id]] == [
+            MEMORY_TYPE_DAILY_SUMMARY,
+            MEMORY_TYPE_LEVEL_10,
+        ]
+        assert isinstance(results[failing.id], RuntimeError)
+
+        db.expire_all()
+        assert memory_crud.get_memories_by_character(
+            db, succeeding.id, memory_type=MEMORY_TYPE_LEVEL_10
+        )
+        assert not memory_crud.get_memories_by_character(
+            db, failing.id, memory_type=MEMORY_TYPE_LEVEL_10
+        )
+        db.close()
+
+
+@pytest.mark.unit
+class TestLLMResponseCache:
+    def test_get_put_and_persistence(self, tmp_path):
+        """LLM応答のキャッシュと永続化のテスト"""
+        path = str(tmp_path / "llm" / "responses.sqlite3")
+        messages = [{"role": "user", "content": "要約して"}]
+        cache = LLMResponseCache(path)
+
+        assert cache.get("gemini/gemini-2.0-flash", messages) is None
+        cache.put("gemini/gemini-2.0-flash", messages, "要約")
+        assert cache.get("gemini/gemini-2.0-flash", messages) == "要約"
+        assert cache.get("openai/gpt-4o", messages) is None
+
+        stats = cache.stats()
+        assert stats["hits"] == 1
+        assert stats["misses"] == 2
+        assert stats["hit_rate"] == pytest.approx(1 / 3)
+        assert stats["bytes_saved"] == len("要約".encode()) + len("要約して".encode())
+        assert stats["entries"] == 1
+        cache.close()
+
+        reopened = LLMResponseCache(path)
+        assert reopened.get("gemini/gemini-2.0-flash", messages) == "要約"
+        assert make_cache_key("m", messages) != make_cache_key("m", messages, "2")
+        reopened.close()
+
+    def test_ttl_and_size_eviction(self):
+        """有効期間とサイズ上限による削除のテスト"""
+        cache = LLMResponseCache(":memory:", max_bytes=10, ttl_seconds=60)
+        prompts = [[{"role": "user", "content": f"p{i}"}] for i in range(3)]
+
+        with patch("app.memory.llm_cache.time.time", return_value=1000.0):
+            cache.put("m", prompts[0], "aaaa")
+        with patch("app.memory.llm_cache.time.time", return_value=1001.0):
+            cache.put("m", prompts[1], "bbbb")
+        with patch("app.memory.llm_cache.time.time", return_value=1001.5):
+            assert cache.get("m", prompts[0]) == "aaaa"
+        with patch("app.memory.llm_cache.time.time", return_value=1002.0):
+            cache.put("m", prompts[2], "cccc")
+
+        # 最も長く参照されていないprompts[1]が削除される
+        assert cache.stats()["size_bytes"] == 8
+        with patch("app.memory.llm_cache.time.time", return_value=1010.0):
+            assert cache.get("m", prompts[1]) is None
+            assert cache.get("m", prompts[0]) == "aaaa"
+
+        # 作成から有効期間を過ぎた応答は参照されていても破棄される
+        with patch("app.memory.llm_cache.time.time", return_value=1061.0):
+            assert cache.get("m", prompts[0]) is None
+            assert cache.get("m", prompts[2]) == "cccc"
+
+    def test_total_size_is_tracked_without_scanning(self, tmp_path):
+        """保存のたびに表全体を集計せずに合計サイズを追跡するかのテスト"""
+        path = str(tmp_path / "responses.sqlite3")
+        cache = LLMResponseCache(path, max_bytes=10, ttl_seconds=60)
+        prompts = [[{"role": "user", "content": f"p{i}"}] for i in range(3)]
+        statements = []
+
+        def put(messages, response):
+            # 保存時に実行されたSQLのみを記録する
+            cache._conn.set_trace_callback(statements.append)
+            try:
+                cache.put("m", messages, response)
+            finally:
+                cache._conn.set_trace_callback(None)
+
+        with patch("app.memory.llm_cache.time.time", return_value=1000.0):
+            put(prompts[0], "aaaa")
+            # 同じキーの置き換えは差分のみを加える
+            put(prompts[0], "aaaaaa")
+            put(prompts[1], "bbbb")
+        assert cache._total_bytes == cache.stats()["size_bytes"] == 10
+        with patch("app.memory.llm_cache.time.time", return_value=1001.0):
+            put(prompts[2], "cccc")
+        assert cache._total_bytes == cache.stats()["size_bytes"] == 8
+        with patch("app.memory.llm_cache.time.time", return_value=1070.0):
+            put(prompts[1], "dd")
+        assert cache._total_bytes == cache.stats()["size_bytes"] == 2
+        assert cache.evictions == 2
+
+        assert statements
+        assert not [
+            statement
+            for statement in statements
+            if "SUM(size)" in statement and "WHERE" not in statement
+        ]
+        cache.close()
+
+        # 開いた時点の合計サイズから再開する
+        reopened = LLMResponseCache(path, max_bytes=10, ttl_seconds=60)
+        assert reopened._total_bytes == 2
+        reopened.close()
+
+    @pytest.mark.asyncio
+    async def test_async_call_uses_cache_off_event_loop(
+        self, db_session, test_character
+    ):
+        """非同期のLLM呼び出しでキャッシュの読み書きをスレッドで行うかのテスト"""
+        cache = LLMResponseCache(":memory:")
+        generator = MemoryGenerator(
+            db_session, test_character.id, "dummy-model", response_cache=cache
+        )
+        messages = [{"role": "user", "content": "要約して"}]
+        response = MagicMock(choices=[MagicMock(message=MagicMock(content="要約"))])
+        loop_thread = threading.get_ident()
+        cache_threads = []
+
+        def record(method):
+            def wrapper(*args):
+                cache_threads.append(threading.get_ident())
+                return method(*args)
+
+            return wrapper
+
+        with (
+            patch.object(cache, "get", record(cache.get)),
+            patch.object(cache, "put", record(cache.put)),
+            patch(
+                "app.memory.generator.acompletion",
+                new=MagicMock(side_effect=lambda **kwargs: asyncio.sleep(0, response)),
+            ),
+        ):
+            assert await generator._acall_model("dummy-model", messages, None) == "要約"
+            assert await generator._acall_model("dummy-model", messages, None) == "要約"
+
+        assert len(cache_threads) == 3
+        assert loop_thread not in cache_threads
+        assert cache.stats()["hits"] == 1
+
+    def test_generator_uses_cache(self, db_session, test_character):
+        """同じプロンプトの再実行でLLMを呼び出さないかのテスト"""
+        add_memory(
+            db=db_session,
+            user_id=test_character.user_id,
+            character_id=test_character.id,
+            memory_type=MEMORY_TYPE_DAILY_RAW,
+            start_day=1,
+            end_day=1,
+            content="テスト会話",
+        )
+        cache = LLMResponseCache(":memory:")
+        generator = MemoryGenerator(
+            db_session, test_character.id, "dummy-model", response_cache=cache
+        )
+        response = MagicMock(choices=[MagicMock(message=MagicMock(content="要約"))])
+
+        with patch(
+            "app.memory.generator.completion", return_value=response
+        ) as mock_completion:
+            first = generator.generate_daily_summary(1)
+            first_content = first.content
+            # 保存前に中断した場合の再実行を想定して要約を削除する
+            delete_memory(db_session, first.id)
+            second = generator.generate_daily_summary(1)
+
+        assert mock_completion.call_count == 1
+        assert first_content == second.content == "要約"
+        assert cache.stats()["hits"] == 1
+
+    def test_locked_cache_is_treated_as_miss(self, db_session, test_character):
+        """キャッシュのエラーでLLM呼び出しを失敗させず、再呼び出しもしないかのテスト"""
+        add_memory(
+            db=db_session,
+            user_id=test_character.user_id,
+            character_id=test_character.id,
+            memory_type=MEMORY_TYPE_DAILY_RAW,
+            start_day=1,
+            end_day=1,
+            content="テスト会話",
+        )
+        cache = LLMResponseCache(":memory:")
+        cache._conn = MagicMock(
+            execute=MagicMock(
+                side_effect=sqlite3.OperationalError("database is locked")
+            )
+        )
+        generator = MemoryGenerator(
+            db_session, test_character.id, "dummy-model", response_cache=cache
+        )
+        response = MagicMock(choices=[MagicMock(message=MagicMock(content="要約"))])
+
+        with patch(
+            "app.memory.generator.completion", return_value=response
+        ) as mock_completion:
+            summary = generator.generate_daily_summary(1)
+
+        assert mock_completion.call_count == 1
+        assert summary.content == "要約"
+        assert cache.errors == 2
+        assert cache.misses == 1
+
+    def test_put_skips_empty_response(self):
+        """空の応答を保存しないかのテスト"""
+        cache = LLMResponseCache(":memory:")
+        messages = [{"role": "user", "content": "要約して"}]
+        cache.put("m", messages, None)
+        cache.put("m", messages, "")
+        assert cache.get("m", messages) is None
+        assert cache.stats()["entries"] == 0
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def _rate_limit_error(retry_after):
+    request = httpx.Request("POST", "https://example.com")
+    return litellm.RateLimitError(
+        message="rate limited",
+        llm_provider="gemini",
+        model="gemini/gemini-2.0-flash",
+        response=httpx.Response(
+            429, headers={"retry-after": retry_after}, request=request
+        ),
+    )
+
+
+@pytest.mark.unit
+class TestLLMCallController:
+    def test_rate_limiter_waits_for_requests_and_tokens(self):
+        """リクエスト数とトークン数によるレート制限のテスト"""
+        clock = FakeClock()
+        limiter = LLMRateLimiter(
+            limits={
+                "gemini": {"requests_per_minute": 2, "tokens_per_minute": 1000},
+                "openai/gpt-4o": {"requests_per_minute": 60, "tokens_per_minute": 600},
+            },
+            clock=clock,
+        )
+
+        # 同じプロバイダーのモデルはバケットを共有する
+        assert limiter.reserve("gemini/gemini-2.0-flash", 100) == 0
+        assert limiter.reserve("gemini/gemini-1.5-pro", 100) == 0
+        assert limiter.reserve("gemini/gemini-2.0-flash", 100) == pytest.approx(30)
+
+        # トークン数の上限のほうが厳しい場合はそちらを待つ
+        assert limiter.reserve("openai/gpt-4o", 600) == 0
+        assert limiter.reserve("openai/gpt-4o", 300) == pytest.approx(30)
+        limiter.record_usage("openai/gpt-4o", 300, 0)
+        clock.now = 30
+        assert limiter.reserve("openai/gpt-4o", 300) == 0
+
+    def test_retry_honors_retry_after(self):
+        """Retry-Afterを考慮した再試行のテスト"""
+        clock = FakeClock()
+        controller = LLMCallController(
+            rate_limiter=LLMRateLimiter(clock=clock),
+            circuit_breaker=CircuitBreaker(clock=clock),
+            base_delay=0.01,
+            sleep=clock.sleep,
+        )
+        request = MagicMock(
+            side_effect=[_rate_limit_error("2"), _rate_limit_error("5"), "応答"]
+        )
+
+        response = controller.call(
+            "gemini/gemini-2.0-flash", [{"role": "user", "content": "要約"}], request
+        )
+
+        assert response == "応答"
+        assert request.call_count == 3
+        assert clock.now == pytest.approx(7)
+        assert controller.circuit_breaker.state("gemini") == "closed"
+
+        bad_request = MagicMock(
+            side_effect=litellm.BadRequestError(
+                message="bad", llm_provider="gemini", model="gemini/gemini-2.0-flash"
+            )
+        )
+        with pytest.raises(litellm.BadRequestError):
+            controller.call("gemini/gemini-2.0-flash", [], bad_request)
+        assert bad_request.call_count == 1
+
+    def test_circuit_breaker_fails_fast(self):
+        """プロバイダー障害時にサーキットが開いて即座に失敗するかのテスト"""
+        clock = FakeClock()
+        controller = LLMCallController(
+            rate_limiter=LLMRateLimiter(clock=clock),
+            circuit_breaker=CircuitBreaker(
+                failure_threshold=3, reset_timeout=30, clock=clock
+            ),
+            max_retries=1,
+            base_delay=0.01,
+            sleep=clock.sleep,
+        )
+        unavailable = litellm.ServiceUnavailableError(
+            message="down", llm_provider="openai", model="openai/gpt-4o"
+        )
+        request = MagicMock(side_effect=unavailable)
+
+        with pytest.raises(litellm.ServiceUnavailableError):
+            controller.call("openai/gpt-4o", [], request)
+        with pytest.raises(CircuitOpenError):
+            controller.call("openai/gpt-4o", [], request)
+        assert request.call_count == 3
+        assert controller.circuit_breaker.state("openai") == "open"
+
+        # 別のプロバイダーには影響しない
+        assert controller.call("gemini/gemini-2.0-flash", [], lambda: "応答") == "応答"
+
+        clock.now += 30
+        assert controller.circuit_breaker.state("openai") == "half_open"
+        assert controller.call("openai/gpt-4o", [], lambda: "復旧") == "復旧"
+        assert controller.circuit_breaker.state("openai") == "closed"
+
+    @pytest.mark.asyncio
+    async def test_cancelled_trial_releases_circuit(self):
+        """半開状態の試行がキャンセルされてもサーキットが開いたままにならないかのテスト"""
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30, clock=clock)
+        controller = LLMCallController(
+            rate_limiter=LLMRateLimiter(clock=clock), circuit_breaker=breaker
+        )
+        breaker.record_failure("openai")
+        clock.now += 30
+        started = asyncio.Event()
+
+        async def hang():
+            started.set()
+            await asyncio.Event().wait()
+
+        task = asyncio.create_task(controller.acall("openai/gpt-4o", [], hang))
+        await started.wait()
+        # 試行中は他の呼び出しを即座に失敗させる
+        with pytest.raises(CircuitOpenError):
+            controller.call("openai/gpt-4o", [], lambda: "応答")
+
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        assert breaker.state("openai") == "half_open"
+
+        async def recovered():
+            return "復旧"
+
+        assert await controller.acall("openai/gpt-4o", [], recovered) == "復旧"
+        assert breaker.state("openai") == "closed"
+
+    def test_unknown_error_keeps_circuit_open(self):
+        """4xx以外の分類できない例外でサーキットを閉じないかのテスト"""
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30, clock=clock)
+        controller = LLMCallController(
+            rate_limiter=LLMRateLimiter(clock=clock),
+            circuit_breaker=breaker,
+            sleep=clock.sleep,
+        )
+        breaker.record_failure("openai")
+        clock.now += 30
+
+        with pytest.raises(KeyError):
+            controller.call("openai/gpt-4o", [], MagicMock(side_effect=KeyError("x")))
+        assert breaker.state("openai") == "open"
+
+        # 4xxの応答はプロバイダーが稼働している証拠として扱う
+        clock.now += 30
+        with pytest.raises(litellm.BadRequestError):
+            controller.call(
+                "openai/gpt-4o",
+                [],
+                MagicMock(
+                    side_effect=litellm.BadRequestError(
+                        message="bad", llm_provider="openai", model="openai/gpt-4o"
+                    )
+                ),
+            )
+        assert breaker.state("openai") == "closed"
+
+    @pytest.mark.asyncio
+    async def test_acall_retries(self):
+        """非同期呼び出しの再試行テスト"""
+        delays = []
+
+        async def record_sleep(seconds):
+            delays.append(seconds)
+
+        controller = LLMCallController(base_delay=0.01, async_sleep=record_sleep)
+        responses = iter([_rate_limit_error("1"), "応答"])
+
+        async def request():
+            response = next(responses)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        assert await controller.acall("gemini/gemini-2.0-flash", [], request) == "応答"
+        assert delays == [1.0]
+
+    def test_call_llm_raises_after_retries(self, db_session, test_character):
+        """再試行後も失敗した場合に例外を送出するかのテスト"""
+        controller = LLMCallController(max_retries=2, sleep=lambda seconds: None)
+        generator = MemoryGenerator(
+            db_session,
+            test_character.id,
+            "gemini/gemini-2.0-flash",
+            call_controller=controller,
+        )
+
+        with (
+            patch(
+                "app.memory.generator.completion",
+                side_effect=_rate_limit_error("0"),
+            ) as mock_completion,
+            pytest.raises(litellm.RateLimitError),
+        ):
+            generator._call_llm("プロンプト")
+        assert mock_completion.call_count == 3
+
+    @pytest.mark.asyncio
+    async def test_acall_llm_raises_when_circuit_open(self, db_session, test_character):
+        """サーキットが開いている場合に非同期の呼び出しが例外を送出するかのテスト"""
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30, clock=clock)
+        breaker.record_failure("gemini")
+        generator = MemoryGenerator(
+            db_session,
+            test_character.id,
+            "gemini/gemini-2.0-flash",
+            call_controller=LLMCallController(circuit_breaker=breaker),
+        )
+
+        with (
+            patch("app.memory.generator.acompletion") as mock_acompletion,
+            pytest.raises(CircuitOpenError),
+        ):
+            await generator._acall_llm("プロンプト")
+        mock_acompletion.assert_not_called()
+
+
+@pytest.mark.unit
+class TestModelRouter:
+    def test_select_by_memory_type_and_size(self):
+        """記憶タイプと入力トークン数によるルート選択のテスト"""
+        router = ModelRouter(
+            routes={
+                MEMORY_TYPE_DAILY_SUMMARY: [(None, ["small"])],
+                MEMORY_TYPE_LEVEL_100: [(None, ["large"]), (1000, ["small"])],
+            },
+            default_models=["default"],
+        )
+
+        assert router.select(MEMORY_TYPE_DAILY_SUMMARY, 50000) == (
+            "daily_summary:max",
+            ["small"],
+        )
+        assert router.select(MEMORY_TYPE_LEVEL_100, 1000) == (
+            "level_100:<=1000",
+            ["small"],
+        )
+        assert router.select(MEMORY_TYPE_LEVEL_100, 1001) == (
+            "level_100:max",
+            ["large"],
+        )
+        assert router.select(None, 10) == ("default", ["default"])
+
+        with pytest.raises(ValueError):
+            ModelRouter(routes={MEMORY_TYPE_DAILY_SUMMARY: []}).select(None, 10)
+        with pytest.raises(ValueError):
+            ModelRouter(routes={MEMORY_TYPE_DAILY_SUMMARY: [(None, [])]})
+
+        # デフォルトのルーティングテーブルは上位の階層ほど強いモデルを使う
+        default_router = ModelRouter()
+        assert default_router.select(MEMORY_TYPE_DAILY_SUMMARY, 100)[1][0] == (
+            "gemini/gemini-2.0-flash"
+        )
+        assert default_router.select(MEMORY_TYPE_LEVEL_ARCHIVE, 100)[1][0] == (
+            "anthropic/claude-3-7-sonnet-20250219"
+        )
+
+    def test_generator_falls_back_and_records_stats(self, db_session, test_character):
+        """失敗時のフォールバックとルートごとの統計のテスト"""
+        router = ModelRouter(
+            routes={MEMORY_TYPE_DAILY_SUMMARY: [(None, ["primary", "fallback"])]}
+        )
+        generator = MemoryGenerator(
+            db_session,
+            test_character.id,
+            call_controller=LLMCallController(max_retries=0),
+            router=router,
+        )
+
+        def fake_completion(model, messages, stream):
+            if model == "primary":
+                raise litellm.BadRequestError(
+                    message="bad", llm_provider="primary", model=model
+                )
+            response = MagicMock()
+            response.choices[0].message.content = "要約"
+            response.usage.prompt_tokens = 120
+            response.usage.completion_tokens = 30
+            return response
+
+        with patch(
+            "app.memory.generator.completion", side_effect=fake_completion
+        ) as mock_completion:
+            assert (
+                generator._call_llm("プロンプト", memory_type=MEMORY_TYPE_DAILY_SUMMARY)
+                == "要約"
+            )
+            # ルーティングの対象外の呼び出しは model を使用する
+            assert generator._call_llm("プロンプト") == "要約"
+
+        assert [call.kwargs["model"] for call in mock_completion.call_args_list] == [
+            "primary",
+            "fallback",
+            "gemini/gemini-2.0-flash",
+        ]
+        stats = router.stats()["daily_summary:max"]
+        assert stats["calls"] == 2
+        assert stats["failures"] == 1
+        assert stats["models"] == {"fallback": 1}
+        assert stats["prompt_tokens"] == 120
+        assert stats["completion_tokens"] == 30
+        assert stats["max_latency"] >= stats["average_latency"] >= 0
+        assert set(router.stats()) == {"daily_summary:max"}
+
+        router.reset_stats()
+        assert router.stats() == {}
+
+    @pytest.mark.asyncio
+    async def test_async_routing_by_input_size(self, db_session, test_character):
+        """非同期の階層的要約で入力サイズに応じたモデルを使うかのテスト"""
+        for day in range(1, 11):
+            add_memory(
+                db=db_session,
+                user_id=test_character.user_id,
+                character_id=test_character.id,
+                memory_type=MEMORY_TYPE_DAILY_SUMMARY,
+                start_day=day,
+                end_day=day,
+                content=f"{day}日目の要約",
+            )
+        router = ModelRouter(
+            routes={MEMORY_TYPE_LEVEL_10: [(10, ["small"]), (None, ["large"])]}
+        )
+        generator = MemoryGenerator(db_session, test_character.id, router=router)
+        models = []
+
+        async def fake_acompletion(model, messages, stream):
+            models.append(model)
+            response = MagicMock()
+            response.choices[0].message.content = "10日間の要約"
+            response.usage = None
+            return response
+
+        with patch("app.memory.generator.acompletion", side_effect=fake_acompletion):
+            memory = await generator.agenerate_hierarchical_summary(
+                MEMORY_TYPE_LEVEL_10, 1, 10
+            )
+
+        assert memory.content == "10日間の要約"
+        assert models == ["large"]
+        stats = router.stats()["level_10:max"]
+        assert stats["calls"] == 1
+        assert stats["completion_tokens"] == estimate_tokens("10日間の要約")
+
 
 @pytest.mark.unit
 class TestMemoryRetriever:
@@ -118,6 +1140,44 @@ class TestMemoryRetriever:
         assert "daily_summary" in memories
         assert len(memories["daily_summary"]) >= 2
 
+    def test_get_memories_for_session_single_query_matches(
+        self, db_session, test_character
+    ):
+        """1回のクエリによる記憶取得が個別クエリと同じ結果になるかのテスト"""
+        fixtures = [
+            (MEMORY_TYPE_DAILY_RAW, 250, 250),
+            (MEMORY_TYPE_DAILY_SUMMARY, 241, 241),
+            (MEMORY_TYPE_DAILY_SUMMARY, 250, 250),
+            (MEMORY_TYPE_DAILY_SUMMARY, 200, 200),
+            (MEMORY_TYPE_LEVEL_10, 150, 159),
+            (MEMORY_TYPE_LEVEL_10, 230, 239),
+            (MEMORY_TYPE_LEVEL_10, 145, 154),
+            (MEMORY_TYPE_LEVEL_100, 1, 100),
+        ]
+        for memory_type, start_day, end_day in fixtures:
+            add_memory(
+                db=db_session,
+                user_id=test_character.user_id,
+                character_id=test_character.id,
+                memory_type=memory_type,
+                start_day=start_day,
+                end_day=end_day,
+                content=f"{memory_type} {start_day}-{end_day}",
+            )
+
+        retriever = MemoryRetriever(db_session, test_character.id)
+        combined = retriever.get_memories_for_session(250)
+        separate = retriever.get_memories_for_session(250, single_query=False)
+
+        assert combined.keys() == separate.keys()
+        for memory_type in combined:
+            assert [m.id for m in combined[memory_type]] == [
+                m.id for m in separate[memory_type]
+            ]
+        assert len(combined[MEMORY_TYPE_DAILY_SUMMARY]) == 2
+        assert len(combined[MEMORY_TYPE_LEVEL_10]) == 2
+        assert len(combined[MEMORY_TYPE_LEVEL_100]) == 1
+
     def test_format_memories_for_prompt(self, db_session, test_character):
         """プロンプト用記憶整形テスト"""
         # いくつかの記憶を作成
@@ -134,6 +1194,716 @@ class TestMemoryRetriever:
         assert "【記憶データ】" in formatted
         assert "テスト記憶内容" in formatted
 
+    def test_get_memories_for_sessions(self, db_session, test_user_id):
+        """複数キャラクターの記憶一括取得テスト"""
+        characters = [
+            create_character(db=db_session, user_id=test_user_id, name=f"一括{i}")
+            for i in range(3)
+        ]
+        targets = [(characters[0].id, 5), (characters[1].id, 40), (characters[2].id, 5)]
+        for character, current_day in zip(characters, [5, 40, 5]):
+            for memory_type, start_day, end_day in [
+                (MEMORY_TYPE_DAILY_RAW, current_day, current_day),
+                (MEMORY_TYPE_DAILY_SUMMARY, current_day - 1, current_day - 1),
+                (MEMORY_TYPE_LEVEL_10, 1, 10),
+            ]:
+                add_memory(
+                    db=db_session,
+                    user_id=test_user_id,
+                    character_id=character.id,
+                    memory_type=memory_type,
+                    start_day=start_day,
+                    end_day=end_day,
+                    content=f"{character.name} {memory_type}",
+                )
+
+        for chunk_size in (1, 500):
+            batch = get_memories_for_sessions(db_session, targets, chunk_size)
+            assert set(batch) == set(targets)
+            for character_id, current_day in targets:
+                expected = MemoryRetriever(
+                    db_session, character_id
+                ).get_memories_for_session(current_day)
+                assert {
+                    memory_type: [m.id for m in items]
+                    for memory_type, items in batch[(character_id, current_day)].items()
+                } == {
+                    memory_type: [m.id for m in items]
+                    for memory_type, items in expected.items()
+                }
+
+        assert len(batch[(characters[1].id, 40)][MEMORY_TYPE_LEVEL_10]) == 1
+        assert batch[(characters[0].id, 5)][MEMORY_TYPE_LEVEL_10] == []
+
+        cache = MemoryContextCache()
+        assert warm_memory_context_cache(db_session, targets, cache) == 3
+        _, text = get_memory_context(MagicMock(), characters[2].id, 5, cache)
+        assert "一括2 daily_raw" in text
+
+    def test_get_memories_for_sessions_query_count(self, db_session, test_user_id):
+        """現在の日が異なる多数の対象でもクエリ数がチャンク数のみで決まることのテスト"""
+        characters = [
+            create_character(db=db_session, user_id=test_user_id, name=f"日別{i}")
+            for i in range(6)
+        ]
+        current_days = [3, 25, 150, 1200, 10500, 42]
+        targets = list(zip([c.id for c in characters], current_days)) + [
+            (characters[0].id, 12)
+        ]
+        for character, current_day in zip(characters, current_days):
+            for memory_type, start_day, end_day in [
+                (MEMORY_TYPE_DAILY_RAW, current_day, current_day),
+                (MEMORY_TYPE_DAILY_SUMMARY, current_day - 2, current_day - 2),
+                (MEMORY_TYPE_LEVEL_10, 1, 10),
+                (MEMORY_TYPE_LEVEL_100, 1, 100),
+                (MEMORY_TYPE_LEVEL_1000, 1, 1000),
+                (MEMORY_TYPE_LEVEL_ARCHIVE, 1, 400),
+            ]:
+                if start_day >= 1:
+                    add_memory(
+                        db=db_session,
+                        user_id=test_user_id,
+                        character_id=character.id,
+                        memory_type=memory_type,
+                        start_day=start_day,
+                        end_day=end_day,
+                        content=f"{character.name} {memory_type}",
+                    )
+
+        statements = []
+
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        connection = db_session.connection()
+        for chunk_size, expected_queries in ((500, 1), (3, 3)):
+            statements.clear()
+            event.listen(connection, "before_cursor_execute", count_statement)
+            try:
+                batch = get_memories_for_sessions(db_session, targets, chunk_size)
+            finally:
+                event.remove(connection, "before_cursor_execute", count_statement)
+            assert len(statements) == expected_queries
+
+            assert set(batch) == set(targets)
+            for character_id, current_day in targets:
+                expected = MemoryRetriever(
+                    db_session, character_id
+                ).get_memories_for_session(current_day)
+                assert {
+                    memory_type: [m.id for m in items]
+                    for memory_type, items in batch[(character_id, current_day)].items()
+                } == {
+                    memory_type: [m.id for m in items]
+                    for memory_type, items in expected.items()
+                }
+
+        assert len(batch[(characters[4].id, 10500)][MEMORY_TYPE_LEVEL_ARCHIVE]) == 1
+        assert len(batch[(characters[1].id, 25)][MEMORY_TYPE_LEVEL_10]) == 1
+        assert batch[(characters[0].id, 12)][MEMORY_TYPE_DAILY_RAW] == []
+
+    def test_format_memories_with_budget(self, db_session, test_character):
+        """トークン予算内での記憶整形テスト"""
+        for memory_type, start_day, end_day, content in [
+            (MEMORY_TYPE_DAILY_RAW, 30, 30, "今日の詳細" * 10),
+            (MEMORY_TYPE_DAILY_SUMMARY, 29, 29, "昨日の要約" * 10),
+            (MEMORY_TYPE_LEVEL_10, 11, 20, "古い要約" * 100),
+        ]:
+            add_memory(
+                db=db_session,
+                user_id=test_character.user_id,
+                character_id=test_character.id,
+                memory_type=memory_type,
+                start_day=start_day,
+                end_day=end_day,
+                content=content,
+            )
+
+        retriever = MemoryRetriever(db_session, test_character.id)
+        unlimited = retriever.format_memories_with_budget(30, token_budget=10000)
+        assert unlimited["text"] == retriever.format_memories_for_prompt(30)
+        assert unlimited["dropped"] == []
+
+        packed = retriever.format_memories_with_budget(30, token_budget=200)
+        assert packed["used_tokens"] <= 200
+        assert packed["included_count"] == 2
+        assert "今日の詳細" in packed["text"]
+        assert "古い要約" not in packed["text"]
+        assert [d["memory_type"] for d in packed["dropped"]] == [MEMORY_TYPE_LEVEL_10]
+
+    def test_format_memories_with_deferred_content(self, db_session, test_character):
+        """メタデータのみで選択してから内容を取得する整形テスト"""
+        for memory_type, start_day, end_day, content in [
+            (MEMORY_TYPE_DAILY_RAW, 30, 30, "今日の詳細" * 10),
+            (MEMORY_TYPE_DAILY_SUMMARY, 29, 29, "昨日の要約" * 10),
+            (MEMORY_TYPE_LEVEL_10, 11, 20, "古い要約" * 100),
+        ]:
+            add_memory(
+                db=db_session,
+                user_id=test_character.user_id,
+                character_id=test_character.id,
+                memory_type=memory_type,
+                start_day=start_day,
+                end_day=end_day,
+                content=content,
+            )
+
+        retriever = MemoryRetriever(db_session, test_character.id)
+        metadata = retriever.get_memory_metadata_for_session(30)
+        assert [row.content_length for row in metadata[MEMORY_TYPE_LEVEL_10]] == [400]
+        assert not hasattr(metadata[MEMORY_TYPE_LEVEL_10][0], "content")
+
+        with patch(
+            "app.crud.memory.get_memories_by_ids",
+            wraps=memory_crud.get_memories_by_ids,
+        ) as fetch:
+            packed = retriever.format_memories_with_budget(
+                30, token_budget=200, deferred_content=True
+            )
+        fetch.assert_called_once()
+        assert len(fetch.call_args.args[1]) == 2
+        assert packed == retriever.format_memories_with_budget(30, token_budget=200)
+
+        unlimited = retriever.format_memories_with_budget(
+            30, token_budget=10000, deferred_content=True
+        )
+        assert unlimited["text"] == retriever.format_memories_for_prompt(30)
+
+        # 文字数より多く数える token_counter でも取得後に数え直して予算内に収める
+        def counter(text):
+            return len(text) * 3
+
+        recounted = retriever.format_memories_with_budget(
+            30, token_budget=250, token_counter=counter, deferred_content=True
+        )
+        assert recounted["used_tokens"] <= 250
+        assert recounted["used_tokens"] == counter(recounted["text"])
+        assert recounted["included_count"] == 1
+        assert "今日の詳細" in recounted["text"]
+        assert [d["memory_type"] for d in recounted["dropped"]] == [
+            MEMORY_TYPE_LEVEL_10,
+            MEMORY_TYPE_DAILY_SUMMARY,
+        ]
+
+    def test_estimate_tokens(self):
+        """トークン数推定のテスト"""
+        assert estimate_tokens("") == 0
+        assert estimate_tokens("記憶") == 2
+        assert estimate_tokens("abcdefgh") == 2
+
+
+@pytest.mark.unit
+class TestAsyncMemoryRetriever:
+    @pytest.mark.asyncio
+    async def test_create_with_invalid_character(self, async_db_session):
+        """無効なキャラクターIDでの非同期初期化テスト"""
+        with pytest.raises(ValueError):
+            await AsyncMemoryRetriever.create(async_db_session, uuid.uuid4())
+
+    @pytest.mark.asyncio
+    async def test_format_memories_for_prompt(self, async_db_session, test_user_id):
+        """非同期でのプロンプト用記憶整形テスト"""
+        character = await async_crud.create_character(
+            async_db_session, test_user_id, "非同期キャラクター"
+        )
+        await async_crud.add_memory(
+            async_db_session,
+            user_id=test_user_id,
+            character_id=character.id,
+            memory_type=MEMORY_TYPE_DAILY_SUMMARY,
+            start_day=2,
+            end_day=2,
+            content="非同期で取得する記憶",
+        )
+
+        retriever = await AsyncMemoryRetriever.create(async_db_session, character.id)
+        memories = await retriever.get_memories_for_session(2)
+        formatted = await retriever.format_memories_for_prompt(2)
+
+        assert len(memories[MEMORY_TYPE_DAILY_SUMMARY]) == 1
+        assert "非同期で取得する記憶" in formatted
+
+        _, text = await get_memory_context_async(
+            async_db_session, character.id, 2, MemoryContextCache()
+        )
+        assert text == formatted
+
+
+@pytest.mark.unit
+class TestMemoryContextCache:
+    def test_get_memory_context_hits_without_db(self, db_session, test_character):
+        """キャッシュヒット時にDBへアクセスしないことのテスト"""
+        add_memory(
+            db=db_session,
+            user_id=test_character.user_id,
+            character_id=test_character.id,
+            memory_type=MEMORY_TYPE_DAILY_SUMMARY,
+            start_day=3,
+            end_day=3,
+            content="キャッシュ対象の記憶",
+        )
+        cache = MemoryContextCache(max_size=4)
+
+        _, text = get_memory_context(db_session, test_character.id, 3, cache)
+        assert "キャッシュ対象の記憶" in text
+
+        cached_memories, cached_text = get_memory_context(
+            MagicMock(), test_character.id, 3, cache
+        )
+        assert cached_text == text
+        assert [m.content for m in cached_memories[MEMORY_TYPE_DAILY_SUMMARY]] == [
+            "キャッシュ対象の記憶"
+        ]
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 1
+
+    def test_lru_eviction(self):
+        """LRU方式での追い出しテスト"""
+        cache = MemoryContextCache(max_size=2)
+        character_id = uuid.uuid4()
+
+        cache.put(character_id, 1, {}, "day1")
+        cache.put(character_id, 2, {}, "day2")
+        assert cache.get(character_id, 1) is not None
+        cache.put(character_id, 3, {}, "day3")
+
+        assert cache.get(character_id, 2) is None
+        assert cache.get(character_id, 1) is not None
+        assert cache.stats()["evictions"] == 1
+
+    def test_invalidated_by_memory_writes(self, db_session, test_character):
+        """記憶の追加・更新・削除によるキャッシュ無効化テスト"""
+        memory_context_cache.clear()
+        memory_context_cache.put(test_character.id, 4, {}, "day4")
+        memory_context_cache.put(test_character.id, 6, {}, "day6")
+
+        memory = add_memory(
+            db=db_session,
+            user_id=test_character.user_id,
+            character_id=test_character.id,
+            memory_type=MEMORY_TYPE_DAILY_RAW,
+            start_day=5,
+            end_day=5,
+            content="新しい記憶",
+        )
+
+        # 終了日より前の日のコンテキストには影響しない
+        assert memory_context_cache.get(test_character.id, 4) is not None
+        assert memory_context_cache.get(test_character.id, 6) is None
+
+        memory_context_cache.put(test_character.id, 6, {}, "day6")
+        update_memory(db=db_session, memory_id=memory.id, content="更新")
+        assert memory_context_cache.get(test_character.id, 6) is None
+
+        memory_context_cache.put(test_character.id, 6, {}, "day6")
+        delete_memory(db=db_session, memory_id=memory.id)
+        assert memory_context_cache.get(test_character.id, 6) is None
+        assert memory_context_cache.stats()["invalidations"] == 3
+
+    def test_invalidation_during_query_skips_put(self, db_session, test_character):
+        """読み込みと保存の間に無効化された場合に古い内容を保存しないことのテスト"""
+        cache = MemoryContextCache(max_size=4)
+        original = MemoryRetriever.get_memories_for_session
+
+        def query_then_write(retriever, current_day):
+            memories = original(retriever, current_day)
+            # クエリ完了後・保存前に別の書き込みがコミットされる
+            cache.invalidate(test_character.id)
+            return memories
+
+        with patch.object(
+            MemoryRetriever, "get_memories_for_session", query_then_write
+        ):
+            get_memory_context(db_session, test_character.id, 3, cache)
+
+        assert cache.get(test_character.id, 3) is None
+        assert cache.stats()["size"] == 0
+
+        get_memory_context(db_session, test_character.id, 3, cache)
+        assert cache.get(test_character.id, 3) is not None
+
+
+@pytest.mark.unit
+class TestMemorySearchIndex:
+    def test_tokenize(self):
+        """日本語と英数字のトークン分割テスト"""
+        assert tokenize("猫が好き") == ["猫", "が", "好", "き", "猫が", "が好", "好き"]
+        assert tokenize("Ｃａｔと猫") == ["cat", "と", "猫", "と猫"]
+        assert tokenize("、猫。") == ["猫"]
+
+    def test_search_ranks_relevant_memory(self, tmp_path):
+        """BM25による検索と永続化のテスト"""
+        index = MemorySearchIndex()
+        character_id = uuid.uuid4()
+        cat_id, dog_id, other_id = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+        index.build_character(
+            character_id,
+            [
+                (cat_id, "ユーザーは猫を飼っていて、猫の名前はミケだと話してくれた。"),
+                (dog_id, "ユーザーは犬の散歩に行った。"),
+                (other_id, "今日は天気が良かった。"),
+            ],
+        )
+
+        results = index.search(character_id, "ユーザーの猫", top_k=2)
+        assert [memory_id for memory_id, _ in results] == [cat_id, dog_id]
+
+        index.remove_memory(character_id, cat_id)
+        assert cat_id not in [m for m, _ in index.search(character_id, "猫")]
+
+        assert index.save(str(tmp_path)) == 1
+        restored = MemorySearchIndex()
+        assert restored.load(str(tmp_path)) == 1
+        assert restored.search(character_id, "犬の散歩") == index.search(
+            character_id, "犬の散歩"
+        )
+
+    def test_load_checks_watermark(self, tmp_path, db_session, test_character):
+        """保存後に記憶が変わったキャラクターのインデックスを読み込まないかのテスト"""
+
+        def add(day):
+            add_memory(
+                db=db_session,
+                user_id=test_character.user_id,
+                character_id=test_character.id,
+                memory_type=MEMORY_TYPE_DAILY_RAW,
+                start_day=day,
+                end_day=day,
+                content=f"{day}日目の記憶",
+            )
+
+        add(1)
+        index = MemorySearchIndex()
+        index.build_character(
+            test_character.id,
+            memory_crud.get_memory_contents(db_session, test_character.id),
+        )
+        watermarks = memory_crud.get_memory_watermarks(db_session, [test_character.id])
+        assert watermarks[test_character.id].startswith("1:")
+        assert index.save(str(tmp_path), watermarks) == 1
+
+        restored = MemorySearchIndex()
+        assert restored.load(str(tmp_path), watermarks=watermarks) == 1
+        assert restored.has_character(test_character.id)
+
+        # 保存後に追加された記憶は保存したインデックスに含まれない
+        add(2)
+        current = memory_crud.get_memory_watermarks(db_session, [test_character.id])
+        assert current != watermarks
+        stale = MemorySearchIndex()
+        assert stale.load(str(tmp_path), watermarks=current) == 0
+        assert not stale.has_character(test_character.id)
+
+        # 保存後に内容のみを更新した場合も一致しない
+        index.build_character(
+            test_character.id,
+            memory_crud.get_memory_contents(db_session, test_character.id),
+        )
+        index.save(str(tmp_path), current)
+        memory = memory_crud.get_memories_by_character(
+            db_session, test_character.id, start_day=2, end_day=2
+        )[0]
+        update_memory(db=db_session, memory_id=memory.id, content="編集された記憶")
+        edited = memory_crud.get_memory_watermarks(db_session, [test_character.id])
+        assert edited != current
+        assert MemorySearchIndex().load(str(tmp_path), watermarks=edited) == 0
+
+    def test_lru_eviction(self):
+        """保持するキャラクター数の上限を超えた場合に最も長く検索されていないものを破棄するかのテスト"""
+        index = MemorySearchIndex(max_characters=2)
+        first, second, third = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+        index.build_character(first, [(uuid.uuid4(), "猫")])
+        index.build_character(second, [(uuid.uuid4(), "犬")])
+        assert index.search(first, "猫")
+
+        index.build_character(third, [(uuid.uuid4(), "鳥")])
+        assert index.has_character(first)
+        assert not index.has_character(second)
+        assert index.has_character(third)
+        assert index.evictions == 1
+
+        with pytest.raises(ValueError):
+            MemorySearchIndex(max_characters=0)
+
+    def test_retriever_search_follows_crud(self, db_session, test_character):
+        """CRUD操作に追従した記憶検索テスト"""
+        memory = add_memory(
+            db=db_session,
+            user_id=test_character.user_id,
+            character_id=test_character.id,
+            memory_type=MEMORY_TYPE_DAILY_RAW,
+            start_day=1,
+            end_day=1,
+            content="ユーザーの猫はミケという名前だ。",
+        )
+        retriever = MemoryRetriever(db_session, test_character.id)
+        assert [m.id for m, _ in retriever.search_memories("ミケ")] == [memory.id]
+        assert memory_search_index.has_character(test_character.id)
+
+        added = add_memory(
+            db=db_session,
+            user_id=test_character.user_id,
+            character_id=test_character.id,
+            memory_type=MEMORY_TYPE_DAILY_RAW,
+            start_day=2,
+            end_day=2,
+            content="ユーザーは新しい犬を迎えた。",
+        )
+        assert [m.id for m, _ in retriever.search_memories("犬")] == [added.id]
+
+        update_memory(
+            db=db_session, memory_id=memory.id, content="ユーザーは旅行した。"
+        )
+        assert retriever.search_memories("ミケ") == []
+
+        delete_memory(db=db_session, memory_id=added.id)
+        assert retriever.search_memories("犬") == []
+
+
+@pytest.mark.unit
+class TestMemoryEmbeddingStore:
+    def test_hashing_provider_is_deterministic(self):
+        """ハッシュ埋め込みの決定性と正規化のテスト"""
+        provider = HashingEmbeddingProvider(dimension=64)
+        first = provider.embed(["ユーザーの猫", ""])
+        second = provider.embed(["ユーザーの猫", ""])
+
+        assert first.dtype == np.float32
+        assert np.array_equal(first, second)
+        assert np.isclose(np.linalg.norm(first[0]), 1.0)
+        assert not first[1].any()
+
+    def test_search_and_persistence(self, tmp_path):
+        """ベクトル検索・削除・メモリマップ読み込みのテスト"""
+        store = MemoryEmbeddingStore(HashingEmbeddingProvider(dimension=128))
+        character_id = uuid.uuid4()
+        cat_id, dog_id = uuid.uuid4(), uuid.uuid4()
+        store.build_character(
+            character_id,
+            [(cat_id, "飼い猫のミケが好き"), (dog_id, "近所の犬と散歩した")],
+        )
+
+        assert store.search(character_id, "ミケという猫", top_k=1)[0][0] == cat_id
+
+        assert store.save(str(tmp_path)) == 1
+        restored = MemoryEmbeddingStore(HashingEmbeddingProvider(dimension=128))
+        assert restored.load(str(tmp_path)) == 1
+        assert restored.search(character_id, "犬の散歩", top_k=1)[0][0] == dog_id
+
+        restored.remove_memory(character_id, dog_id)
+        assert [m for m, _ in restored.search(character_id, "犬の散歩")] == [cat_id]
+
+    def test_add_memory_defers_embedding(self):
+        """記憶の追加では埋め込みを計算せず、次の検索時にまとめて計算するかのテスト"""
+        provider = HashingEmbeddingProvider(dimension=128)
+        store = MemoryEmbeddingStore(provider)
+        character_id = uuid.uuid4()
+        store.build_character(character_id, [])
+        cat_id, dog_id, removed_id = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+
+        with patch.object(provider, "embed", wraps=provider.embed) as embed:
+            store.add_memory(character_id, cat_id, "飼い猫のミケが好き")
+            store.add_memory(character_id, dog_id, "近所の犬と散歩した")
+            store.add_memory(character_id, removed_id, "削除される記憶")
+            store.remove_memory(character_id, removed_id)
+            assert embed.call_count == 0
+            assert store.pending_count(character_id) == 2
+
+            assert store.search(character_id, "ミケという猫", top_k=1)[0][0] == cat_id
+            # キューの記憶を1回、クエリを1回埋め込む
+            assert embed.call_count == 2
+            assert store.pending_count(character_id) == 0
+
+        # 読み込まれていないキャラクターの更新はキューに追加しない
+        other_id = uuid.uuid4()
+        store.add_memory(other_id, uuid.uuid4(), "無視される記憶")
+        assert store.pending_count(other_id) == 0
+
+    def test_flush_pending_failure_keeps_queue(self):
+        """埋め込みの計算に失敗した場合に記憶をキューに残すかのテスト"""
+        provider = HashingEmbeddingProvider(dimension=64)
+        store = MemoryEmbeddingStore(provider)
+        character_id = uuid.uuid4()
+        store.build_character(character_id, [])
+        memory_id = uuid.uuid4()
+        store.add_memory(character_id, memory_id, "ユーザーの猫")
+
+        with patch.object(provider, "embed", side_effect=RuntimeError("接続エラー")):
+            assert store.flush_pending(character_id) == 0
+        assert store.pending_count(character_id) == 1
+
+        assert store.flush_pending(character_id) == 1
+        assert store.search(character_id, "猫", top_k=1)[0][0] == memory_id
+
+    def test_load_checks_watermark(self, tmp_path):
+        """保存後に記憶が変わったキャラクターのベクトルストアを読み込まないかのテスト"""
+        store = MemoryEmbeddingStore(HashingEmbeddingProvider(dimension=32))
+        character_id = uuid.uuid4()
+        store.build_character(character_id, [(uuid.uuid4(), "ユーザーの猫")])
+        assert store.save(str(tmp_path), {character_id: "1:1:saved"}) == 1
+
+        restored = MemoryEmbeddingStore(HashingEmbeddingProvider(dimension=32))
+        assert restored.load(str(tmp_path), watermarks={character_id: "2:2:new"}) == 0
+        assert not restored.has_character(character_id)
+        assert restored.load(str(tmp_path), watermarks={character_id: "1:1:saved"}) == 1
+        assert restored.has_character(character_id)
+
+    def test_lru_eviction(self):
+        """保持するキャラクター数の上限を超えた場合に最も長く検索されていないものを破棄するかのテスト"""
+        store = MemoryEmbeddingStore(
+            HashingEmbeddingProvider(dimension=32), max_characters=2
+        )
+        first, second, third = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+        store.build_character(first, [(uuid.uuid4(), "猫")])
+        store.build_character(second, [(uuid.uuid4(), "犬")])
+        store.add_memory(second, uuid.uuid4(), "未計算の記憶")
+        assert store.search(first, "猫")
+
+        store.build_character(third, [(uuid.uuid4(), "鳥")])
+        assert store.has_character(first)
+        assert not store.has_character(second)
+        assert store.pending_count(second) == 0
+        assert store.evictions == 1
+
+        with pytest.raises(ValueError):
+            MemoryEmbeddingStore(max_characters=0)
+
+    def test_litellm_provider_batches_requests(self):
+        """埋め込みのリクエストをバッチサイズごとに分割するかのテスト"""
+        provider = LiteLLMEmbeddingProvider(dimension=2, batch_size=2)
+
+        def fake_embedding(model, input):
+            return MagicMock(data=[{"embedding": [len(text), 1.0]} for text in input])
+
+        with patch("litellm.embedding", side_effect=fake_embedding) as embedding:
+            vectors = provider.embed(["a", "bb", "ccc", "dddd", "eeeee"])
+
+        assert [len(call.kwargs["input"]) for call in embedding.call_args_list] == [
+            2,
+            2,
+            1,
+        ]
+        assert vectors.shape == (5, 2)
+        assert np.allclose(vectors[4], np.array([5.0, 1.0]) / np.sqrt(26.0))
+
+    def test_ivf_search_matches_exact(self):
+        """IVFインデックスでの検索テスト"""
+        rng = np.random.default_rng(1)
+        vectors = rng.normal(size=(400, 16)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        ids = [str(i) for i in range(400)]
+
+        exact = CharacterVectorStore(16, ivf_threshold=10**9)
+        exact.add(ids, vectors)
+        ivf = CharacterVectorStore(16, ivf_threshold=100, nprobe=20)
+        ivf.add(ids, vectors)
+
+        query = vectors[7]
+        assert ivf.search(query, 1)[0][0] == exact.search(query, 1)[0][0] == "7"
+
+    def test_retriever_recall(self, db_session, test_character):
+        """CRUD操作に追従した意味的な記憶取得のテスト"""
+        memory = add_memory(
+            db=db_session,
+            user_id=test_character.user_id,
+            character_id=test_character.id,
+            memory_type=MEMORY_TYPE_DAILY_RAW,
+            start_day=1,
+            end_day=1,
+            content="ユーザーは猫のミケを飼っている。",
+        )
+        retriever = MemoryRetriever(db_session, test_character.id)
+        assert retriever.recall_similar_memories("ミケ", top_k=1)[0][0].id == memory.id
+
+        added = add_memory(
+            db=db_session,
+            user_id=test_character.user_id,
+            character_id=test_character.id,
+            memory_type=MEMORY_TYPE_DAILY_RAW,
+            start_day=2,
+            end_day=2,
+            content="ユーザーは犬の散歩が日課だ。",
+        )
+        assert retriever.recall_similar_memories("犬の散歩", top_k=1)[0][0].id == (
+            added.id
+        )
+
+
+@pytest.mark.unit
+class TestHybridScorer:
+    def test_score_components(self):
+        """経過日数・階層・関連度によるスコアのテスト"""
+        scorer = HybridScorer(
+            recency_weight=1.0,
+            tier_weight=1.0,
+            relevance_weight=1.0,
+            recency_half_life=10.0,
+            tier_weights={MEMORY_TYPE_DAILY_SUMMARY: 0.0, MEMORY_TYPE_LEVEL_10: 0.5},
+        )
+        scores = scorer.score(
+            current_day=100,
+            end_days=np.array([100, 90, 90]),
+            tier_levels=np.array([1, 1, 2]),
+            relevance=np.array([0.0, 0.0, 2.0]),
+        )
+
+        assert np.allclose(scores, [1.0, 0.5, 0.5 + 0.5 + 1.0])
+
+        # 経過日数は期間の中央の日から数える
+        spans = scorer.score(
+            current_day=100,
+            end_days=np.array([100, 100]),
+            tier_levels=np.array([1, 1]),
+            start_days=np.array([100, 80]),
+        )
+        assert np.allclose(spans, [1.0, 0.5])
+
+    def test_rank_memories_for_prompt(self, db_session, test_character):
+        """ユーザーメッセージとの関連度を含む記憶の並べ替えテスト"""
+        for day, content in [(9, "猫のミケと遊んだ"), (10, "雨が降った")]:
+            add_memory(
+                db=db_session,
+                user_id=test_character.user_id,
+                character_id=test_character.id,
+                memory_type=MEMORY_TYPE_DAILY_SUMMARY,
+                start_day=day,
+                end_day=day,
+                content=content,
+            )
+        retriever = MemoryRetriever(db_session, test_character.id)
+
+        by_recency = retriever.rank_memories_for_prompt(10)
+        assert [memory.content for _, memory, _ in by_recency] == [
+            "雨が降った",
+            "猫のミケと遊んだ",
+        ]
+
+        scorer = HybridScorer(relevance_weight=5.0)
+        by_relevance = retriever.rank_memories_for_prompt(
+            10, user_message="ミケは元気？", scorer=scorer, top_k=1
+        )
+        assert [(label, memory.content) for label, memory, _ in by_relevance] == [
+            ("昨日の記憶", "猫のミケと遊んだ")
+        ]
+
+    @pytest.mark.slow
+    def test_score_benchmark(self):
+        """10万件の候補のスコアリング速度のベンチマーク"""
+        rng = np.random.default_rng(0)
+        count = 100_000
+        end_days = rng.integers(1, 5000, size=count)
+        tier_levels = rng.integers(0, 6, size=count)
+        relevance = rng.random(count)
+        scorer = HybridScorer()
+
+        scorer.score(5000, end_days, tier_levels, relevance)
+        started = time.perf_counter()
+        for _ in range(10):
+            scorer.score(5000, end_days, tier_levels, relevance)
+        per_thousand_ms = (time.perf_counter() - started) / 10 / (count / 1000) * 1000
+
+        assert per_thousand_ms < 0.1, f"1000件あたり {per_thousand_ms:.4f} ms"
+
 
 @pytest.mark.unit
 class TestSleepProcessor:
@@ -156,6 +1926,280 @@ class TestSleepProcessor:
         assert len(processed) >= 1
         assert processed[0].memory_type == MEMORY_TYPE_DAILY_SUMMARY
 
+    def _add_daily_memories(self, db_session, character, memory_type, days):
+        for day in days:
+            add_memory(
+                db=db_session,
+                user_id=character.user_id,
+                character_id=character.id,
+                memory_type=memory_type,
+                start_day=day,
+                end_day=day,
+                content=f"{day}日目の記憶",
+            )
+
+    def test_process_daily_memories_batch_writes(self, db_session, test_character):
+        """睡眠処理1回分の書き込みを1回のコミットで確定するかのテスト"""
+        self._add_daily_memories(
+            db_session, test_character, MEMORY_TYPE_DAILY_RAW, range(1, 11)
+        )
+        self._add_daily_memories(
+            db_session, test_character, MEMORY_TYPE_DAILY_SUMMARY, range(1, 10)
+        )
+        processor = SleepProcessor(
+            db_session, test_character.id, "dummy-model", batch_writes=True
+        )
+
+        with (
+            patch.object(processor.memory_generator, "_call_llm", return_value="要約"),
+            patch.object(db_session, "commit", wraps=db_session.commit) as commit,
+        ):
+            processed = processor.process_daily_memories(current_day=10)
+
+        assert [memory.memory_type for memory in processed] == [
+            MEMORY_TYPE_DAILY_SUMMARY,
+            MEMORY_TYPE_LEVEL_10,
+        ]
+        assert commit.call_count == 1
+        db_session.refresh(test_character)
+        assert test_character.last_memory_processing_date is not None
+
+    def test_plan_catch_up(self, db_session, test_character):
+        """不足している要約の依存関係グラフのテスト"""
+        self._add_daily_memories(
+            db_session, test_character, MEMORY_TYPE_DAILY_RAW, range(1, 38)
+        )
+        # 1〜10日目は処理済み、11〜20日目はlevel_10のみ作成済みで15日目が不足
+        self._add_daily_memories(
+            db_session,
+            test_character,
+            MEMORY_TYPE_DAILY_SUMMARY,
+            [day for day in range(1, 21) if day != 15],
+        )
+        for start_day, end_day in [(1, 10), (11, 20)]:
+            add_memory(
+                db=db_session,
+                user_id=test_character.user_id,
+                character_id=test_character.id,
+                memory_type=MEMORY_TYPE_LEVEL_10,
+                start_day=start_day,
+                end_day=end_day,
+                content="10日間の要約",
+            )
+
+        processor = SleepProcessor(db_session, test_character.id, "dummy-model")
+        graph = processor.plan_catch_up(current_day=37)
+
+        daily = {
+            SummaryTask(MEMORY_TYPE_DAILY_SUMMARY, day, day)
+            for day in [15, *range(21, 38)]
+        }
+        assert set(graph) == daily | {
+            SummaryTask(MEMORY_TYPE_LEVEL_10, 11, 20),
+            SummaryTask(MEMORY_TYPE_LEVEL_10, 21, 30),
+        }
+        assert graph[SummaryTask(MEMORY_TYPE_LEVEL_10, 11, 20)] == {
+            SummaryTask(MEMORY_TYPE_DAILY_SUMMARY, 15, 15)
+        }
+        assert graph[SummaryTask(MEMORY_TYPE_LEVEL_10, 21, 30)] == {
+            SummaryTask(MEMORY_TYPE_DAILY_SUMMARY, day, day) for day in range(21, 31)
+        }
+
+        # 上位の階層は下位の計画済みの要約に依存する
+        graph = build_catch_up_plan(
+            [(MEMORY_TYPE_DAILY_RAW, day, day) for day in range(1, 2001)], 2000
+        )
+        assert len(graph) == 2000 + 200 + 20 + 2 + 1
+        archive = SummaryTask(MEMORY_TYPE_LEVEL_ARCHIVE, 1, 2000)
+        assert graph[archive] == {
+            SummaryTask(MEMORY_TYPE_LEVEL_1000, 1, 1000),
+            SummaryTask(MEMORY_TYPE_LEVEL_1000, 1001, 2000),
+        }
+        assert len(graph[SummaryTask(MEMORY_TYPE_LEVEL_100, 101, 200)]) == 10
+
+    def test_plan_rolling_archives(self):
+        """incrementalモードでarchiveを1つ前のarchiveに続けて計画するテスト"""
+        periods = [
+            (MEMORY_TYPE_LEVEL_1000, start_day, start_day + 999)
+            for start_day in range(1, 3002, 1000)
+        ]
+        graph = build_catch_up_plan(periods, 4000)
+        first = SummaryTask(MEMORY_TYPE_LEVEL_ARCHIVE, 1, 2000)
+        second = SummaryTask(MEMORY_TYPE_LEVEL_ARCHIVE, 1, 3000)
+        third = SummaryTask(MEMORY_TYPE_LEVEL_ARCHIVE, 1, 4000)
+        assert graph == {first: set(), second: {first}, third: {second}}
+
+        # 既存のarchive以降のlevel_1000のみを統合する
+        periods.append((MEMORY_TYPE_LEVEL_ARCHIVE, 1, 3000))
+        assert build_catch_up_plan(periods, 4000) == {third: set()}
+
+        # 既存のarchiveより前のlevel_1000を生成する場合はそれ以降のarchiveを作り直す
+        periods.remove((MEMORY_TYPE_LEVEL_1000, 2001, 3000))
+        periods.extend(
+            (MEMORY_TYPE_LEVEL_100, start_day, start_day + 99)
+            for start_day in range(2001, 3000, 100)
+        )
+        graph = build_catch_up_plan(periods, 4000)
+        level_1000 = SummaryTask(MEMORY_TYPE_LEVEL_1000, 2001, 3000)
+        assert graph[first] == set()
+        assert graph[second] == {first, level_1000}
+        assert graph[third] == {second}
+
+        # fullモードではすべてのlevel_1000から1件のarchiveを生成する
+        graph = build_catch_up_plan(periods, 4000, archive_mode="full")
+        assert graph[third] == {level_1000}
+
+    def test_catch_up_memories_skips_failed_dependencies(
+        self, db_session, test_character
+    ):
+        """失敗した要約に依存する要約を生成しないかのテスト"""
+        self._add_daily_memories(
+            db_session, test_character, MEMORY_TYPE_DAILY_RAW, range(1, 21)
+        )
+        processor = SleepProcessor(db_session, test_character.id, "dummy-model")
+
+        def fake_call_llm(prompt, messages=None, memory_type=None):
+            if memory_type == MEMORY_TYPE_DAILY_SUMMARY and "\n5日目の記憶\n" in prompt:
+                return ""
+            return f"{memory_type}の要約"
+
+        with patch.object(
+            processor.memory_generator, "_call_llm", side_effect=fake_call_llm
+        ):
+            processed = processor.catch_up_memories(current_day=20)
+
+        assert len(processed) == 19 + 1
+        assert {
+            (memory.memory_type, memory.start_day)
+            for memory in processed
+            if memory.memory_type == MEMORY_TYPE_LEVEL_10
+        } == {(MEMORY_TYPE_LEVEL_10, 11)}
+
+        # 次回の追いつき処理で不足分のみを再び計画する
+        assert set(processor.plan_catch_up(current_day=20)) == {
+            SummaryTask(MEMORY_TYPE_DAILY_SUMMARY, 5, 5),
+            SummaryTask(MEMORY_TYPE_LEVEL_10, 1, 10),
+        }
+
+    def test_catch_up_memories_raises_after_saving_others(
+        self, db_session, test_character
+    ):
+        """LLMの呼び出しが失敗した場合に他の要約を保存してから例外を送出するかのテスト"""
+        self._add_daily_memories(
+            db_session, test_character, MEMORY_TYPE_DAILY_RAW, range(1, 21)
+        )
+        processor = SleepProcessor(
+            db_session, test_character.id, "dummy-model", batch_writes=True
+        )
+
+        def fake_call_llm(prompt, messages=None, memory_type=None):
+            if memory_type == MEMORY_TYPE_DAILY_SUMMARY and "\n5日目の記憶\n" in prompt:
+                raise CircuitOpenError("gemini のサーキットが開いています")
+            return f"{memory_type}の要約"
+
+        with (
+            patch.object(
+                processor.memory_generator, "_call_llm", side_effect=fake_call_llm
+            ),
+            pytest.raises(CircuitOpenError),
+        ):
+            processor.catch_up_memories(current_day=20)
+
+        # 生成できた要約は保存され、失敗した要約と依存する要約のみが再び計画される
+        assert set(processor.plan_catch_up(current_day=20)) == {
+            SummaryTask(MEMORY_TYPE_DAILY_SUMMARY, 5, 5),
+            SummaryTask(MEMORY_TYPE_LEVEL_10, 1, 10),
+        }
+
+    @pytest.mark.asyncio
+    async def test_acatch_up_memories_raises_after_saving_others(
+        self, db_session, test_character
+    ):
+        """非同期の追いつき処理でLLMの呼び出しが失敗した場合のテスト"""
+        self._add_daily_memories(
+            db_session, test_character, MEMORY_TYPE_DAILY_RAW, range(1, 21)
+        )
+        processor = SleepProcessor(db_session, test_character.id, "dummy-model")
+
+        async def fake_acall_llm(prompt, messages=None, memory_type=None):
+            if memory_type == MEMORY_TYPE_DAILY_SUMMARY and "\n5日目の記憶\n" in prompt:
+                raise CircuitOpenError("gemini のサーキットが開いています")
+            return f"{memory_type}の要約"
+
+        with (
+            patch.object(
+                processor.memory_generator, "_acall_llm", side_effect=fake_acall_llm
+            ),
+            pytest.raises(CircuitOpenError),
+        ):
+            await processor.acatch_up_memories(current_day=20)
+
+        assert set(processor.plan_catch_up(current_day=20)) == {
+            SummaryTask(MEMORY_TYPE_DAILY_SUMMARY, 5, 5),
+            SummaryTask(MEMORY_TYPE_LEVEL_10, 1, 10),
+        }
+
+    def test_sleep_session_fails_when_llm_unavailable(self, db_session, test_character):
+        """LLMを呼び出せない場合に睡眠セッションがエラーで終了するかのテスト"""
+        self._add_daily_memories(
+            db_session, test_character, MEMORY_TYPE_DAILY_RAW, range(1, 11)
+        )
+        processor = SleepProcessor(db_session, test_character.id, "dummy-model")
+
+        with patch.object(
+            processor.memory_generator,
+            "_call_llm",
+            side_effect=CircuitOpenError("gemini のサーキットが開いています"),
+        ):
+            result = processor.start_sleep_session(current_day=10)
+
+        assert result["success"] is False
+        session = get_sessions_by_character(db_session, test_character.id)[0]
+        assert session.status == SESSION_STATUS_ERROR
+        assert result["error"] == "gemini のサーキットが開いています"
+
+    @pytest.mark.asyncio
+    async def test_acatch_up_memories_runs_in_parallel(
+        self, db_session, test_character
+    ):
+        """依存関係グラフに沿った並行な追いつき処理のテスト"""
+        self._add_daily_memories(
+            db_session, test_character, MEMORY_TYPE_DAILY_RAW, range(1, 38)
+        )
+        processor = SleepProcessor(db_session, test_character.id, "dummy-model")
+        active = 0
+        peak = 0
+        order = []
+
+        async def fake_acall_llm(prompt, messages=None, memory_type=None):
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.05)
+            active -= 1
+            order.append(memory_type)
+            return f"{memory_type}の要約"
+
+        with patch.object(
+            processor.memory_generator, "_acall_llm", side_effect=fake_acall_llm
+        ):
+            processed = await processor.acatch_up_memories(current_day=37)
+
+        assert len(processed) == 37 + 3
+        assert peak >= 10
+        # level_10は依存するdaily_summaryの後に保存される
+        for memory in processed:
+            if memory.memory_type == MEMORY_TYPE_LEVEL_10:
+                saved_before = {
+                    other.start_day
+                    for other in processed[: processed.index(memory)]
+                    if other.memory_type == MEMORY_TYPE_DAILY_SUMMARY
+                }
+                assert set(range(memory.start_day, memory.end_day + 1)) <= (
+                    saved_before
+                )
+        assert processor.plan_catch_up(current_day=37) == {}
+
     @patch("app.memory.processor.create_session")
     @patch("app.memory.processor.end_session")
     def test_start_sleep_session(
@@ -183,3 +2227,311 @@ class TestSleepProcessor:
         assert result["processed_memories_count"] == 1
         assert mock_create_session.called
         assert mock_end_session.called
+
+    def test_resume_sleep_session_after_failure(self, db_session, test_character):
+        """途中で失敗した睡眠セッションを完了済みのステップから再開するかのテスト"""
+        self._add_daily_memories(
+            db_session, test_character, MEMORY_TYPE_DAILY_RAW, range(1, 11)
+        )
+        self._add_daily_memories(
+            db_session, test_character, MEMORY_TYPE_DAILY_SUMMARY, range(1, 10)
+        )
+        processor = SleepProcessor(db_session, test_character.id, "dummy-model")
+        calls = []
+
+        def fake_call_llm(prompt, messages=None, memory_type=None):
+            calls.append(memory_type)
+            return f"{memory_type}の要約"
+
+        # daily_summaryの保存後、level_10の生成中に処理が失敗する
+        with (
+            patch.object(
+                processor.memory_generator, "_call_llm", side_effect=fake_call_llm
+            ),
+            patch.object(
+                processor.memory_generator,
+                "generate_hierarchical_summary",
+                side_effect=RuntimeError("処理が中断されました"),
+            ),
+        ):
+            failed = processor.start_sleep_session(current_day=10)
+
+        assert failed["success"] is False
+        assert calls == [MEMORY_TYPE_DAILY_SUMMARY]
+        failed_session = get_sessions_by_character(db_session, test_character.id)[0]
+        assert failed_session.properties[SESSION_PROP_COMPLETED_STEPS] == [
+            "daily_summary:10-10"
+        ]
+        failed_session.started_at = datetime.now() - timedelta(minutes=1)
+        db_session.commit()
+
+        calls.clear()
+        with patch.object(
+            processor.memory_generator, "_call_llm", side_effect=fake_call_llm
+        ):
+            result = processor.start_sleep_session(current_day=10)
+
+        assert result["success"] is True
+        assert result["resumed_from"] == str(failed_session.id)
+        assert calls == [MEMORY_TYPE_LEVEL_10]
+        assert result["processed_memory_types"] == [
+            MEMORY_TYPE_DAILY_SUMMARY,
+            MEMORY_TYPE_LEVEL_10,
+        ]
+        session = db_session.get(DbSession, uuid.UUID(result["session_id"]))
+        assert session.properties[SESSION_PROP_COMPLETED_STEPS] == [
+            "daily_summary:10-10",
+            "level_10:1-10",
+        ]
+        assert (
+            len(
+                memory_crud.get_memories_for_range(
+                    db_session, test_character.id, MEMORY_TYPE_DAILY_SUMMARY, 10, 10
+                )
+            )
+            == 1
+        )
+
+        # 完了したセッションからは再開しない
+        calls.clear()
+        with patch.object(
+            processor.memory_generator, "_call_llm", side_effect=fake_call_llm
+        ):
+            assert processor.start_sleep_session(current_day=10)["resumed_from"] is None
+        assert calls == []
+
+
+@pytest.mark.unit
+class TestSleepWorker:
+    @pytest.fixture
+    def jobs_db(self, session_factory):
+        db = session_factory()
+        yield db
+        db.close()
+
+    @pytest.fixture
+    def character_id(self, jobs_db):
+        return create_character(jobs_db, uuid.uuid4(), "ワーカーテスト").id
+
+    @pytest.mark.asyncio
+    async def test_run_processes_jobs_concurrently(
+        self, jobs_db, character_id, session_factory
+    ):
+        """複数のジョブを並行に処理して完了にするかのテスト"""
+        jobs = [enqueue_sleep_job(jobs_db, character_id, day) for day in (1, 2, 3)]
+        active = 0
+        peak = 0
+
+        async def handler(db, job):
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.05)
+            active -= 1
+            return {"current_day": job.current_day}
+
+        worker = SleepWorker(
+            session_factory=session_factory,
+            worker_id="worker-test",
+            concurrency=3,
+            handler=handler,
+        )
+        assert await worker.run(stop_when_idle=True) == 3
+        assert peak == 3
+
+        for job in jobs:
+            jobs_db.refresh(job)
+            assert job.status == SLEEP_JOB_STATUS_COMPLETED
+            assert job.result == {"current_day": job.current_day}
+
+    @pytest.mark.asyncio
+    async def test_run_sleep_job_keeps_database_work_off_event_loop(
+        self, jobs_db, character_id, session_factory
+    ):
+        """既定のハンドラーがイベントループのスレッドでデータベースを使用しないかのテスト"""
+        user_id = jobs_db.get(Character, character_id).user_id
+        for day in range(1, 11):
+            add_memory(
+                db=jobs_db,
+                user_id=user_id,
+                character_id=character_id,
+                memory_type=MEMORY_TYPE_DAILY_RAW,
+                start_day=day,
+                end_day=day,
+                content=f"{day}日目の記憶",
+            )
+        job = enqueue_sleep_job(jobs_db, character_id, 10)
+        worker = SleepWorker(
+            session_factory=session_factory, concurrency=1, batch_writes=True
+        )
+
+        async def fake_acall_llm(prompt, messages=None, memory_type=None):
+            await asyncio.sleep(0)
+            return f"{memory_type}の要約"
+
+        loop_thread = threading.get_ident()
+        statement_threads = set()
+
+        def record_thread(*args):
+            statement_threads.add(threading.get_ident())
+
+        engine = session_factory.kw["bind"]
+        event.listen(engine, "before_cursor_execute", record_thread)
+        try:
+            with patch.object(
+                MemoryGenerator, "_acall_llm", side_effect=fake_acall_llm
+            ):
+                assert await worker.run(stop_when_idle=True) == 1
+        finally:
+            event.remove(engine, "before_cursor_execute", record_thread)
+
+        assert statement_threads
+        assert loop_thread not in statement_threads
+        jobs_db.refresh(job)
+        assert job.status == SLEEP_JOB_STATUS_COMPLETED
+        assert job.result["processed_memories_count"] == 11
+
+    @pytest.mark.asyncio
+    async def test_failed_job_is_retried_then_dead_lettered(
+        self, jobs_db, character_id, session_factory
+    ):
+        """失敗したジョブを再試行し、上限に達したら破棄するかのテスト"""
+        job = enqueue_sleep_job(jobs_db, character_id, 1, max_attempts=2)
+        calls = []
+
+        async def handler(db, claimed):
+            calls.append(claimed.attempts)
+            raise RuntimeError("処理に失敗しました")
+
+        worker = SleepWorker(
+            session_factory=session_factory,
+            concurrency=1,
+            retry_delay=0,
+            handler=handler,
+        )
+        assert await worker.run(stop_when_idle=True) == 0
+
+        jobs_db.refresh(job)
+        assert calls == [1, 2]
+        assert job.status == SLEEP_JOB_STATUS_DEAD
+        assert job.last_error == "処理に失敗しました"
+
+    @pytest.mark.asyncio
+    async def test_heartbeat_extends_lease_and_cancels_on_loss(
+        self, jobs_db, character_id, session_factory
+    ):
+        """ハートビートによるリース延長と、リースを失った場合の中断のテスト"""
+        extended = enqueue_sleep_job(jobs_db, character_id, 1)
+        worker = SleepWorker(
+            session_factory=session_factory,
+            worker_id="worker-a",
+            concurrency=1,
+            lease_seconds=0.5,
+            heartbeat_interval=0.05,
+        )
+
+        async def slow_handler(db, job):
+            await asyncio.sleep(0.2)
+            return {}
+
+        worker.handler = slow_handler
+        assert await worker.run(stop_when_idle=True) == 1
+        jobs_db.refresh(extended)
+        assert extended.status == SLEEP_JOB_STATUS_COMPLETED
+        assert extended.heartbeat_at is not None
+
+        lost = enqueue_sleep_job(jobs_db, character_id, 2)
+
+        async def stolen_handler(db, job):
+            # 他のワーカーがリースを取得した状態にする
+            other = session_factory()
+            other.query(SleepJob).filter(SleepJob.id == job.id).update(
+                {SleepJob.locked_by: "worker-b"}
+            )
+            other.commit()
+            other.close()
+            await asyncio.sleep(1)
+            return {}
+
+        worker.handler = stolen_handler
+        assert await worker.run(stop_when_idle=True) == 0
+        jobs_db.refresh(lost)
+        assert lost.status == SLEEP_JOB_STATUS_RUNNING
+        assert lost.locked_by == "worker-b"
+
+    @pytest.mark.asyncio
+    async def test_heartbeat_extends_lease_while_job_runs(
+        self, jobs_db, character_id, session_factory
+    ):
+        """ジョブの処理中にハートビートのスレッドがリースを延長するかのテスト"""
+        job = enqueue_sleep_job(jobs_db, character_id, 1)
+        worker = SleepWorker(
+            session_factory=session_factory,
+            concurrency=1,
+            lease_seconds=0.5,
+            heartbeat_interval=0.05,
+        )
+        heartbeat_sleep_job = sleep_job_crud.heartbeat_sleep_job
+        heartbeat_done = threading.Event()
+
+        def recording_heartbeat(*args, **kwargs):
+            extended = heartbeat_sleep_job(*args, **kwargs)
+            heartbeat_done.set()
+            return extended
+
+        def read_lease(job_id):
+            with session_factory() as other:
+                return other.get(SleepJob, job_id).lease_expires_at
+
+        async def waiting_handler(db, claimed):
+            # 経過時間ではなくハートビートの完了を待つ
+            assert await asyncio.to_thread(heartbeat_done.wait, 5)
+            extended = await asyncio.to_thread(read_lease, claimed.id)
+            return {"extended": extended > claimed.lease_expires_at}
+
+        worker.handler = waiting_handler
+        with patch.object(
+            sleep_job_crud, "heartbeat_sleep_job", side_effect=recording_heartbeat
+        ):
+            assert await worker.run(stop_when_idle=True) == 1
+        jobs_db.refresh(job)
+        assert job.result == {"extended": True}
+
+    @pytest.mark.asyncio
+    async def test_lost_lease_on_complete_is_not_counted(
+        self, jobs_db, character_id, session_factory
+    ):
+        """完了の記録時にリースを失っていたジョブを処理済みに数えないかのテスト"""
+        job = enqueue_sleep_job(jobs_db, character_id, 1)
+        worker = SleepWorker(
+            session_factory=session_factory,
+            worker_id="worker-a",
+            concurrency=1,
+            lease_seconds=60,
+            heartbeat_interval=30,
+        )
+
+        async def stolen_handler(db, claimed):
+            # ハートビートが検知する前に他のワーカーがリースを取得した状態にする
+            with session_factory() as other:
+                other.query(SleepJob).filter(SleepJob.id == claimed.id).update(
+                    {SleepJob.locked_by: "worker-b"}
+                )
+                other.commit()
+            return {}
+
+        worker.handler = stolen_handler
+        assert await worker.run(stop_when_idle=True) == 0
+        assert worker.processed_jobs == 0
+        jobs_db.refresh(job)
+        assert job.status == SLEEP_JOB_STATUS_RUNNING
+        assert job.locked_by == "worker-b"
+
+    def test_invalid_settings(self, session_factory):
+        """無効な設定のテスト"""
+        with pytest.raises(ValueError):
+            SleepWorker(session_factory=session_factory, concurrency=0)
+        with pytest.raises(ValueError):
+            SleepWorker(
+                session_factory=session_factory, lease_seconds=10, heartbeat_interval=10
+            )
@@ -0,0 +1 @@
+ALTER TABLE memories ADD COLUMN IF NOT EXISTS source_fingerprint TEXT;
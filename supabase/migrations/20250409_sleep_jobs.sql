@@ -0,0 +1,28 @@
+-- Durable queue for sleep processing, claimed by workers with FOR UPDATE SKIP LOCKED
+CREATE TABLE IF NOT EXISTS sleep_jobs (
+  id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+  character_id UUID NOT NULL REFERENCES characters(id) ON DELETE CASCADE,
+  current_day INTEGER NOT NULL,
+  /*
+   * status:
+   * - 'pending': waiting to be claimed (after run_after)
+   * - 'running': claimed by locked_by until lease_expires_at
+   * - 'completed': finished successfully
+   * - 'dead': gave up after max_attempts (dead-letter)
+   */
+  status TEXT NOT NULL DEFAULT 'pending',
+  attempts INTEGER NOT NULL DEFAULT 0,
+  max_attempts INTEGER NOT NULL DEFAULT 5,
+  run_after TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  locked_by TEXT,
+  lease_expires_at TIMESTAMPTZ,
+  heartbeat_at TIMESTAMPTZ,
+  last_error TEXT,
+  result JSONB,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_sleep_jobs_status_run_after ON sleep_jobs(status, run_after);
+
+ALTER TABLE sleep_jobs ENABLE ROW LEVEL SECURITY;
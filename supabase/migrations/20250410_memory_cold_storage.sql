@@ -0,0 +1,12 @@
+-- Cold tier for old daily_raw memories: content moves to a zlib-compressed side table
+ALTER TABLE memories ADD COLUMN IF NOT EXISTS is_compressed BOOLEAN NOT NULL DEFAULT FALSE;
+
+CREATE TABLE IF NOT EXISTS memory_cold_contents (
+  memory_id UUID PRIMARY KEY REFERENCES memories(id) ON DELETE CASCADE,
+  compressed_content BYTEA NOT NULL,
+  original_bytes INTEGER NOT NULL,
+  compressed_bytes INTEGER NOT NULL,
+  compressed_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+ALTER TABLE memory_cold_contents ENABLE ROW LEVEL SECURITY;
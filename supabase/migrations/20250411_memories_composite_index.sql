@@ -0,0 +1,9 @@
+-- Composite index for the hot memories predicate:
+--   character_id = ? AND memory_type = ? AND start_day >= ? AND end_day <= ?
+--   ORDER BY start_day DESC, id DESC
+-- end_day is carried in the leaf pages so the range filter does not touch the heap.
+CREATE INDEX IF NOT EXISTS idx_memories_character_type_start_day
+  ON memories(character_id, memory_type, start_day, id) INCLUDE (end_day);
+
+-- Superseded by the leading columns of the composite index above
+DROP INDEX IF EXISTS idx_memories_character_memory_type;
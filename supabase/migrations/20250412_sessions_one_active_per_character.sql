@@ -0,0 +1,23 @@
+-- Enforce "one active session per character" in the database so that
+-- create_session can start a session with a single
+-- INSERT ... ON CONFLICT DO NOTHING RETURNING statement.
+
+-- Close all but the most recent active session of each character before adding the index
+UPDATE sessions
+SET is_active = FALSE,
+    status = 'completed',
+    last_updated_at = NOW()
+WHERE is_active
+  AND id NOT IN (
+    SELECT DISTINCT ON (character_id) id
+    FROM sessions
+    WHERE is_active
+    ORDER BY character_id, started_at DESC, id DESC
+  );
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_sessions_one_active_per_character
+  ON sessions(character_id) WHERE is_active;
+
+-- The old constraint blocked a device from ever starting a second session with the
+-- same character and did not prevent two devices from holding active sessions
+ALTER TABLE sessions DROP CONSTRAINT IF EXISTS unique_active_device_character;
@@ -0,0 +1,3 @@
+-- Incremented whenever a memory's content is edited, so that persisted search and
+-- embedding partitions can detect content-only changes in their watermark
+ALTER TABLE memories ADD COLUMN IF NOT EXISTS content_version INTEGER NOT NULL DEFAULT 1;